@@ -0,0 +1,151 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from g4fschedule import BATCH, concurrency_warning, request_priority
+
+# Default number of prompts in flight
+BATCH_CONCURRENCY = 8
+
+# Turn one input line into chat messages.  A line is either a JSON string,
+# or an object with "messages" (a full history) or a prompt field.
+def parse_prompt(record, field):
+    if isinstance(record, str):
+        return [{"role": "user", "content": record}]
+    if "messages" in record:
+        return record["messages"]
+    return [{"role": "user", "content": record[field]}]
+
+# Indices already answered in an existing output file.  A torn last line
+# left by a crash is cut off so appending starts on a clean line, and rows
+# of failed prompts are dropped, since those prompts are run again and
+# their new rows appended.
+def completed_indices(output_path):
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    good_size = 0
+    failed = False
+    with open(output_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                result = json.loads(line)
+            except ValueError:
+                break
+            good_size += len(line)
+            if result.get("error") is None:
+                done.add(result["index"])
+            else:
+                failed = True
+    if failed:
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        with open(output_path, 'rb') as f, open(tmp_path, 'wb') as out:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    break
+                if result.get("error") is None:
+                    out.write(line)
+        os.replace(tmp_path, output_path)
+    elif good_size != os.path.getsize(output_path):
+        with open(output_path, 'r+b') as f:
+            f.truncate(good_size)
+    return done
+
+# Run every prompt in input_path through a pool of workers on the engine,
+# appending results to output_path as they complete.  Replies come from and
+# go to the response cache.  Input is read lazily through a bounded
+# queue, so memory stays flat however long the file is.  Each result carries
+# the line's index; lines already answered in output_path are skipped, which
+# is how an interrupted run is resumed.
+async def run_batch(engine, input_path, output_path, provider_name, concurrency=BATCH_CONCURRENCY,
+                    field="prompt", failover_providers=1, on_progress=None):
+    done = completed_indices(output_path)
+    prompts = asyncio.Queue(maxsize=concurrency * 2)
+    stats = {"done": 0, "cached": 0, "errors": 0, "skipped": len(done)}
+
+    with open(output_path, 'a') as output:
+        def write(result):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            key = "errors" if result.get("error") else "cached" if result.get("cached") else "done"
+            stats[key] += 1
+            if on_progress:
+                on_progress(stats)
+
+        async def worker():
+            # Batch prompts queue behind chats for the provider's rate limit
+            request_priority.set(BATCH)
+            while True:
+                item = await prompts.get()
+                if item is None:
+                    return
+                index, record = item
+                result = {"index": index}
+                if isinstance(record, dict) and "id" in record:
+                    result["id"] = record["id"]
+                start = time.perf_counter()
+                try:
+                    messages = parse_prompt(record, field)
+                    winner, response, cached = await engine.complete(
+                        provider_name, messages, stream=False, failover=failover_providers
+                    )
+                    result.update(provider=winner, response=response, cached=cached, error=None)
+                except Exception as e:
+                    result.update(provider=provider_name, response=None, cached=False, error=f"{type(e).__name__}: {e}")
+                result["latency"] = round(time.perf_counter() - start, 3)
+                write(result)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+        with open(input_path, 'r') as f:
+            for index, line in enumerate(f):
+                if index in done or not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    write({"index": index, "provider": provider_name, "response": None, "cached": False,
+                           "error": f"Invalid JSON: {e}"})
+                    continue
+                await prompts.put((index, record))
+        for _ in workers:
+            await prompts.put(None)
+        await asyncio.gather(*workers)
+    return stats
+
+# Entry point for 'g4fchatplus.py batch ...'
+def batch_main(argv, engine):
+    parser = argparse.ArgumentParser(prog="g4fchatplus.py batch", description="Answer a JSONL file of prompts.")
+    parser.add_argument("input", help="JSONL file of prompts")
+    parser.add_argument("output", help="JSONL file results are appended to (resumes if it exists)")
+    parser.add_argument("--provider", required=True, help="provider to ask")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY,
+                        help="prompts in flight, at most the provider's limits in rate_limits.json allow")
+    parser.add_argument("--field", default="prompt", help="field holding the prompt in object lines")
+    parser.add_argument("--failover", type=int, default=1, metavar="N", help="providers to try per prompt")
+    args = parser.parse_args(argv)
+
+    if args.provider not in engine.registry:
+        parser.error(f"unknown provider '{args.provider}'")
+    warning = concurrency_warning(args.provider, max(1, args.concurrency))
+    if warning:
+        print(warning, file=sys.stderr)
+
+    def progress(stats):
+        print(f"\rdone {stats['done']}  cached {stats['cached']}  errors {stats['errors']}", end="", file=sys.stderr, flush=True)
+
+    start = time.perf_counter()
+    stats = asyncio.run(run_batch(engine, args.input, args.output, args.provider,
+                                  max(1, args.concurrency), args.field, args.failover, progress))
+    elapsed = time.perf_counter() - start
+    answered = stats["done"] + stats["cached"] + stats["errors"]
+    print(f"\n{answered} prompts in {elapsed:.1f}s ({answered / elapsed if elapsed else 0:.1f}/s), "
+          f"{stats['skipped']} already done", file=sys.stderr)
+    return 1 if stats["errors"] else 0
@@ -0,0 +1,285 @@
+import argparse
+import asyncio
+import hashlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import g4fcache
+from g4fcache import ResponseStore, cache_response, get_cached_response
+from g4fhealth import percentile
+from g4fmetrics import get_metrics
+from g4fregistry import ProviderRegistry
+from g4fschedule import get_scheduler
+
+# Scenarios run when none are named
+SCENARIOS = ("cache", "startup", "history", "sessions", "batch")
+
+# Cache sizes for the cache scenario
+CACHE_SIZES = (1000, 100000)
+
+# Lookups timed per cache size
+CACHE_SAMPLES = 1000
+
+# Words fake replies are made of
+_WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+
+# Build a provider class that answers locally with the given behaviour.
+#
+# latency is the seconds a whole reply takes and ttft the seconds before
+# its first chunk; streamed replies arrive in chunks of chunk_size
+# characters spread over the rest of the latency.  error_rate is the
+# fraction of calls that raise, response_size the reply length in
+# characters.  Replies are derived from the prompt, so equal prompts get
+# equal replies, and errors come from a seeded generator so runs repeat.
+def make_fake_provider(name="Fake", latency=0.05, ttft=0.01, chunk_size=16, error_rate=0.0,
+                       response_size=512, supports_stream=True, seed=0):
+    rng = random.Random(seed)
+
+    def reply(messages):
+        prompt = messages[-1].get("content", "") if messages else ""
+        digest = int(hashlib.sha1(prompt.encode("utf-8")).hexdigest(), 16)
+        words = []
+        size = 0
+        while size < response_size:
+            words.append(_WORDS[digest % len(_WORDS)])
+            digest = digest // len(_WORDS) or digest + 7919
+            size += len(words[-1]) + 1
+        return " ".join(words)[:response_size]
+
+    def fail():
+        if error_rate and rng.random() < error_rate:
+            raise RuntimeError(f"{name} failed (simulated)")
+
+    class FakeProvider:
+        local = True
+        working = True
+        needs_auth = False
+
+        @staticmethod
+        async def create_async(model, messages, **kwargs):
+            await asyncio.sleep(latency)
+            fail()
+            return reply(messages)
+
+        @staticmethod
+        async def create_async_generator(model, messages, **kwargs):
+            await asyncio.sleep(ttft)
+            fail()
+            text = reply(messages)
+            chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)] or [""]
+            delay = max(0.0, latency - ttft) / len(chunks)
+            for i, chunk in enumerate(chunks):
+                if i and delay:
+                    await asyncio.sleep(delay)
+                yield chunk
+
+    FakeProvider.supports_stream = supports_stream
+    FakeProvider.__name__ = FakeProvider.__qualname__ = name
+    return FakeProvider
+
+# Add a fake provider to a registry (available_providers or a fresh one)
+def register_fake_provider(registry=None, name="Fake", **behaviour):
+    if registry is None:
+        registry = ProviderRegistry({"providers": {}})
+    registry.register(name, make_fake_provider(name, **behaviour))
+    # The fake provider has no rate limits to respect
+    get_scheduler().configure(name)
+    return registry
+
+# Summary of a list of timings in seconds
+def summarize(timings):
+    return {
+        "count": len(timings),
+        "total": sum(timings),
+        "mean": sum(timings) / len(timings) if timings else None,
+        "p50": percentile(timings, 0.5),
+        "p95": percentile(timings, 0.95),
+    }
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+# Store and lookup costs of the response cache at each size
+def bench_cache(options):
+    results = {}
+    rng = random.Random(options.seed)
+    value = "x" * options.response_size
+    for size in options.cache_sizes:
+        store = ResponseStore(f"bench{size}", max_bytes=0, max_entries=0, ttl=0)
+        start = time.perf_counter()
+        for i in range(size):
+            store.put(f"key{i}", value)
+        fill = time.perf_counter() - start
+        keys = [f"key{rng.randrange(size)}" for _ in range(options.cache_samples)]
+        hits = [_timed(lambda key=key: store.get(key)) for key in keys]
+        misses = [_timed(lambda i=i: store.get(f"missing{i}")) for i in range(options.cache_samples)]
+        store.close()
+        reopen = _timed(lambda: ResponseStore(f"bench{size}", max_bytes=0, max_entries=0, ttl=0).close())
+        # Full cache path, with context keys and near-duplicate signatures
+        provider = f"benchfull{size}"
+        prompts = [[{"role": "user", "content": f"benchmark prompt number {i}"}] for i in range(options.cache_samples)]
+        stores = [_timed(lambda m=m: cache_response(provider, m, value)) for m in prompts]
+        lookups = [_timed(lambda m=m: get_cached_response(provider, m)) for m in prompts]
+        results[str(size)] = {
+            "fill_per_second": size / fill if fill else None,
+            "get_hit": summarize(hits),
+            "get_miss": summarize(misses),
+            "reopen": reopen,
+            "cache_response": summarize(stores),
+            "get_cached_response": summarize(lookups),
+        }
+    return results
+
+# Fresh interpreters importing the engine, and discovering providers
+def bench_startup(options):
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=here + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    timings = []
+    for _ in range(options.runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import g4fcore, g4fbatch"], check=True, env=env)
+        timings.append(time.perf_counter() - start)
+    results = {"import_engine": summarize(timings)}
+    if importlib.util.find_spec("g4f") is None:
+        results["discovery"] = {"skipped": "g4f is not installed"}
+    else:
+        from g4fregistry import benchmark_startup
+        results["discovery"] = benchmark_startup(options.runs)
+    return results
+
+# Turns on top of a long history: what the engine adds per turn
+async def bench_history(options, registry):
+    from g4fcore import ChatEngine, TurnOutput
+    from g4fsessions import SessionStore
+    engine = ChatEngine(registry, store=SessionStore())
+    session = engine.open_session("bench-history", "Fake")
+    for i in range(options.history_turns):
+        session.history.append({"role": "user", "content": f"earlier question {i} " + "x" * 200})
+        session.history.append({"role": "assistant", "content": f"earlier answer {i} " + "y" * 400})
+    timings = []
+    for i in range(options.turns):
+        start = time.perf_counter()
+        await session.send(f"new question {i}", TurnOutput())
+        timings.append(time.perf_counter() - start)
+    await engine.shutdown()
+    return {"history_turns": options.history_turns, "turn": summarize(timings),
+            "overhead_p50": percentile(timings, 0.5) - options.latency}
+
+# Many chats sending at once
+async def bench_sessions(options, registry):
+    from g4fcore import ChatEngine, TurnOutput
+    engine = ChatEngine(registry)
+
+    async def chat(index):
+        session = engine.open_session(f"bench-{index}", "Fake")
+        for turn in range(options.turns):
+            await session.send(f"chat {index} turn {turn}", TurnOutput())
+
+    start = time.perf_counter()
+    await asyncio.gather(*(chat(i) for i in range(options.sessions)))
+    elapsed = time.perf_counter() - start
+    await engine.shutdown()
+    turns = options.sessions * options.turns
+    return {"sessions": options.sessions, "turns": turns, "seconds": elapsed, "turns_per_second": turns / elapsed}
+
+# Batch mode throughput
+async def bench_batch(options, registry):
+    from g4fbatch import run_batch
+    from g4fcore import ChatEngine
+    engine = ChatEngine(registry)
+    with open("batch_in.jsonl", 'w') as f:
+        for i in range(options.batch_prompts):
+            f.write(json.dumps({"prompt": f"batch prompt {i}"}) + "\n")
+    start = time.perf_counter()
+    stats = await run_batch(engine, "batch_in.jsonl", "batch_out.jsonl", "Fake", options.concurrency,
+                            failover_providers=1)
+    elapsed = time.perf_counter() - start
+    return {"prompts": options.batch_prompts, "concurrency": options.concurrency, "seconds": elapsed,
+            "prompts_per_second": options.batch_prompts / elapsed, "stats": stats}
+
+# Run the named scenarios in a scratch directory and return the results
+def run_benchmarks(options):
+    registry = register_fake_provider(
+        name="Fake", latency=options.latency, ttft=options.ttft, chunk_size=options.chunk_size,
+        error_rate=options.error_rate, response_size=options.response_size, seed=options.seed
+    )
+    results = {
+        "meta": {
+            "time": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "options": vars(options),
+        },
+        "scenarios": {},
+    }
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="g4fbench-") as scratch:
+        # Every store uses relative paths, so the run never touches real data
+        os.chdir(scratch)
+        try:
+            for scenario in options.scenarios:
+                random.seed(options.seed)
+                start = time.perf_counter()
+                if scenario == "cache":
+                    result = bench_cache(options)
+                elif scenario == "startup":
+                    result = bench_startup(options)
+                else:
+                    bench = {"history": bench_history, "sessions": bench_sessions, "batch": bench_batch}[scenario]
+                    result = asyncio.run(bench(options, registry))
+                result["elapsed"] = time.perf_counter() - start
+                results["scenarios"][scenario] = result
+                print(f"{scenario}: done in {result['elapsed']:.1f}s", file=sys.stderr)
+        finally:
+            g4fcache.close_stores()
+            # Export now so nothing is written to the real cache at exit
+            get_metrics().export()
+            os.chdir(cwd)
+    return results
+
+def _sizes(text):
+    return [int(size) for size in text.split(",") if size]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="g4fbench.py", description="Benchmark the chat engine against a local fake provider.")
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake provider seconds per reply")
+    parser.add_argument("--ttft", type=float, default=0.01, help="fake provider seconds to first chunk")
+    parser.add_argument("--chunk-size", type=int, default=16, help="fake provider characters per chunk")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake provider calls failing")
+    parser.add_argument("--response-size", type=int, default=512, help="fake provider characters per reply")
+    parser.add_argument("--cache-sizes", type=_sizes, default=list(CACHE_SIZES), help="comma separated cache sizes")
+    parser.add_argument("--cache-samples", type=int, default=CACHE_SAMPLES, help="lookups timed per cache size")
+    parser.add_argument("--runs", type=int, default=5, help="interpreter starts timed")
+    parser.add_argument("--history-turns", type=int, default=2000, help="turns of history before the timed turns")
+    parser.add_argument("--turns", type=int, default=20, help="timed turns per chat")
+    parser.add_argument("--sessions", type=int, default=50, help="concurrent chats")
+    parser.add_argument("--batch-prompts", type=int, default=1000, help="prompts in the batch file")
+    parser.add_argument("--concurrency", type=int, default=32, help="batch prompts in flight")
+    options = parser.parse_args(argv)
+    options.scenarios = options.scenarios or list(SCENARIOS)
+    for scenario in options.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario '{scenario}'")
+
+    results = run_benchmarks(options)
+    text = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
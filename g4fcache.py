@@ -0,0 +1,843 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+import atexit
+import random
+import re
+import zlib
+from collections import OrderedDict
+from g4fstate import FileLock, write_atomic
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Directory for caching
+CACHE_DIR = "cache"
+
+# Per-provider cache limits, 0 disables a limit
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_MAX_ENTRIES = 50000
+CACHE_TTL = 30 * 24 * 3600
+
+# Compact once dead records outweigh live ones and pass this size
+COMPACT_MIN_BYTES = 1024 * 1024
+
+# Number of earlier messages that are part of a cache key
+CACHE_CONTEXT_MESSAGES = 6
+
+# Near-duplicate prompt lookup
+NEAR_DUPLICATE_LOOKUP = False
+NEAR_DUPLICATE_THRESHOLD = 0.85
+SHINGLE_SIZE = 4
+MINHASH_BANDS = 16
+MINHASH_ROWS = 4
+
+# Shared, compressed response bodies
+BLOB_DIR = os.path.join(CACHE_DIR, "blobs")
+BLOB_COMPRESS_LEVEL = 6
+
+# Collect unreferenced blobs once the pack passes this size and has doubled since the last collection
+BLOB_GC_MIN_BYTES = 16 * 1024 * 1024
+
+# Open stores, one per provider
+_stores = {}
+_stores_lock = threading.RLock()
+_blobs = None
+_blobs_lock = threading.Lock()
+
+# Hash a cache key for the index
+def _key_hash(key):
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+def _file_id(path):
+    stat = _stat(path)
+    return stat.st_ino if stat else None
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# Complete JSON lines of a log from position on, and the position after the
+# last of them; a line still being written is left for the next read
+def _read_log(f, position):
+    f.seek(position)
+    records = []
+    for line in f:
+        if not line.endswith(b"\n"):
+            break
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break
+        records.append(record)
+        position += len(line)
+    return records, position
+
+# Append-only response store for a single provider.
+#
+# Responses go to a data log ("<provider>.<generation>.dat") and every put or
+# eviction appends a small record to an index log ("<provider>.idx").  Opening
+# a store replays only the index, so lookups are a dict hit plus one seek and
+# read, never a full load.  The first line of the index names the data file it
+# belongs to; compaction writes a new generation and swaps the index in with
+# an atomic rename, so a crash at any point leaves a consistent pair behind.
+#
+# Several processes may share a store.  Writers take "<provider>.lock" and
+# first replay what others appended; readers never lock, and on a miss
+# replay new index records, or reopen when the index was swapped for a new
+# generation.
+class ResponseStore:
+    def __init__(self, provider, cache_dir=None, max_bytes=None, max_entries=None, ttl=None):
+        self.provider = provider
+        self.cache_dir = cache_dir or CACHE_DIR
+        self.max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_entries = CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.ttl = CACHE_TTL if ttl is None else ttl
+        self.index_file = os.path.join(self.cache_dir, f"{provider}.idx")
+        # Taken before lock: serializes writers across processes
+        self.file_lock = FileLock(os.path.join(self.cache_dir, f"{provider}.lock"))
+        self.lock = threading.RLock()
+        # key hash -> [offset, length, created], least recently used first
+        self.entries = OrderedDict()
+        self.live_bytes = 0
+        self.generation = 0
+        self.data = None
+        self.index = None
+        # Inode of the open index, and how much of it has been applied
+        self.index_id = None
+        self.index_position = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.similar = None
+        self._open()
+
+    def _data_path(self, generation):
+        return os.path.join(self.cache_dir, f"{self.provider}.{generation}.dat")
+
+    def _open(self):
+        if self._load():
+            return
+        with self.file_lock:
+            # Another process may have created the store meanwhile
+            if not self._load():
+                self._write_fresh(1, [])
+
+    # Open the current index and data log; False when there is no index yet
+    def _load(self):
+        if not os.path.exists(self.index_file):
+            return False
+        index = open(self.index_file, "a+b")
+        # A torn last line from a crash is simply ignored
+        records, position = _read_log(index, 0)
+        if not records:
+            index.close()
+            return False
+        generation = records.pop(0)["generation"]
+        data_path = self._data_path(generation)
+        existed = os.path.exists(data_path)
+        data = open(data_path, "a+b")
+        index_id = os.fstat(index.fileno()).st_ino
+        if _file_id(self.index_file) != index_id:
+            # Compacted by another process meanwhile; open the new generation
+            data.close()
+            index.close()
+            if not existed:
+                _remove(data_path)
+            return self._load()
+        self._close_files()
+        self.generation = generation
+        self.entries = OrderedDict()
+        self.live_bytes = 0
+        self.data, self.index = data, index
+        self.index_id, self.index_position = index_id, position
+        self._apply(records)
+        return True
+
+    def _apply(self, records):
+        data_size = os.fstat(self.data.fileno()).st_size
+        now = time.time()
+        for op, key_hash, offset, length, created in records:
+            if op == "-":
+                self._drop(key_hash)
+            elif offset + length <= data_size and not self._expired(created, now):
+                self._drop(key_hash)
+                self.entries[key_hash] = [offset, length, created]
+                self.live_bytes += length
+
+    # Catch up with what other processes wrote since the index was read: new
+    # records are replayed, a new generation is opened
+    def _sync(self):
+        stat = _stat(self.index_file)
+        if stat is None:
+            return
+        if stat.st_ino != self.index_id:
+            self._load()
+        elif stat.st_size > self.index_position:
+            records, self.index_position = _read_log(self.index, self.index_position)
+            self._apply(records)
+
+    # Write a brand new generation containing the given (key hash, record
+    # bytes, created) items.  The caller holds file_lock.
+    def _write_fresh(self, generation, items):
+        data_path = self._data_path(generation)
+        entries = OrderedDict()
+        live_bytes = 0
+        with open(data_path, "wb") as data:
+            index_lines = [json.dumps({"generation": generation}).encode("utf-8") + b"\n"]
+            for key_hash, payload, created in items:
+                offset = data.tell()
+                data.write(payload)
+                entries[key_hash] = [offset, len(payload), created]
+                live_bytes += len(payload)
+                index_lines.append(self._index_line("+", key_hash, offset, len(payload), created))
+            data.flush()
+            os.fsync(data.fileno())
+        index_data = b"".join(index_lines)
+        write_atomic(self.index_file, index_data)
+
+        old_generation = self.generation
+        self._close_files()
+        if old_generation and old_generation != generation:
+            _remove(self._data_path(old_generation))
+        self.generation = generation
+        self.entries = entries
+        self.live_bytes = live_bytes
+        self.data = open(data_path, "a+b")
+        self.index = open(self.index_file, "a+b")
+        self.index_id = os.fstat(self.index.fileno()).st_ino
+        self.index_position = len(index_data)
+
+    def _close_files(self):
+        if self.data:
+            self.data.close()
+            self.index.close()
+            self.data = self.index = None
+
+    def _index_line(self, op, key_hash, offset, length, created):
+        return json.dumps([op, key_hash, offset, length, created], separators=(",", ":")).encode("utf-8") + b"\n"
+
+    def _append_index(self, line):
+        self.index.write(line)
+        self.index.flush()
+        self.index_position += len(line)
+
+    def _expired(self, created, now):
+        return self.ttl and now - created > self.ttl
+
+    def _drop(self, key_hash):
+        entry = self.entries.pop(key_hash, None)
+        if entry:
+            self.live_bytes -= entry[1]
+        return entry
+
+    def _read(self, entry):
+        self.data.seek(entry[0])
+        return json.loads(self.data.read(entry[1]))
+
+    def get(self, key):
+        key_hash = _key_hash(key)
+        with self.lock:
+            entry = self.entries.get(key_hash)
+            if entry is None:
+                # Another process may have stored it since
+                self._sync()
+                entry = self.entries.get(key_hash)
+                if entry is None:
+                    return None
+            # Expired entries are misses; readers never take the file lock,
+            # so they stay until compaction or eviction drops them
+            if self._expired(entry[2], time.time()):
+                return None
+            record = self._read(entry)
+            if record.get("k") != key:
+                return None
+            self.entries.move_to_end(key_hash)
+            return record["v"]
+
+    def put(self, key, value):
+        key_hash = _key_hash(key)
+        payload = json.dumps({"k": key, "v": value}).encode("utf-8") + b"\n"
+        created = time.time()
+        with self.file_lock, self.lock:
+            self._sync()
+            self.data.seek(0, os.SEEK_END)
+            offset = self.data.tell()
+            # Data first: an index record never points at bytes that are not on disk
+            self.data.write(payload)
+            self.data.flush()
+            self._append_index(self._index_line("+", key_hash, offset, len(payload), created))
+            self._drop(key_hash)
+            self.entries[key_hash] = [offset, len(payload), created]
+            self.live_bytes += len(payload)
+            self._evict()
+            self._maybe_compact()
+
+    def delete(self, key):
+        with self.file_lock, self.lock:
+            self._sync()
+            self._delete_hash(_key_hash(key))
+
+    def _delete_hash(self, key_hash):
+        if self._drop(key_hash):
+            self._append_index(self._index_line("-", key_hash, 0, 0, 0))
+
+    # Evict least recently used entries until the limits hold again
+    def _evict(self):
+        while self.entries and (
+            (self.max_entries and len(self.entries) > self.max_entries)
+            or (self.max_bytes and self.live_bytes > self.max_bytes)
+        ):
+            self._delete_hash(next(iter(self.entries)))
+
+    def _maybe_compact(self):
+        self.data.seek(0, os.SEEK_END)
+        dead_bytes = self.data.tell() - self.live_bytes
+        if dead_bytes > COMPACT_MIN_BYTES and dead_bytes > self.live_bytes:
+            self.compact()
+
+    # Rewrite the live entries into a new generation, dropping dead and expired ones
+    def compact(self):
+        with self.file_lock, self.lock:
+            self._sync()
+            now = time.time()
+            items = []
+            for key_hash, entry in self.entries.items():
+                if self._expired(entry[2], now):
+                    continue
+                self.data.seek(entry[0])
+                items.append((key_hash, self.data.read(entry[1]), entry[2]))
+            self._write_fresh(self.generation + 1, items)
+
+    # (value, created) of every live entry
+    def values(self):
+        with self.lock:
+            self._sync()
+            return [(self._read(entry)["v"], entry[2]) for entry in list(self.entries.values())]
+
+    def close(self):
+        with self.lock:
+            self._close_files()
+        self.file_lock.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+# Content-addressed, compressed store for response bodies, shared by every
+# provider.
+#
+# A body is stored once under the SHA-256 of its text, however many
+# providers, chats or prompts produced it; provider stores only keep a
+# reference to it.  Bodies are compressed with zstd when the zstandard
+# module is installed (with the trained dictionary named in "zstd.current",
+# if any) and zlib otherwise.  The codec and dictionary id are recorded per
+# blob, so blobs written any way stay readable.  Bodies go to an append-only pack
+# ("<generation>.pack") indexed by "index", whose first line names the pack
+# generation; collect() rewrites only the blobs still referenced into a new
+# generation and swaps the index in atomically.  Processes share it the way
+# they share a ResponseStore, with "lock" as the writers' lock.
+class BlobStore:
+    def __init__(self, blob_dir=None):
+        self.blob_dir = blob_dir or BLOB_DIR
+        self.index_file = os.path.join(self.blob_dir, "index")
+        # Taken before lock: serializes writers across processes
+        self.file_lock = FileLock(os.path.join(self.blob_dir, "lock"))
+        self.lock = threading.RLock()
+        # blob hash -> [offset, length, codec]
+        self.entries = {}
+        self.generation = 0
+        self.collected_size = 0
+        self.pack = None
+        self.index = None
+        # Inode of the open index, and how much of it has been applied
+        self.index_id = None
+        self.index_position = 0
+        os.makedirs(self.blob_dir, exist_ok=True)
+        # Trained dictionaries by id, and the id new blobs are compressed with
+        self.dictionaries = {}
+        self.dictionary_id = None
+        if zstandard is not None:
+            for file_name in os.listdir(self.blob_dir):
+                if file_name.startswith("zstd-") and file_name.endswith(".dict"):
+                    self._load_dictionary(file_name[5:-5])
+            current_path = os.path.join(self.blob_dir, "zstd.current")
+            if os.path.exists(current_path):
+                with open(current_path, "r") as f:
+                    self.dictionary_id = f.read().strip() or None
+        self._open()
+
+    def _pack_path(self, generation):
+        return os.path.join(self.blob_dir, f"{generation}.pack")
+
+    def _load_dictionary(self, dictionary_id):
+        with open(os.path.join(self.blob_dir, f"zstd-{dictionary_id}.dict"), "rb") as f:
+            dictionary = self.dictionaries[dictionary_id] = zstandard.ZstdCompressionDict(f.read())
+        return dictionary
+
+    def _open(self):
+        if self._load():
+            return
+        with self.file_lock:
+            # Another process may have created the store meanwhile
+            if not self._load():
+                self._write_fresh(1, [])
+
+    # Open the current index and pack; False when there is no index yet
+    def _load(self):
+        if not os.path.exists(self.index_file):
+            return False
+        index = open(self.index_file, "a+b")
+        records, position = _read_log(index, 0)
+        if not records:
+            index.close()
+            return False
+        header = records.pop(0)
+        pack_path = self._pack_path(header["generation"])
+        existed = os.path.exists(pack_path)
+        pack = open(pack_path, "a+b")
+        index_id = os.fstat(index.fileno()).st_ino
+        if _file_id(self.index_file) != index_id:
+            # Collected by another process meanwhile; open the new generation
+            pack.close()
+            index.close()
+            if not existed:
+                _remove(pack_path)
+            return self._load()
+        self._close_files()
+        self.generation = header["generation"]
+        self.collected_size = header.get("collected_size", 0)
+        self.entries = {}
+        self.pack, self.index = pack, index
+        self.index_id, self.index_position = index_id, position
+        self._apply(records)
+        return True
+
+    def _apply(self, records):
+        pack_size = os.fstat(self.pack.fileno()).st_size
+        for blob_hash, offset, length, codec in records:
+            if offset + length <= pack_size:
+                self.entries[blob_hash] = [offset, length, codec]
+
+    # Catch up with blobs other processes stored since the index was read
+    def _sync(self):
+        stat = _stat(self.index_file)
+        if stat is None:
+            return
+        if stat.st_ino != self.index_id:
+            self._load()
+        elif stat.st_size > self.index_position:
+            records, self.index_position = _read_log(self.index, self.index_position)
+            self._apply(records)
+
+    # Write a new generation holding the given (hash, compressed bytes, codec)
+    # items.  The caller holds file_lock.
+    def _write_fresh(self, generation, items):
+        pack_path = self._pack_path(generation)
+        entries = {}
+        with open(pack_path, "wb") as pack:
+            lines = []
+            for blob_hash, data, codec in items:
+                entries[blob_hash] = [pack.tell(), len(data), codec]
+                lines.append(self._index_line(blob_hash, pack.tell(), len(data), codec))
+                pack.write(data)
+            pack.flush()
+            os.fsync(pack.fileno())
+            size = pack.tell()
+        header = json.dumps({"generation": generation, "collected_size": size}).encode("utf-8") + b"\n"
+        index_data = header + b"".join(lines)
+        write_atomic(self.index_file, index_data)
+        old_generation = self.generation
+        self._close_files()
+        if old_generation and old_generation != generation:
+            _remove(self._pack_path(old_generation))
+        self.generation = generation
+        self.collected_size = size
+        self.entries = entries
+        self.pack = open(pack_path, "a+b")
+        self.index = open(self.index_file, "a+b")
+        self.index_id = os.fstat(self.index.fileno()).st_ino
+        self.index_position = len(index_data)
+
+    def _close_files(self):
+        if self.pack:
+            self.pack.close()
+            self.index.close()
+            self.pack = self.index = None
+
+    def _index_line(self, blob_hash, offset, length, codec):
+        return json.dumps([blob_hash, offset, length, codec], separators=(",", ":")).encode("utf-8") + b"\n"
+
+    def _compress(self, data):
+        if zstandard is not None:
+            dictionary = self.dictionaries.get(self.dictionary_id)
+            compressor = zstandard.ZstdCompressor(level=BLOB_COMPRESS_LEVEL, dict_data=dictionary)
+            return compressor.compress(data), f"zstd:{self.dictionary_id}" if dictionary else "zstd"
+        compressed = zlib.compress(data, BLOB_COMPRESS_LEVEL)
+        # Short replies may not shrink at all
+        return (compressed, "zlib") if len(compressed) < len(data) else (data, "raw")
+
+    def _decompress(self, data, codec):
+        if codec == "raw":
+            return data
+        if codec == "zlib":
+            return zlib.decompress(data)
+        if zstandard is None:
+            raise RuntimeError("Blob was written with zstd; install the zstandard module to read it")
+        dictionary = None
+        if codec.startswith("zstd:"):
+            # Possibly trained by another process after this one started
+            dictionary = self.dictionaries.get(codec[5:]) or self._load_dictionary(codec[5:])
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(data)
+
+    # Store a body and return its hash; a body already stored is not written again
+    def put(self, text):
+        data = text.encode("utf-8")
+        blob_hash = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if blob_hash in self.entries:
+                return blob_hash
+        with self.file_lock, self.lock:
+            self._sync()
+            if blob_hash in self.entries:
+                return blob_hash
+            compressed, codec = self._compress(data)
+            self.pack.seek(0, os.SEEK_END)
+            offset = self.pack.tell()
+            # Data first: an index record never points at bytes that are not on disk
+            self.pack.write(compressed)
+            self.pack.flush()
+            line = self._index_line(blob_hash, offset, len(compressed), codec)
+            self.index.write(line)
+            self.index.flush()
+            self.index_position += len(line)
+            self.entries[blob_hash] = [offset, len(compressed), codec]
+        return blob_hash
+
+    def get(self, blob_hash):
+        with self.lock:
+            entry = self.entries.get(blob_hash)
+            if entry is None:
+                # Another process may have stored it since
+                self._sync()
+                entry = self.entries.get(blob_hash)
+                if entry is None:
+                    return None
+            self.pack.seek(entry[0])
+            data = self.pack.read(entry[1])
+        return self._decompress(data, entry[2]).decode("utf-8")
+
+    def size(self):
+        with self.lock:
+            self.pack.seek(0, os.SEEK_END)
+            return self.pack.tell()
+
+    def should_collect(self):
+        size = self.size()
+        return size > BLOB_GC_MIN_BYTES and size > 2 * self.collected_size
+
+    # Keep only the blobs whose hashes are in live.  The caller holds
+    # file_lock while finding the live hashes, so no reference to a new blob
+    # can be written in between.
+    def collect(self, live):
+        with self.file_lock, self.lock:
+            self._sync()
+            items = []
+            for blob_hash, (offset, length, codec) in self.entries.items():
+                if blob_hash in live:
+                    self.pack.seek(offset)
+                    items.append((blob_hash, self.pack.read(length), codec))
+            self._write_fresh(self.generation + 1, items)
+
+    def close(self):
+        with self.lock:
+            self._close_files()
+        self.file_lock.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+# Train a zstd dictionary on stored bodies; new blobs are compressed with it
+def train_blob_dictionary(size=112640, samples=2000):
+    if zstandard is None:
+        raise RuntimeError("Training a dictionary needs the zstandard module")
+    blobs = get_blobs()
+    texts = [blobs.get(blob_hash).encode("utf-8") for blob_hash in list(blobs.entries)[-samples:]]
+    dictionary = zstandard.train_dictionary(size, texts)
+    dictionary_id = str(dictionary.dict_id())
+    write_atomic(os.path.join(blobs.blob_dir, f"zstd-{dictionary_id}.dict"), dictionary.as_bytes())
+    write_atomic(os.path.join(blobs.blob_dir, "zstd.current"), dictionary_id)
+    with blobs.lock:
+        blobs.dictionaries[dictionary_id] = dictionary
+        blobs.dictionary_id = dictionary_id
+    return len(texts)
+
+# MinHash permutations, fixed so signatures stay comparable across runs
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(0x6734F)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+
+# Lowercase and collapse whitespace so trivially different prompts compare equal
+def normalize_prompt(text):
+    return " ".join(re.findall(r"\w+|[^\w\s]", text.lower()))
+
+# MinHash signature over character shingles of the normalized prompt
+def minhash_signature(text):
+    text = normalize_prompt(text)
+    if len(text) <= SHINGLE_SIZE:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in shingles]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+# Fraction of matching signature slots, an estimate of the Jaccard similarity
+def signature_similarity(a, b):
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+# Hash of everything a reply depends on apart from the prompt itself
+def context_key(provider, model, messages):
+    context = [
+        [m.get("role"), m.get("content")]
+        for m in messages[:-1][-CACHE_CONTEXT_MESSAGES:]
+    ] if CACHE_CONTEXT_MESSAGES else []
+    # Pinned system prompts matter no matter how far back they are
+    system = [m.get("content") for m in messages[:-1] if m.get("role") == "system"]
+    payload = json.dumps([provider, model, system, context], separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# Cache key for the last message of a conversation
+def cache_key(provider, model, messages):
+    prompt = messages[-1].get("content", "")
+    payload = context_key(provider, model, messages) + "\0" + prompt
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# Locality-sensitive hash index over prompt signatures for one provider.
+#
+# Signatures are split into bands; two prompts with the same context that
+# share any band become candidates, and a candidate is accepted when its
+# estimated similarity reaches the threshold.  Entries are appended to
+# "<provider>.lsh" and loaded on first near-duplicate lookup.
+class NearDuplicateIndex:
+    def __init__(self, store):
+        self.store = store
+        self.path = os.path.join(store.cache_dir, f"{store.provider}.lsh")
+        self.signatures = {}
+        self.contexts = {}
+        self.buckets = {}
+        self._load()
+
+    def _bands(self, context, signature):
+        for band in range(MINHASH_BANDS):
+            rows = signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]
+            yield (band, context, tuple(rows))
+
+    def _insert(self, key, context, signature):
+        self.signatures[key] = signature
+        self.contexts[key] = context
+        for bucket in self._bands(context, signature):
+            self.buckets.setdefault(bucket, set()).add(key)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        lines = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                lines += 1
+                key, context, signature = json.loads(line)
+                # Keys the store has since evicted are left out
+                if _key_hash(key) in self.store.entries:
+                    self._insert(key, context, signature)
+        if lines > 2 * len(self.signatures) + 100:
+            self._rewrite()
+
+    def _rewrite(self):
+        write_atomic(self.path, b"".join(
+            _signature_line(key, self.contexts[key], signature) for key, signature in self.signatures.items()
+        ))
+
+    # Best matching key for the prompt within the same context, or None
+    def lookup(self, context, prompt, threshold):
+        signature = minhash_signature(prompt)
+        candidates = set()
+        for bucket in self._bands(context, signature):
+            candidates |= self.buckets.get(bucket, set())
+        best, best_score = None, threshold
+        for key in candidates:
+            score = signature_similarity(signature, self.signatures[key])
+            if score >= best_score:
+                best, best_score = key, score
+        return best
+
+def _signature_line(key, context, signature):
+    return json.dumps([key, context, signature], separators=(",", ":")).encode("utf-8") + b"\n"
+
+# Get (opening on first use) the store for a provider
+def get_store(provider):
+    with _stores_lock:
+        store = _stores.get(provider)
+        if store is not None:
+            return store
+        store = _stores[provider] = ResponseStore(provider)
+    _migrate_pickle(store)
+    return store
+
+# Get (opening on first use) the shared blob store
+def get_blobs():
+    global _blobs
+    with _blobs_lock:
+        if _blobs is None:
+            _blobs = BlobStore()
+        return _blobs
+
+# Get (loading on first use) the near-duplicate index for a store
+def _similar_index(store):
+    # Loading may rewrite the signature file, which writers append to
+    with store.file_lock, store.lock:
+        if store.similar is None:
+            store.similar = NearDuplicateIndex(store)
+        return store.similar
+
+# Unpickler for the legacy caches that only builds plain containers and
+# strings: a pickle referring to any class or function is rejected, so a
+# tampered cache file cannot run code
+class _LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Refusing to load {module}.{name} from a legacy cache")
+
+# Import the legacy whole-file pickle cache once, then set it aside.  Old
+# entries were keyed on the bare prompt, so they become first-turn entries.
+def _migrate_pickle(store):
+    legacy_file = os.path.join(store.cache_dir, f"{store.provider}_cache.pkl")
+    if not os.path.exists(legacy_file):
+        return
+    # One process imports it; the others find it gone
+    with get_blobs().file_lock:
+        if not os.path.exists(legacy_file):
+            return
+        try:
+            with open(legacy_file, "rb") as f:
+                legacy = _LegacyUnpickler(f).load()
+        except Exception:
+            legacy = {}
+        if not isinstance(legacy, dict):
+            legacy = {}
+        for query, response in legacy.items():
+            if isinstance(query, str) and isinstance(response, str):
+                _store_response(store, None, [{"role": "user", "content": query}], response)
+        os.replace(legacy_file, legacy_file + ".migrated")
+
+def _store_response(store, model, messages, response):
+    key = cache_key(store.provider, model, messages)
+    context = context_key(store.provider, model, messages)
+    signature = minhash_signature(messages[-1].get("content", ""))
+    blobs = get_blobs()
+    # The store only keeps a reference; the body is stored once, compressed.
+    # Holding the blob lock until the reference is written keeps a
+    # collection in another process from dropping the body in between.
+    with blobs.file_lock:
+        store.put(key, {"b": blobs.put(response)})
+    if blobs.should_collect():
+        collect_blobs()
+    # Signatures are appended even when the index is not loaded yet
+    with store.file_lock, store.lock:
+        if store.similar is not None:
+            store.similar._insert(key, context, signature)
+        with open(os.path.join(store.cache_dir, f"{store.provider}.lsh"), "ab") as f:
+            f.write(_signature_line(key, context, signature))
+
+# Text of a stored value: a blob reference, or a response stored inline
+# before the blob store existed
+def _resolve(value):
+    if isinstance(value, dict):
+        return get_blobs().get(value["b"])
+    return value
+
+# Providers with a store on disk
+def stored_providers(cache_dir=None):
+    cache_dir = cache_dir or CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        return []
+    return sorted(file_name[:-4] for file_name in os.listdir(cache_dir) if file_name.endswith(".idx"))
+
+# (response, created) of every live entry of a provider's store
+def stored_responses(provider):
+    for value, created in get_store(provider).values():
+        text = _resolve(value)
+        if text is not None:
+            yield text, created
+
+# Drop blobs no provider store refers to any more
+def collect_blobs():
+    blobs = get_blobs()
+    # No process can add a reference while the live set is gathered
+    with blobs.file_lock:
+        live = set()
+        for provider in stored_providers():
+            for value, _ in get_store(provider).values():
+                if isinstance(value, dict):
+                    live.add(value["b"])
+        blobs.collect(live)
+
+# Close all open stores
+def close_stores():
+    global _blobs
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
+    with _blobs_lock:
+        if _blobs is not None:
+            _blobs.close()
+            _blobs = None
+
+atexit.register(close_stores)
+
+# Cache function: messages ends with the user message being answered
+def cache_response(provider, messages, response, model=None):
+    _store_response(get_store(provider), model, messages, response)
+
+# Get cached response, optionally falling back to a near-duplicate prompt
+def get_cached_response(provider, messages, model=None, near_duplicate=None):
+    store = get_store(provider)
+    response = store.get(cache_key(provider, model, messages))
+    if response is not None:
+        return _resolve(response)
+    if near_duplicate is None:
+        near_duplicate = NEAR_DUPLICATE_LOOKUP
+    if not near_duplicate:
+        return None
+    index = _similar_index(store)
+    with store.lock:
+        key = index.lookup(context_key(provider, model, messages), messages[-1].get("content", ""), NEAR_DUPLICATE_THRESHOLD)
+    return _resolve(store.get(key)) if key else None
+
+if __name__ == "__main__":
+    import sys
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "gc":
+        before = get_blobs().size()
+        collect_blobs()
+        print(f"Blob pack {before} -> {get_blobs().size()} bytes")
+    elif command == "train-dict":
+        print(f"Trained a dictionary on {train_blob_dictionary()} responses")
+    else:
+        for provider in stored_providers():
+            print(f"{provider}: {len(get_store(provider))} entries")
+        print(f"Blobs: {len(get_blobs())} unique responses, {get_blobs().size()} bytes")
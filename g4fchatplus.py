@@ -1,15 +1,21 @@
-import g4f
+import asyncio
 import sys
-import inspect
-import json
-import os
-import pickle
 from datetime import datetime
-import sys
-import select
-
-# Dictionary to store available providers
-available_providers = {}
+from g4fcore import ChatEngine, TurnOutput
+from g4fregistry import load_providers, parse_filter
+from g4fhealth import get_scoreboard, probe_providers as probe_all, rank_providers
+from g4fsessions import SessionStore
+from g4fsearch import open_search_index
+from g4fstate import SharedDict
+from g4fprofile import capture, enable_from_argv, phase
+from g4fworkflow import describe_prompt, parse_prompt_text
+
+# --profile writes profiles of startup, discovery and every turn to profiles/
+enable_from_argv()
+
+# Available providers, from the cached provider manifest
+with capture("discovery"):
+    available_providers = load_providers()
 
 # File to store API keys
 API_KEYS_FILE = "api_keys.json"
@@ -17,80 +23,52 @@ API_KEYS_FILE = "api_keys.json"
 # File to store custom prompts
 CUSTOM_PROMPTS_FILE = "custom_prompts.json"
 
-# Directory for caching
-CACHE_DIR = "cache"
-
-# Load API keys from file
+# API keys, shared with other running instances: changes are saved as
+# they are made and other instances' changes are seen on the next read
 def load_api_keys():
-    if os.path.exists(API_KEYS_FILE):
-        with open(API_KEYS_FILE, 'r') as f:
-            return json.load(f)
-    return {}
-
-# Save API keys to file
-def save_api_keys(api_keys):
-    with open(API_KEYS_FILE, 'w') as f:
-        json.dump(api_keys, f, indent=2)
+    return SharedDict(API_KEYS_FILE)
 
-# Load custom prompts from file
+# Custom prompts, shared the same way
 def load_custom_prompts():
-    if os.path.exists(CUSTOM_PROMPTS_FILE):
-        with open(CUSTOM_PROMPTS_FILE, 'r') as f:
-            return json.load(f)
-    return {}
-
-# Save custom prompts to file
-def save_custom_prompts(custom_prompts):
-    with open(CUSTOM_PROMPTS_FILE, 'w') as f:
-        json.dump(custom_prompts, f, indent=2)
-
-# Cache function
-def cache_response(provider, query, response):
-    if not os.path.exists(CACHE_DIR):
-        os.makedirs(CACHE_DIR)
-    cache_file = os.path.join(CACHE_DIR, f"{provider}_cache.pkl")
-    cache = {}
-    if os.path.exists(cache_file):
-        with open(cache_file, 'rb') as f:
-            cache = pickle.load(f)
-    cache[query] = response
-    with open(cache_file, 'wb') as f:
-        pickle.dump(cache, f)
-
-# Get cached response
-def get_cached_response(provider, query):
-    cache_file = os.path.join(CACHE_DIR, f"{provider}_cache.pkl")
-    if os.path.exists(cache_file):
-        with open(cache_file, 'rb') as f:
-            cache = pickle.load(f)
-        return cache.get(query)
-    return None
+    return SharedDict(CUSTOM_PROMPTS_FILE)
 
-# Dynamically get all provider classes from g4f.Provider
-for name, obj in inspect.getmembers(g4f.Provider):
-    if inspect.isclass(obj) and issubclass(obj, g4f.Provider.BaseProvider) and obj != g4f.Provider.BaseProvider:
-        try:
-            if obj.working:
-                available_providers[name] = obj
-        except AttributeError:
-            pass
+# Providers in the order they were last displayed
+displayed_providers = []
 
 # Function to display available providers
-def display_providers():
+def display_providers(names=None):
+    global displayed_providers
+    names = list(available_providers.keys()) if names is None else names
+    displayed_providers = rank_providers(names)
+    scoreboard = get_scoreboard()
     print("\nAvailable providers:")
-    for i, provider in enumerate(available_providers.keys(), start=1):
-        print(f"{i}. {provider}")
+    for i, provider in enumerate(displayed_providers, start=1):
+        print(f"{i}. {provider} ({scoreboard.describe(provider)})")
+
+# Function to probe all providers and show the results
+def probe_providers(api_keys):
+    print(f"\nProbing {len(available_providers)} providers...")
+
+    def show(result):
+        status = "ok" if result["ok"] else f"failed ({result['error']})"
+        print(f"{result['provider']}: {status} in {result['latency']:.1f}s")
+
+    run(probe_all(available_providers, api_keys=api_keys, on_result=show))
+    display_providers()
 
 # Function to get user input for provider selection
 def get_provider_choice():
     while True:
-        choice = input("Enter your choice (number) or 'q' to quit: ")
+        choice = input("Enter your choice (number), 'filter stream|noauth|auth' or 'q' to quit: ")
         if choice.lower() == 'q':
             return None
+        if choice.lower().startswith('filter'):
+            display_providers(available_providers.filter(**parse_filter(choice.split()[1:])))
+            continue
         try:
             index = int(choice) - 1
-            if 0 <= index < len(available_providers):
-                return list(available_providers.keys())[index]
+            if 0 <= index < len(displayed_providers):
+                return displayed_providers[index]
             else:
                 print("Invalid choice. Please try again.")
         except ValueError:
@@ -114,13 +92,11 @@ def manage_api_keys(api_keys):
             provider = input("Enter provider name: ")
             key = input("Enter API key: ")
             api_keys[provider] = key
-            save_api_keys(api_keys)
             print("API key added/updated successfully.")
         elif choice == '3':
             provider = input("Enter provider name to remove: ")
             if provider in api_keys:
                 del api_keys[provider]
-                save_api_keys(api_keys)
                 print("API key removed successfully.")
             else:
                 print("Provider not found.")
@@ -142,18 +118,20 @@ def manage_custom_prompts(custom_prompts):
         if choice == '1':
             print("\nCurrent custom prompts:")
             for name, prompt in custom_prompts.items():
-                print(f"{name}: {prompt}")
+                print(f"{name}: {describe_prompt(prompt)}")
         elif choice == '2':
             name = input("Enter prompt name: ")
-            prompt = input("Enter prompt: ")
-            custom_prompts[name] = prompt
-            save_custom_prompts(custom_prompts)
+            prompt = input("Enter prompt (a JSON object with \"steps\" makes a workflow): ")
+            try:
+                custom_prompts[name] = parse_prompt_text(name, prompt)
+            except ValueError as e:
+                print(e)
+                continue
             print("Custom prompt added/updated successfully.")
         elif choice == '3':
             name = input("Enter prompt name to remove: ")
             if name in custom_prompts:
                 del custom_prompts[name]
-                save_custom_prompts(custom_prompts)
                 print("Custom prompt removed successfully.")
             else:
                 print("Prompt not found.")
@@ -164,70 +142,93 @@ def manage_custom_prompts(custom_prompts):
 
 # Function to display provider information
 def display_provider_info(provider_name):
-    provider = available_providers[provider_name]
+    provider = available_providers.info(provider_name)
     print(f"\nProvider Information for {provider_name}:")
-    print(f"Working: {provider.working}")
-    print(f"Supports Stream: {provider.supports_stream}")
-    print(f"Needs Auth: {provider.needs_auth}")
-    if hasattr(provider, 'params'):
+    print(f"Working: {provider['working']}")
+    print(f"Supports Stream: {provider['supports_stream']}")
+    print(f"Needs Auth: {provider['needs_auth']}")
+    if 'params' in provider:
         print("Parameters:")
-        for param, value in provider.params.items():
-            print(f"  {param}: {value}")
+        if isinstance(provider['params'], dict):
+            for param, value in provider['params'].items():
+                print(f"  {param}: {value}")
+        else:
+            print(f"  {provider['params']}")
+
+# Prints a turn's output to the terminal
+class ConsoleOutput(TurnOutput):
+    def line(self, text):
+        print(text)
+
+    def reply_start(self, label):
+        with phase("render"):
+            print(f"{label}: ", end="", flush=True)
+
+    def chunk(self, text):
+        with phase("render"):
+            print(text, end="", flush=True)
+
+    def reply_end(self):
+        print()
+
+    def error(self, error):
+        print(f"An error occurred: {str(error)}")
+        print("This could be due to provider issues, rate limiting, or missing API key.")
+        print("You can try again, switch providers, check your API key, or type 'menu' to return to the main menu.")
+
+# Event loop the conversation engine runs on
+loop = asyncio.new_event_loop()
+
+# Run a coroutine on the event loop; Ctrl+C cancels it instead of quitting
+def run(coro):
+    task = loop.create_task(coro)
+    try:
+        return loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except BaseException:
+            pass
+        print()
+    except asyncio.CancelledError:
+        pass
+    return None
 
-def start_conversation(provider_name, api_keys, custom_prompts):
-    provider = available_providers[provider_name]
+def start_conversation(engine, chat_name, provider_name):
+    session = engine.open_session(chat_name, provider_name)
+    turns = engine.store.info(chat_name)["turns"]
+    if turns:
+        print(f"\nResuming chat '{chat_name}' ({turns} turns, {len(session.history)} messages loaded).")
     print(f"\nConversing with {provider_name}...")
     print("Type 'menu' at any time to return to the main menu.")
-    history = []
+    output = ConsoleOutput()
 
     while True:
         user_input = input("You: ")
-        if user_input.lower() == 'exit':
+        signal = run(session.handle(user_input, output))
+        if signal == 'exit':
             return False  # Signal to end the chat
-        if user_input.lower() == 'menu':
+        if signal == 'menu':
             return 'menu'  # Signal to return to the main menu
-        if user_input.lower() == 'switch':
+        if signal == 'switch':
             return True  # Signal to switch provider
-        if user_input.lower() == 'info':
+        if signal == 'info':
             display_provider_info(provider_name)
-            continue
-        if user_input.lower().startswith('use prompt '):
-            prompt_name = user_input[11:].strip()
-            if prompt_name in custom_prompts:
-                user_input = custom_prompts[prompt_name]
-                print(f"Using custom prompt: {user_input}")
-            else:
-                print(f"Custom prompt '{prompt_name}' not found.")
-                continue
-
-        history.append({"role": "user", "content": user_input})
 
-        cached_response = get_cached_response(provider_name, user_input)
-        if cached_response:
-            print(f"{provider_name} (cached): {cached_response}")
-            history.append({"role": "assistant", "content": cached_response})
-            continue
-
-        try:
-            api_key = api_keys.get(provider_name)
-            response = g4f.ChatCompletion.create(
-                model=None,
-                provider=provider,
-                messages=history,
-                api_key=api_key
-            )
-            print(f"{provider_name}: {response}")
-            history.append({"role": "assistant", "content": response})
-            cache_response(provider_name, user_input, response)
-        except Exception as e:
-            print(f"An error occurred: {str(e)}")
-            print("This could be due to provider issues, rate limiting, or missing API key.")
-            print("You can try again, switch providers, check your API key, or type 'menu' to return to the main menu.")
-
-    return False  # Signal to not switch provider
-
-def manage_chats(api_keys, custom_prompts):
-    chats = {}
+# Print saved chats from the session index
+def list_chats(engine, title="Existing chats"):
+    chats = engine.store.list()
+    if not chats:
+        print("No existing chats.")
+        return False
+    print(f"\n{title}:")
+    for name, info in chats.items():
+        updated = datetime.fromtimestamp(info["updated"]).strftime("%Y-%m-%d %H:%M")
+        print(f"{name} (Provider: {info['provider']}, {info['turns']} turns, last used {updated})")
+    return True
+
+def manage_chats(engine):
     current_chat = None
 
     while True:
@@ -244,80 +245,89 @@ def manage_chats(api_keys, custom_prompts):
             provider_choice = get_provider_choice()
             if provider_choice:
                 chat_name = input("Enter a name for this chat: ")
-                chats[chat_name] = {"provider": provider_choice, "history": []}
+                if chat_name in engine.store:
+                    print(f"Chat '{chat_name}' already exists.")
+                    continue
+                engine.open_session(chat_name, provider_choice)
                 current_chat = chat_name
                 print(f"Created and switched to chat '{chat_name}' with provider {provider_choice}")
         elif choice == '2':
-            if chats:
-                print("\nExisting chats:")
-                for name in chats.keys():
-                    print(name)
+            if list_chats(engine):
                 chat_name = input("Enter the name of the chat to switch to: ")
-                if chat_name in chats:
+                if chat_name in engine.store:
                     current_chat = chat_name
                     print(f"Switched to chat '{chat_name}'")
                 else:
                     print("Chat not found.")
-            else:
-                print("No existing chats.")
         elif choice == '3':
-            if chats:
-                print("\nAll chats:")
-                for name, info in chats.items():
-                    print(f"{name} (Provider: {info['provider']})")
-            else:
-                print("No existing chats.")
+            list_chats(engine, "All chats")
         elif choice == '4':
-            if chats:
-                print("\nExisting chats:")
-                for name in chats.keys():
-                    print(name)
+            if list_chats(engine):
                 chat_name = input("Enter the name of the chat to delete: ")
-                if chat_name in chats:
-                    del chats[chat_name]
+                if chat_name in engine.store:
+                    run(engine.delete_session(chat_name))
                     if current_chat == chat_name:
                         current_chat = None
                     print(f"Deleted chat '{chat_name}'")
                 else:
                     print("Chat not found.")
-            else:
-                print("No existing chats.")
         elif choice == '5':
             return
 
         if current_chat:
             print(f"\nCurrent chat: {current_chat}")
-            chat_info = chats[current_chat]
-            result = start_conversation(chat_info["provider"], api_keys, custom_prompts)
+            result = start_conversation(engine, current_chat, engine.store.info(current_chat)["provider"])
             if result == 'menu':
                 continue  # Return to the chat management menu
             elif result:  # True means switch provider
                 display_providers()
                 new_provider = get_provider_choice()
                 if new_provider:
-                    chat_info["provider"] = new_provider
+                    engine.open_session(current_chat, new_provider)
                     print(f"Switched provider to {new_provider}")
 
 # Main function
 def main():
-    api_keys = load_api_keys()
-    custom_prompts = load_custom_prompts()
+    with capture("startup"):
+        api_keys = load_api_keys()
+        custom_prompts = load_custom_prompts()
+        store = SessionStore()
+        engine = ChatEngine(available_providers, api_keys, custom_prompts, store, open_search_index(store))
+
+    if sys.argv[1:2] == ['batch']:
+        from g4fbatch import batch_main
+        sys.exit(batch_main(sys.argv[2:], engine))
+    if sys.argv[1:2] == ['serve']:
+        from g4fserve import serve_main
+        sys.exit(serve_main(sys.argv[2:], engine))
+    if sys.argv[1:2] == ['--pipe']:
+        from g4fpipe import pipe_main
+        sys.exit(pipe_main(sys.argv[2:], engine))
+    if sys.argv[1:2] == ['workflow']:
+        from g4fworkflow import workflow_main
+        sys.exit(workflow_main(sys.argv[2:], engine))
+    if sys.argv[1:2] == ['warm']:
+        from g4fwarm import warm_main
+        sys.exit(warm_main(sys.argv[2:], engine))
 
     while True:
         print("\nMain Menu:")
         print("1. Manage chats")
         print("2. Manage API keys")
         print("3. Manage custom prompts")
-        print("4. Quit")
+        print("4. Probe providers")
+        print("5. Quit")
         choice = input("Enter your choice: ")
 
         if choice == '1':
-            manage_chats(api_keys, custom_prompts)
+            manage_chats(engine)
         elif choice == '2':
             manage_api_keys(api_keys)
         elif choice == '3':
             manage_custom_prompts(custom_prompts)
         elif choice == '4':
+            probe_providers(api_keys)
+        elif choice == '5':
             print("Goodbye!")
             sys.exit(0)
         else:
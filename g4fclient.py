@@ -0,0 +1,365 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from g4fhealth import get_breaker, get_scoreboard
+from g4fmetrics import get_metrics
+from g4fschedule import get_scheduler
+
+# Stream replies token by token from providers that support it
+STREAM_RESPONSES = True
+
+# End-of-stream marker passed through the chunk queue
+_DONE = object()
+
+# Run a blocking call on a daemon thread and await its result.  Unlike the
+# default executor, an abandoned call (timed out or cancelled) never holds up
+# asyncio.run() or interpreter exit.
+def run_blocking(fn):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(result, error):
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def work():
+        try:
+            result, error = fn(), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(settle, result, error)
+        except RuntimeError:
+            pass
+
+    threading.Thread(target=work, daemon=True).start()
+    return future
+
+# Whether a reply from this provider should be streamed
+def can_stream(provider, stream=None):
+    if stream is None:
+        stream = STREAM_RESPONSES
+    return bool(stream and getattr(provider, "supports_stream", False))
+
+# Ask a provider for a completion and return the full reply text.
+#
+# Providers with g4f's native async API (create_async_generator for streams,
+# create_async otherwise) are awaited directly, so cancelling the awaiting
+# task cancels the request itself.  Other providers are blocking and run on
+# a daemon thread; when streaming, each chunk is handed back to the event
+# loop as soon as the provider yields it, and cancelling tells the worker to
+# drop the stream at its next chunk.  Streamed chunks are passed to on_chunk
+# as they arrive; without streaming on_chunk gets the whole reply at once.
+# Every call first queues in the scheduler for the provider's rate limit and
+# is recorded in the process-wide metrics.
+async def create_completion(provider, messages, api_key=None, model=None, stream=None, on_chunk=None):
+    name = getattr(provider, "__name__", str(provider))
+    scheduler = get_scheduler()
+    waited = await scheduler.acquire(name)
+    try:
+        return await _measured_completion(name, provider, messages, api_key, model, stream, on_chunk, waited)
+    finally:
+        scheduler.release(name)
+
+async def _measured_completion(name, provider, messages, api_key, model, stream, on_chunk, waited):
+    streaming = can_stream(provider, stream)
+    start = time.perf_counter()
+    first_chunk = []
+    received = [0]
+
+    def relay(chunk):
+        if not first_chunk:
+            first_chunk.append(time.perf_counter() - start)
+        received[0] += len(chunk.encode("utf-8"))
+        if on_chunk:
+            on_chunk(chunk)
+
+    sent = len(json.dumps(messages).encode("utf-8"))
+    metrics = get_metrics()
+    metrics.wait(name, waited)
+    try:
+        response = await _create_completion(provider, messages, api_key, model, stream, relay)
+    except asyncio.CancelledError:
+        metrics.request(name, time.perf_counter() - start, request_bytes=sent, response_bytes=received[0], cancelled=True)
+        raise
+    except Exception as e:
+        metrics.request(name, time.perf_counter() - start, request_bytes=sent, response_bytes=received[0], error=e)
+        raise
+    metrics.request(name, time.perf_counter() - start, first_chunk[0] if streaming and first_chunk else None,
+                    sent, received[0])
+    return response
+
+async def _create_completion(provider, messages, api_key, model, stream, on_chunk):
+    # Providers defined outside g4f (local=True) implement the async API
+    # themselves and are called without importing g4f at all
+    local = getattr(provider, "local", False)
+    if local and not can_stream(provider, stream):
+        response = await provider.create_async(model, messages, api_key=api_key)
+        if on_chunk:
+            on_chunk(response)
+        return response
+    if local or (hasattr(provider, "create_async_generator") and can_stream(provider, stream)):
+        parts = []
+        async for chunk in provider.create_async_generator(model, messages, api_key=api_key):
+            if isinstance(chunk, str) and chunk:
+                parts.append(chunk)
+                if on_chunk:
+                    on_chunk(chunk)
+        return "".join(parts)
+
+    # Imported here so startup does not pay for loading every g4f provider
+    import g4f
+    loop = asyncio.get_running_loop()
+    if not can_stream(provider, stream):
+        if hasattr(provider, "create_async") and hasattr(g4f.ChatCompletion, "create_async"):
+            response = await g4f.ChatCompletion.create_async(
+                model=model,
+                messages=messages,
+                provider=provider,
+                api_key=api_key
+            )
+        else:
+            response = await run_blocking(lambda: g4f.ChatCompletion.create(
+                model=model,
+                provider=provider,
+                messages=messages,
+                api_key=api_key
+            ))
+        if on_chunk:
+            on_chunk(response)
+        return response
+
+    chunks = asyncio.Queue()
+    cancelled = threading.Event()
+
+    def send(item):
+        try:
+            loop.call_soon_threadsafe(chunks.put_nowait, item)
+        except RuntimeError:
+            # The loop has gone away; nobody is listening any more
+            cancelled.set()
+
+    def produce():
+        try:
+            for chunk in g4f.ChatCompletion.create(
+                model=model,
+                provider=provider,
+                messages=messages,
+                api_key=api_key,
+                stream=True
+            ):
+                if cancelled.is_set():
+                    break
+                if isinstance(chunk, str) and chunk:
+                    send(chunk)
+        except Exception as e:
+            send(e)
+        finally:
+            send(_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+    parts = []
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is _DONE:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            parts.append(chunk)
+            if on_chunk:
+                on_chunk(chunk)
+    finally:
+        cancelled.set()
+    return "".join(parts)
+
+# Number of providers sent the same request in race mode
+RACE_PROVIDERS = 3
+
+# Seconds to wait before hedging to a provider with no latency history
+HEDGE_DELAY = 8.0
+
+# How long to give a provider before hedging: its p95 time to first token
+# when streaming, otherwise its p95 latency
+def hedge_delay(name, stream):
+    stats = get_scoreboard().stats(name)
+    if stats:
+        delay = stats["ttft_p95"] if stream else stats["p95"]
+        if delay:
+            return delay
+    return HEDGE_DELAY
+
+# Send the same request to several providers and keep the first good reply.
+#
+# candidates is a list of (name, provider class, api key) in preference order.
+# Without hedging all of them start at once; with hedging the next one only
+# starts when the ones in flight have not answered within hedge_delay() or
+# have failed.  Candidates whose circuit breaker is open are skipped, the
+# chat's own provider included.  The first provider to produce output wins
+# (its first chunk when streaming), only its chunks reach on_chunk, and the
+# others are cancelled; on_winner is called with the winner's name before
+# its first chunk is passed on.  Returns (winner name, reply).
+async def race_completion(candidates, messages, model=None, stream=None, on_chunk=None, hedge=False, on_winner=None):
+    scoreboard = get_scoreboard()
+    tasks = {}
+    started = {}
+    first_chunk = {}
+    winner = None
+    errors = []
+    remaining = list(candidates)
+
+    def relay(name):
+        def handle(chunk):
+            nonlocal winner
+            first_chunk.setdefault(name, time.perf_counter() - started[name])
+            if winner is None:
+                winner = name
+                for task, other in tasks.items():
+                    if other != name:
+                        task.cancel()
+                if on_winner:
+                    on_winner(name)
+            if winner == name and on_chunk:
+                on_chunk(chunk)
+        return handle
+
+    # Start the next candidate whose circuit breaker lets a request through
+    def launch():
+        while remaining:
+            name, provider, api_key = remaining.pop(0)
+            if get_breaker(name).allow():
+                break
+        else:
+            return
+        started[name] = time.perf_counter()
+        task = asyncio.ensure_future(create_completion(
+            provider, messages, api_key=api_key, model=model, stream=stream, on_chunk=relay(name)
+        ))
+        tasks[task] = name
+
+    launch()
+    while not hedge and remaining:
+        launch()
+    try:
+        while tasks:
+            timeout = None
+            if hedge and remaining and winner is None:
+                now = time.perf_counter()
+                timeout = max(0, min(
+                    started[name] + hedge_delay(name, can_stream(candidates[0][1], stream)) - now
+                    for name in tasks.values()
+                ))
+            done, _ = await asyncio.wait(list(tasks), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch()
+                continue
+            for task in done:
+                name = tasks.pop(task)
+                if task.cancelled():
+                    get_breaker(name).release()
+                    continue
+                latency = time.perf_counter() - started[name]
+                error = task.exception()
+                scoreboard.record(name, error is None, latency, first_chunk.get(name), save=False)
+                if error is None:
+                    get_breaker(name).success()
+                else:
+                    get_breaker(name).failure()
+                if error is None and name == winner:
+                    return name, task.result()
+                if error is not None:
+                    if name == winner:
+                        # Part of this reply has already been shown
+                        raise error
+                    errors.append(error)
+                    if remaining and winner is None:
+                        launch()
+        raise errors[-1] if errors else RuntimeError("No provider answered" if started else "No provider is available right now")
+    finally:
+        for task, name in tasks.items():
+            task.cancel()
+            get_breaker(name).release()
+        scoreboard.save()
+
+# Candidates for a race or failover: the chat's provider first, then the best
+# ranked others whose circuit breakers are not open
+def race_candidates(registry, primary, api_keys, count=None):
+    count = RACE_PROVIDERS if count is None else count
+    others = [
+        name for name in get_scoreboard().rank(registry.keys())
+        if name != primary and get_breaker(name).available()
+    ]
+    names = [primary] + others[:max(0, count - 1)]
+    return [(name, registry[name], api_keys.get(name)) for name in names]
+
+# Automatic failover settings
+FAILOVER = True
+FAILOVER_PROVIDERS = 3
+RETRY_ATTEMPTS = 2
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 8.0
+
+# Exponential backoff with full jitter for the given retry (0 based)
+def backoff_delay(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+# Try candidates in order until one answers.
+#
+# Each provider gets RETRY_ATTEMPTS tries with jittered exponential backoff
+# in between, as long as its circuit breaker lets requests through; then the
+# next candidate is tried.  Once a reply has started streaming it is not
+# retried elsewhere, since part of it has already been shown.  on_winner is
+# called with the provider's name before its first chunk and on_event with
+# human readable retry/failover notices.  Returns (provider name, reply).
+async def failover_completion(candidates, messages, model=None, stream=None, on_chunk=None, on_winner=None, on_event=None):
+    scoreboard = get_scoreboard()
+    errors = []
+    for position, (name, provider, api_key) in enumerate(candidates):
+        breaker = get_breaker(name)
+        for attempt in range(RETRY_ATTEMPTS):
+            if not breaker.allow():
+                if on_event:
+                    on_event(f"{name} is unavailable (circuit open), skipping.")
+                break
+            start = time.perf_counter()
+            first_chunk = []
+
+            def relay(chunk, name=name, start=start, first_chunk=first_chunk):
+                if not first_chunk:
+                    first_chunk.append(time.perf_counter() - start)
+                    if on_winner:
+                        on_winner(name)
+                if on_chunk:
+                    on_chunk(chunk)
+
+            try:
+                response = await create_completion(
+                    provider, messages, api_key=api_key, model=model, stream=stream, on_chunk=relay
+                )
+            except Exception as e:
+                breaker.failure()
+                scoreboard.record(name, False, time.perf_counter() - start)
+                if first_chunk:
+                    raise
+                errors.append(e)
+                if attempt + 1 < RETRY_ATTEMPTS and breaker.available():
+                    delay = backoff_delay(attempt)
+                    if on_event:
+                        on_event(f"{name} failed ({e}), retrying in {delay:.1f}s...")
+                    await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled: neither a success nor a failure of the provider
+                breaker.release()
+                raise
+            breaker.success()
+            scoreboard.record(name, True, time.perf_counter() - start, first_chunk[0] if first_chunk else None)
+            return name, response
+        if on_event and position + 1 < len(candidates):
+            on_event(f"Failing over from {name} to {candidates[position + 1][0]}...")
+    raise errors[-1] if errors else RuntimeError("No provider is available right now")
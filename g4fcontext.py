@@ -0,0 +1,137 @@
+import json
+import math
+import os
+
+# File with per-provider context budgets in tokens, e.g. {"default": 3000, "Bing": 8000}
+CONTEXT_BUDGETS_FILE = "context_budgets.json"
+
+# Budget for providers without an entry
+DEFAULT_CONTEXT_BUDGET = 3000
+
+# Rough token estimate: characters per token plus a fixed cost per message
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD = 4
+
+# Longest rolling summary kept, in tokens
+SUMMARY_MAX_TOKENS = 400
+
+# Prompt used to fold evicted turns into the rolling summary
+SUMMARY_PROMPT = (
+    "Summarize the conversation below in a few sentences, keeping names, facts, "
+    "decisions and open questions. Reply with the summary only.\n\n{text}"
+)
+
+_budgets = None
+
+# Load per-provider budgets from file (once)
+def load_context_budgets():
+    global _budgets
+    if _budgets is None:
+        _budgets = {}
+        if os.path.exists(CONTEXT_BUDGETS_FILE):
+            with open(CONTEXT_BUDGETS_FILE, 'r') as f:
+                _budgets = json.load(f)
+    return _budgets
+
+# Token budget for a provider
+def context_budget(provider_name):
+    budgets = load_context_budgets()
+    return budgets.get(provider_name, budgets.get("default", DEFAULT_CONTEXT_BUDGET))
+
+# Estimated tokens for one message
+def estimate_tokens(message):
+    return MESSAGE_OVERHEAD + math.ceil(len(message.get("content") or "") / CHARS_PER_TOKEN)
+
+# A conversation history that knows what fits into a provider's budget.
+#
+# Token estimates are computed once per message as it is appended and the
+# running total is kept up to date, so choosing a payload only walks back over
+# the messages that end up being sent.  System messages and messages appended
+# with pinned=True (custom prompts) are always sent.  With the "summary"
+# strategy, turns that fall out of the window are folded into a rolling
+# summary which is sent in their place.
+class ContextWindow:
+    def __init__(self, messages=None, strategy="window"):
+        self.messages = []
+        self.tokens = []
+        self.pinned = set()
+        self.total_tokens = 0
+        self.strategy = strategy
+        self.summary = None
+        self.summary_tokens = 0
+        # Messages before this index are already part of the summary
+        self.summarized = 0
+        # Start of the window of the last payload
+        self.window_start = 0
+        for message in messages or []:
+            self.append(message)
+
+    def append(self, message, pinned=False):
+        if message.get("role") == "system":
+            pinned = True
+        if pinned:
+            self.pinned.add(len(self.messages))
+        self.messages.append(message)
+        self.tokens.append(estimate_tokens(message))
+        self.total_tokens += self.tokens[-1]
+
+    def pop(self):
+        self.pinned.discard(len(self.messages) - 1)
+        self.total_tokens -= self.tokens.pop()
+        return self.messages.pop()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    # Messages to send: pinned messages before the window, the summary of
+    # evicted turns, then the most recent messages that fit the budget.  The
+    # last message is always sent, even on its own it is over budget.
+    def payload(self, budget):
+        remaining = budget - (self.summary_tokens if self.strategy == "summary" else 0)
+        for index in self.pinned:
+            remaining -= self.tokens[index]
+        start = len(self.messages)
+        while start > 0:
+            cost = 0 if start - 1 in self.pinned else self.tokens[start - 1]
+            if start < len(self.messages) and cost > remaining:
+                break
+            remaining -= cost
+            start -= 1
+        self.window_start = start
+        pinned_before = [self.messages[i] for i in sorted(self.pinned) if i < start]
+        summary = []
+        if self.strategy == "summary" and self.summary and start > 0:
+            summary = [{"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"}]
+        return pinned_before + summary + self.messages[start:]
+
+    # Estimated tokens of a payload
+    def payload_tokens(self, payload):
+        return sum(estimate_tokens(message) for message in payload)
+
+    # Text of turns that left the window and are not summarized yet
+    def evicted_text(self):
+        if self.strategy != "summary" or self.window_start <= self.summarized:
+            return None
+        lines = [
+            f"{self.messages[i]['role']}: {self.messages[i]['content']}"
+            for i in range(self.summarized, self.window_start) if i not in self.pinned
+        ]
+        return "\n".join(lines) if lines else None
+
+    # Fold evicted turns into the summary; summarize is an async function
+    # taking a prompt and returning the summary text
+    async def update_summary(self, summarize):
+        text = self.evicted_text()
+        if not text:
+            return
+        upto = self.window_start
+        if self.summary:
+            text = f"Earlier summary: {self.summary}\n\n{text}"
+        summary = await summarize(SUMMARY_PROMPT.format(text=text))
+        # Keep the payload bounded even if the provider rambles
+        self.summary = summary[:SUMMARY_MAX_TOKENS * CHARS_PER_TOKEN]
+        self.summary_tokens = estimate_tokens({"content": self.summary})
+        self.summarized = upto
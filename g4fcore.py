@@ -0,0 +1,538 @@
+import asyncio
+import threading
+import g4fcache
+import g4fclient
+from g4fcache import cache_key, cache_response, get_cached_response
+from g4fclient import failover_completion, race_candidates, race_completion
+from g4fmetrics import get_metrics
+from g4fprofile import capture, phase
+from g4fschedule import BACKGROUND, get_scheduler, request_priority, wait_notice
+from g4fcontext import CHARS_PER_TOKEN, ContextWindow, context_budget, estimate_tokens
+from g4fsearch import format_results, turn_text
+from g4fwarm import record_hit
+from g4fworkflow import Workflow, fill, is_workflow, parse_prompt_command, run_workflow
+
+# Where a turn's output goes.  Frontends override the parts they display.
+class TurnOutput:
+    # The user's message, about to be sent
+    def user(self, text):
+        pass
+
+    # A complete line: notices, retry and failover messages
+    def line(self, text):
+        pass
+
+    # A reply begins; label names the provider, e.g. "Bing (cached)"
+    def reply_start(self, label):
+        pass
+
+    # Part of the reply (all of it when not streaming)
+    def chunk(self, text):
+        pass
+
+    # The reply begun by reply_start is over, complete or not
+    def reply_end(self):
+        pass
+
+    # The turn failed
+    def error(self, error):
+        pass
+
+    # handle() returned one of SIGNALS for a message posted to a chat worker
+    def signal(self, signal):
+        pass
+
+# Signals handle() passes back for the frontend to act on
+SIGNALS = ('exit', 'menu', 'switch', 'info')
+
+# One conversation: its provider, history and per-chat settings
+class ChatSession:
+    def __init__(self, engine, name, provider_name):
+        self.engine = engine
+        self.name = name
+        self.provider_name = provider_name
+        self.history = ContextWindow()
+        self.summary_task = None
+        self.near_duplicate = g4fcache.NEAR_DUPLICATE_LOOKUP
+        self.stream = g4fclient.STREAM_RESPONSES
+        self.race_mode = None
+        self.failover = g4fclient.FAILOVER
+        self.task = None
+        # One turn at a time; later messages wait their turn
+        self.lock = asyncio.Lock()
+        # Messages posted to this chat's worker, and the worker itself
+        self.inbox = None
+        self.worker = None
+
+    # Handle a line typed by the user: a chat command or a message to send.
+    # Returns one of SIGNALS when the frontend has to act, otherwise None.
+    async def handle(self, user_input, output):
+        command = user_input.lower()
+        if command in SIGNALS:
+            return command
+        if command in ('fuzzy on', 'fuzzy off'):
+            self.near_duplicate = command == 'fuzzy on'
+            output.line(f"Near-duplicate cache lookup {'enabled' if self.near_duplicate else 'disabled'}.")
+            return None
+        if command in ('stream on', 'stream off'):
+            self.stream = command == 'stream on'
+            output.line(f"Streaming {'enabled' if self.stream else 'disabled'}.")
+            return None
+        if command in ('race on', 'race hedge', 'race off'):
+            self.race_mode = {'race on': 'race', 'race hedge': 'hedge'}.get(command)
+            output.line(f"Race mode {self.race_mode or 'disabled'}.")
+            return None
+        if command in ('failover on', 'failover off'):
+            self.failover = command == 'failover on'
+            output.line(f"Automatic failover {'enabled' if self.failover else 'disabled'}.")
+            return None
+        if command in ('summary on', 'summary off'):
+            self.history.strategy = 'summary' if command == 'summary on' else 'window'
+            output.line(f"Summarizing old turns {'enabled' if command == 'summary on' else 'disabled'}.")
+            return None
+        if command == 'context':
+            budget = context_budget(self.provider_name)
+            sent = self.history.payload_tokens(self.history.payload(budget))
+            output.line(f"Context: {len(self.history)} messages, ~{self.history.total_tokens} tokens; "
+                        f"sending ~{sent} of a {budget} token budget ({self.history.strategy}).")
+            return None
+        if command == 'stats':
+            lines = get_metrics().describe() + get_scheduler().describe()
+            if self.engine.warmer:
+                lines += self.engine.warmer.describe()
+            for line in lines:
+                output.line(line)
+            get_metrics().export()
+            return None
+        if command.startswith('search '):
+            for line in self.engine.search_lines(user_input[7:]):
+                output.line(line)
+            return None
+        pinned = False
+        if command.startswith('use prompt '):
+            try:
+                prompt_name, variables = parse_prompt_command(user_input[11:], self.engine.custom_prompts)
+            except (OSError, ValueError) as e:
+                output.line(str(e))
+                return None
+            if prompt_name not in self.engine.custom_prompts:
+                output.line(f"Custom prompt '{prompt_name}' not found.")
+                return None
+            prompt = self.engine.custom_prompts[prompt_name]
+            if is_workflow(prompt):
+                await self.run_workflow(prompt_name, prompt, variables, output)
+                return None
+            user_input = fill(prompt, variables)
+            output.line(f"Using custom prompt: {user_input}")
+            pinned = True
+        await self.send(user_input, output, pinned)
+        return None
+
+    # Send a message and add the exchange to the history.  Only what fits the
+    # provider's context budget is sent; pinned messages always are.
+    async def send(self, user_input, output, pinned=False):
+        async with self.lock:
+            with capture("turn"):
+                self.task = asyncio.current_task()
+                output.user(user_input)
+                message = {"role": "user", "content": user_input}
+                self.history.append(message, pinned)
+                try:
+                    winner, response, cached = await self.engine.complete(
+                        self.provider_name,
+                        self.history.payload(context_budget(self.provider_name)),
+                        output,
+                        near_duplicate=self.near_duplicate,
+                        stream=self.stream,
+                        race_mode=self.race_mode,
+                        failover=g4fclient.FAILOVER_PROVIDERS if self.failover else 1,
+                        index=False
+                    )
+                except asyncio.CancelledError:
+                    self.history.pop()
+                    output.line("Cancelled.")
+                    raise
+                except Exception as e:
+                    self.history.pop()
+                    output.error(e)
+                    return None
+                finally:
+                    self.task = None
+                self._finish_turn(message, response, pinned)
+                return response
+
+    # Run a workflow custom prompt.  Steps are reported as they finish; the
+    # output step's resolved prompt and answer become a pinned turn of the
+    # chat, like a plain custom prompt's.
+    async def run_workflow(self, name, spec, variables, output):
+        async with self.lock:
+            self.task = asyncio.current_task()
+            try:
+                workflow = Workflow(name, spec)
+                workflow.bind(variables)
+                output.line(f"Running workflow '{name}': {len(workflow.steps)} steps.")
+
+                def on_step(step, provider, cached):
+                    output.line(f"Step '{step}' ({provider}): {'cached' if cached else 'done'}")
+
+                results = await run_workflow(self.engine, workflow, variables, self.provider_name,
+                                             g4fclient.FAILOVER_PROVIDERS if self.failover else 1, on_step)
+            except asyncio.CancelledError:
+                output.line("Cancelled.")
+                raise
+            except ValueError as e:
+                output.line(str(e))
+                return None
+            except Exception as e:
+                output.error(e)
+                return None
+            finally:
+                self.task = None
+            result = results[workflow.output]
+            ran = sum(not step["cached"] for step in results.values())
+            output.line(f"Workflow '{name}': {ran} steps ran, {len(results) - ran} from the cache.")
+            message = {"role": "user", "content": result["prompt"]}
+            output.user(result["prompt"])
+            output.reply_start(f"{result['provider']} (cached)" if result["cached"] else result["provider"])
+            output.chunk(result["response"])
+            output.reply_end()
+            self.history.append(message, True)
+            self._finish_turn(message, result["response"], True)
+            return result["response"]
+
+    # Add the reply to a message already in the history, then journal and
+    # index the turn and fold evicted turns into the summary
+    def _finish_turn(self, message, response, pinned):
+        reply = {"role": "assistant", "content": response}
+        self.history.append(reply)
+        if self.engine.store and self.name in self.engine.store:
+            self.engine.store.append_turn(self.name, message, reply, pinned)
+        if self.engine.search is not None:
+            self.engine.search.add("chat", self.name, turn_text(message, reply))
+        if self.history.evicted_text() and not (self.summary_task and not self.summary_task.done()):
+            self.summary_task = asyncio.ensure_future(self.update_summary())
+
+    # Fold evicted turns into the rolling summary and journal the result
+    async def update_summary(self):
+        request_priority.set(BACKGROUND)
+        summary = self.history.summary
+        await self.history.update_summary(self.summarize)
+        if self.engine.store and self.history.summary != summary and self.name in self.engine.store:
+            self.engine.store.append_summary(self.name, self.history.summary)
+
+    # Rebuild the history from the chat's journal: pinned messages, the
+    # rolling summary and as much of the tail as the context budget can use
+    def resume(self, store):
+        # Read twice the budget's worth of characters to allow for UTF-8 and record overhead
+        max_bytes = 2 * CHARS_PER_TOKEN * context_budget(self.provider_name)
+        pinned, summary, tail = store.load(self.name, max_bytes)
+        for record in pinned:
+            self.history.append({"role": record["role"], "content": record["content"]}, True)
+        if summary:
+            self.history.strategy = 'summary'
+            self.history.summary = summary
+            self.history.summary_tokens = estimate_tokens({"content": summary})
+            self.history.summarized = len(pinned)
+        for _, record in tail:
+            self.history.append({"role": record["role"], "content": record["content"]}, record.get("pinned", False))
+
+    # Summarize text with the chat's provider, for the rolling context summary
+    async def summarize(self, prompt):
+        _, summary, _ = await self.engine.complete(
+            self.provider_name,
+            [{"role": "user", "content": prompt}],
+            stream=False,
+            failover=g4fclient.FAILOVER_PROVIDERS if self.failover else 1,
+            index=False
+        )
+        return summary
+
+    # Cancel the turn in flight, if any.  Must be called on the engine's loop.
+    def cancel(self):
+        if self.task:
+            self.task.cancel()
+
+    # Queue a message for this chat's worker, starting it on first use.
+    # Must be called on the engine's loop.
+    def post(self, user_input, output):
+        if self.worker is None:
+            self.inbox = asyncio.Queue()
+            self.worker = asyncio.ensure_future(self._work())
+        self.inbox.put_nowait((user_input, output))
+
+    # Handle posted messages in order until close() is called
+    async def _work(self):
+        inbox = self.inbox
+        while True:
+            item = await inbox.get()
+            if item is None:
+                return
+            user_input, output = item
+            try:
+                signal = await self.handle(user_input, output)
+            except asyncio.CancelledError:
+                # Only the turn was cancelled; keep serving the chat
+                if inbox is not self.inbox:
+                    raise
+                if hasattr(asyncio.current_task(), "uncancel"):
+                    asyncio.current_task().uncancel()
+                continue
+            if signal:
+                output.signal(signal)
+
+    # Stop the worker after the turn in flight is cancelled; queued messages are dropped
+    async def close(self):
+        if self.worker is None:
+            return
+        worker, self.worker = self.worker, None
+        inbox, self.inbox = self.inbox, None
+        while not inbox.empty():
+            inbox.get_nowait()
+        inbox.put_nowait(None)
+        self.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+
+# One upstream request that identical concurrent requests wait on.
+#
+# The first request for a cache key leads: its output is teed so every
+# follower sees the reply stream in as well, and followers that join late get
+# the chunks so far replayed first.  Only the leader talks to the provider and
+# writes the cache.  If the leader is cancelled, the followers start over and
+# one of them leads.
+class Flight:
+    def __init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+        self.label = None
+        self.chunks = []
+        self.followers = []
+
+    # The leader's output, copying the reply to the followers
+    def tee(self, output):
+        flight = self
+
+        class FlightOutput(TurnOutput):
+            def line(self, text):
+                output.line(text)
+
+            def reply_start(self, label):
+                flight.label = label
+                output.reply_start(label)
+                for follower in flight.followers:
+                    follower.reply_start(flight.shared_label())
+
+            def chunk(self, text):
+                flight.chunks.append(text)
+                output.chunk(text)
+                for follower in flight.followers:
+                    follower.chunk(text)
+
+            def reply_end(self):
+                output.reply_end()
+
+        return FlightOutput()
+
+    def shared_label(self):
+        return f"{self.label} (shared)"
+
+    # Wait for the leader's result.  Returns None if the leader gave up.
+    async def join(self, output):
+        if self.label is not None:
+            output.reply_start(self.shared_label())
+            for chunk in self.chunks:
+                output.chunk(chunk)
+        self.followers.append(output)
+        try:
+            result = await asyncio.shield(self.future)
+        finally:
+            self.followers.remove(output)
+            if self.label is not None:
+                output.reply_end()
+        if result is None:
+            return None
+        winner, response, _ = result
+        return winner, response, True
+
+    def finish(self, result):
+        self.future.set_result(result)
+
+    def fail(self, error):
+        if isinstance(error, asyncio.CancelledError) or not self.followers:
+            self.future.set_result(None)
+        else:
+            self.future.set_exception(error)
+
+# Sessions, provider calls and caching shared by every frontend.
+#
+# All methods run on a single event loop: the CLI drives one directly and
+# g4ftink talks to one through an EngineThread.  api_keys and custom_prompts
+# are the frontend's dicts, so edits made through the menus apply at once.
+# With a SessionStore every finished turn is journaled and chats opened by
+# name resume where they left off; with a SearchIndex turns and fresh
+# replies are indexed for 'search'.
+class ChatEngine:
+    def __init__(self, registry, api_keys=None, custom_prompts=None, store=None, search=None):
+        self.registry = registry
+        self.api_keys = api_keys if api_keys is not None else {}
+        self.custom_prompts = custom_prompts if custom_prompts is not None else {}
+        self.store = store
+        self.search = search
+        self.sessions = {}
+        # Requests in flight by (cache key, race mode)
+        self.flights = {}
+        # CacheWarmer told about cache hits, if the frontend runs one;
+        # without one hits are still counted in WARM_FILE
+        self.warmer = None
+
+    # Get the named session, creating, resuming or switching its provider
+    def open_session(self, name, provider_name):
+        session = self.sessions.get(name)
+        if session is None:
+            session = self.sessions[name] = ChatSession(self, name, provider_name)
+            if self.store and name in self.store:
+                session.resume(self.store)
+            elif self.store:
+                self.store.create(name, provider_name)
+        session.provider_name = provider_name
+        if self.store:
+            self.store.set_provider(name, provider_name)
+        return session
+
+    async def close_session(self, name):
+        session = self.sessions.pop(name, None)
+        if session:
+            session.cancel()
+            await session.close()
+
+    # Close a chat and remove its journal
+    async def delete_session(self, name):
+        await self.close_session(name)
+        if self.store:
+            self.store.delete(name)
+
+    # Post a message to the named chat's worker.  Must be called on the engine's loop.
+    def post(self, name, user_input, output):
+        self.sessions[name].post(user_input, output)
+
+    # Ranked past turns and cached replies matching a query, as display lines
+    def search_lines(self, query):
+        if self.search is None:
+            return ["Search is not available."]
+        return format_results(self.search.search(query))
+
+    # Stop every chat worker
+    async def shutdown(self):
+        if self.warmer:
+            self.warmer.stop()
+        await asyncio.gather(*(self.close_session(name) for name in list(self.sessions)))
+
+    # Answer the last message of `messages`, from the cache when possible,
+    # otherwise by racing providers or failing over across `failover` of them.
+    # Identical requests already in flight are joined instead of repeated.
+    # Fresh replies are added to the search index unless index is False.
+    # Returns (provider name, reply, whether it came from the cache or
+    # another request).
+    async def complete(self, provider_name, messages, output=None, near_duplicate=None, stream=None,
+                       race_mode=None, failover=1, index=True, model=None):
+        output = output or TurnOutput()
+        key = (cache_key(provider_name, model, messages), race_mode)
+        while key in self.flights:
+            result = await self.flights[key].join(output)
+            if result is not None:
+                return result
+        flight = self.flights[key] = Flight()
+        # Rate limit waits are reported where the reply goes
+        notice = wait_notice.set(output.line)
+        try:
+            result = await self._complete(provider_name, messages, flight.tee(output), near_duplicate, stream,
+                                          race_mode, failover, index, model)
+        except BaseException as e:
+            flight.fail(e)
+            raise
+        finally:
+            wait_notice.reset(notice)
+            del self.flights[key]
+        flight.finish(result)
+        return result
+
+    async def _complete(self, provider_name, messages, output, near_duplicate, stream, race_mode, failover,
+                        index, model):
+        # In race mode any of the racing providers may already have the answer
+        candidates = race_candidates(self.registry, provider_name, self.api_keys) if race_mode else None
+        for cache_provider in [c[0] for c in candidates] if candidates else [provider_name]:
+            with phase("cache lookup"):
+                cached_response = get_cached_response(cache_provider, messages, model, near_duplicate)
+            get_metrics().cache_lookup(cache_provider, bool(cached_response))
+            if cached_response:
+                if self.warmer:
+                    self.warmer.hit(cache_provider, messages, model)
+                else:
+                    record_hit(cache_provider, messages, model)
+                output.reply_start(f"{cache_provider} (cached)")
+                output.chunk(cached_response)
+                output.reply_end()
+                return cache_provider, cached_response, True
+
+        started = []
+
+        def start(label):
+            started.append(label)
+            output.reply_start(label)
+
+        try:
+            with phase("provider call"):
+                if candidates:
+                    winner, response = await race_completion(
+                        candidates,
+                        messages,
+                        model=model,
+                        stream=stream,
+                        on_chunk=output.chunk,
+                        hedge=race_mode == 'hedge',
+                        on_winner=lambda name: start(f"{name} (won race)")
+                    )
+                else:
+                    winner, response = await failover_completion(
+                        race_candidates(self.registry, provider_name, self.api_keys, failover),
+                        messages,
+                        model=model,
+                        stream=stream,
+                        on_chunk=output.chunk,
+                        on_winner=start,
+                        on_event=output.line
+                    )
+        finally:
+            if started:
+                output.reply_end()
+        with phase("cache write"):
+            cache_response(winner, messages, response, model)
+        if index and self.search is not None:
+            self.search.add("cache", winner, turn_text(messages[-1], {"content": response}))
+        return winner, response, False
+
+# Runs an event loop on a background thread so a GUI can drive the engine.
+#
+# submit() schedules a coroutine from any thread and returns a
+# concurrent.futures.Future; call() runs a plain function on the loop and
+# run() does the same but waits for its result.
+class EngineThread:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="g4f-engine", daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, fn, *args):
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    # Run a plain function on the loop and wait for its result
+    def run(self, fn, *args):
+        async def call():
+            return fn(*args)
+
+        return self.submit(call()).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=1)
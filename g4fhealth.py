@@ -0,0 +1,235 @@
+import asyncio
+import os
+import threading
+import time
+from g4fcache import CACHE_DIR
+from g4fschedule import BACKGROUND, request_priority
+from g4fstate import JsonFile
+
+# File storing provider health samples
+SCOREBOARD_FILE = os.path.join(CACHE_DIR, "scoreboard.json")
+
+# Recent samples kept per provider
+SCOREBOARD_WINDOW = 50
+
+# Probe settings
+PROBE_PROMPT = "Reply with the single word: ok"
+PROBE_TIMEOUT = 20
+PROBE_CONCURRENCY = 8
+
+# Percentile of a list of numbers (nearest rank)
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# Success rate and latency statistics per provider, persisted across runs.
+#
+# Every probe or chat call adds a sample; only the last SCOREBOARD_WINDOW
+# samples are kept so the ranking follows how providers behave now.  Saving
+# merges with the samples other processes saved, so instances sharing the
+# file all contribute to it.
+class Scoreboard:
+    def __init__(self, path=SCOREBOARD_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = JsonFile(path)
+        self.samples = {provider: list(samples) for provider, samples in self.file.load().items()}
+
+    def record(self, provider, ok, latency, ttft=None, save=True):
+        with self.lock:
+            samples = self.samples.setdefault(provider, [])
+            samples.append({"ok": ok, "latency": latency, "ttft": ttft, "at": time.time()})
+            del samples[:-SCOREBOARD_WINDOW]
+        if save:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            samples = {provider: list(provider_samples) for provider, provider_samples in self.samples.items()}
+
+        def merge(saved):
+            for provider, mine in samples.items():
+                # A sample is identified by when it was taken
+                merged = {sample["at"]: sample for sample in saved.get(provider, []) + mine}
+                saved[provider] = sorted(merged.values(), key=lambda sample: sample["at"])[-SCOREBOARD_WINDOW:]
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.file.update(merge)
+        with self.lock:
+            for provider, saved in self.file.data.items():
+                # Keep samples recorded while saving
+                recent = [s for s in self.samples.get(provider, []) if s["at"] > saved[-1]["at"]] if saved else []
+                self.samples[provider] = list(saved) + recent
+
+    def stats(self, provider):
+        with self.lock:
+            samples = list(self.samples.get(provider, []))
+        if not samples:
+            return None
+        latencies = [s["latency"] for s in samples if s["ok"]]
+        ttfts = [s["ttft"] for s in samples if s["ok"] and s["ttft"] is not None]
+        return {
+            "samples": len(samples),
+            "success_rate": len(latencies) / len(samples),
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "ttft_p50": percentile(ttfts, 0.5),
+            "ttft_p95": percentile(ttfts, 0.95),
+        }
+
+    # Expected seconds per successful reply; lower is better
+    def score(self, provider):
+        stats = self.stats(provider)
+        if stats is None:
+            # Unprobed providers rank like one that answers at the timeout
+            return PROBE_TIMEOUT
+        if not stats["success_rate"]:
+            return PROBE_TIMEOUT * 10
+        return (stats["ttft_p50"] or stats["p50"]) / stats["success_rate"]
+
+    # Provider names, best score first
+    def rank(self, names):
+        return sorted(names, key=self.score)
+
+    # Short human readable summary for menus
+    def describe(self, provider):
+        stats = self.stats(provider)
+        if stats is None:
+            return "not probed"
+        text = f"ok {stats['success_rate']:.0%}"
+        if stats["p50"] is not None:
+            text += f", p50 {stats['p50']:.1f}s, p95 {stats['p95']:.1f}s"
+        if stats["ttft_p50"] is not None:
+            text += f", ttft {stats['ttft_p50']:.1f}s"
+        return text
+
+_scoreboard = None
+_scoreboard_lock = threading.Lock()
+
+# Get the process-wide scoreboard
+def get_scoreboard():
+    global _scoreboard
+    with _scoreboard_lock:
+        if _scoreboard is None:
+            _scoreboard = Scoreboard()
+        return _scoreboard
+
+# Send a tiny completion to one provider and record the outcome
+async def probe_provider(registry, name, api_keys=None, timeout=PROBE_TIMEOUT):
+    # g4fclient imports this module, so it is imported here
+    import g4fclient
+    first_chunk = []
+    start = time.perf_counter()
+
+    def on_chunk(chunk):
+        if not first_chunk:
+            first_chunk.append(time.perf_counter() - start)
+
+    try:
+        await asyncio.wait_for(g4fclient.create_completion(
+            registry[name],
+            [{"role": "user", "content": PROBE_PROMPT}],
+            api_key=(api_keys or {}).get(name),
+            on_chunk=on_chunk
+        ), timeout)
+        ok, error = True, None
+    except Exception as e:
+        ok, error = False, e if not isinstance(e, asyncio.TimeoutError) else "timeout"
+    latency = time.perf_counter() - start
+    get_scoreboard().record(name, ok, latency, first_chunk[0] if ok and first_chunk else None, save=False)
+    return {"provider": name, "ok": ok, "latency": latency, "error": str(error) if error else None}
+
+# Probe providers concurrently, at most `concurrency` at a time
+async def probe_providers(registry, names=None, api_keys=None, timeout=PROBE_TIMEOUT, concurrency=PROBE_CONCURRENCY, on_result=None):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(name):
+        # Probes queue behind chats for the providers' rate limits
+        request_priority.set(BACKGROUND)
+        async with semaphore:
+            result = await probe_provider(registry, name, api_keys, timeout)
+        if on_result:
+            on_result(result)
+        return result
+
+    names = list(registry.keys()) if names is None else names
+    try:
+        return await asyncio.gather(*(run(name) for name in names))
+    finally:
+        get_scoreboard().save()
+
+# Provider names ranked by score
+def rank_providers(names):
+    return get_scoreboard().rank(names)
+
+# Circuit breaker settings: consecutive failures that open a breaker, and
+# seconds an open breaker waits before letting a single trial request through
+BREAKER_FAILURES = 3
+BREAKER_COOLDOWN = 60
+
+# Per-provider circuit breaker shared by every chat in the process.
+#
+# closed:    requests flow; consecutive failures are counted
+# open:      requests are refused until the cooldown has passed
+# half-open: one trial request is let through; success closes the breaker,
+#            failure opens it again for another cooldown
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    # Whether a request would currently be let through, without claiming it
+    def available(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            return self.state == self.OPEN and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN
+
+    # Claim permission to send a request
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= BREAKER_FAILURES:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    # Give back a trial claimed by allow() that ended without an outcome,
+    # e.g. cancelled; the cooldown is over, so the next request is the trial
+    def release(self):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+# Get the process-wide breaker for a provider
+def get_breaker(name):
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
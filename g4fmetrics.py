@@ -0,0 +1,275 @@
+import asyncio
+import atexit
+import json
+import os
+import threading
+import time
+from g4fcache import CACHE_DIR
+from g4fstate import write_atomic
+
+# Files the metrics are exported to for a local scraper
+METRICS_PROM_FILE = os.path.join(CACHE_DIR, "metrics.prom")
+METRICS_JSON_FILE = os.path.join(CACHE_DIR, "metrics.json")
+
+# Least seconds between two automatic exports
+METRICS_EXPORT_INTERVAL = 15
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+# Counts of observations per bucket, plus their sum, Prometheus style
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last slot counts observations above every bound (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    # Estimated quantile, interpolated within its bucket
+    def quantile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else lower * 2
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def snapshot(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+# Counters and latency histograms for one provider
+class ProviderMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.cancelled = 0
+        self.errors = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency = Histogram()
+        self.ttft = Histogram()
+        self.queue_wait = Histogram()
+
+    def snapshot(self):
+        return {
+            "requests": self.requests,
+            "cancelled": self.cancelled,
+            "errors": dict(self.errors),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+            "latency": self.latency.snapshot(),
+            "ttft": self.ttft.snapshot(),
+            "queue_wait": self.queue_wait.snapshot(),
+        }
+
+# Process-wide request metrics.
+#
+# Every provider call records its outcome, latency, time to first chunk,
+# rate limit wait and bytes in each direction; every cache lookup records a
+# hit or miss.  The
+# numbers are kept in memory and exported to METRICS_PROM_FILE (Prometheus
+# text format) and METRICS_JSON_FILE at most every METRICS_EXPORT_INTERVAL
+# seconds and at exit.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.providers = {}
+        self.started = time.time()
+        self.exported = 0.0
+        self.dirty = False
+        self.exporting = False
+
+    def _provider(self, provider):
+        metrics = self.providers.get(provider)
+        if metrics is None:
+            metrics = self.providers[provider] = ProviderMetrics()
+        return metrics
+
+    def cache_lookup(self, provider, hit):
+        with self.lock:
+            metrics = self._provider(provider)
+            if hit:
+                metrics.cache_hits += 1
+            else:
+                metrics.cache_misses += 1
+            self.dirty = True
+        self._maybe_export()
+
+    # Seconds a provider call waited for its rate limit
+    def wait(self, provider, seconds):
+        with self.lock:
+            self._provider(provider).queue_wait.observe(seconds)
+            self.dirty = True
+
+    # One provider call; error is the exception it raised, if any
+    def request(self, provider, latency, ttft=None, request_bytes=0, response_bytes=0, error=None, cancelled=False):
+        with self.lock:
+            metrics = self._provider(provider)
+            metrics.requests += 1
+            metrics.request_bytes += request_bytes
+            metrics.response_bytes += response_bytes
+            if cancelled:
+                metrics.cancelled += 1
+            elif error is not None:
+                name = type(error).__name__
+                metrics.errors[name] = metrics.errors.get(name, 0) + 1
+            else:
+                metrics.latency.observe(latency)
+                if ttft is not None:
+                    metrics.ttft.observe(ttft)
+            self.dirty = True
+        self._maybe_export()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "at": time.time(),
+                "providers": {name: metrics.snapshot() for name, metrics in self.providers.items()},
+            }
+
+    # Metrics in the Prometheus text exposition format
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP g4f_{name} {help_text}")
+            lines.append(f"# TYPE g4f_{name} {kind}")
+
+        def label(provider, **extra):
+            pairs = [("provider", provider)] + sorted(extra.items())
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+        providers = sorted(snapshot["providers"].items())
+        for name, key, help_text in (
+            ("requests_total", "requests", "Provider calls made."),
+            ("cancelled_total", "cancelled", "Provider calls cancelled, e.g. race losers."),
+            ("cache_hits_total", "cache_hits", "Response cache hits."),
+            ("cache_misses_total", "cache_misses", "Response cache misses."),
+            ("request_bytes_total", "request_bytes", "Bytes of messages sent to providers."),
+            ("response_bytes_total", "response_bytes", "Bytes of replies received from providers."),
+        ):
+            family(name, "counter", help_text)
+            for provider, metrics in providers:
+                lines.append(f"g4f_{name}{label(provider)} {metrics[key]}")
+        family("errors_total", "counter", "Failed provider calls by exception type.")
+        for provider, metrics in providers:
+            for error, count in sorted(metrics["errors"].items()):
+                lines.append(f"g4f_errors_total{label(provider, type=error)} {count}")
+        for name, key, help_text in (
+            ("latency_seconds", "latency", "Seconds per successful provider call."),
+            ("ttft_seconds", "ttft", "Seconds to the first chunk of a reply."),
+            ("queue_wait_seconds", "queue_wait", "Seconds provider calls waited for their rate limit."),
+        ):
+            family(name, "histogram", help_text)
+            for provider, metrics in providers:
+                histogram = metrics[key]
+                total = 0
+                for bound, count in zip(list(histogram["buckets"]) + ["+Inf"], histogram["counts"]):
+                    total += count
+                    lines.append(f"g4f_{name}_bucket{label(provider, le=bound)} {total}")
+                lines.append(f"g4f_{name}_sum{label(provider)} {histogram['sum']}")
+                lines.append(f"g4f_{name}_count{label(provider)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    # Write both export files, each replaced atomically
+    def export(self, prom_path=None, json_path=None):
+        with self.lock:
+            self.exported = time.time()
+            self.dirty = False
+        for path, text in (
+            (prom_path or METRICS_PROM_FILE, self.prometheus()),
+            (json_path or METRICS_JSON_FILE, json.dumps(self.snapshot(), indent=2)),
+        ):
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            write_atomic(path, text)
+
+    # Export when the interval is up.  Writing and syncing the files is left
+    # to a worker thread when called on an event loop, so the request that
+    # happens to be due does not wait for the disk.
+    def _maybe_export(self):
+        with self.lock:
+            if self.exporting or time.time() - self.exported < METRICS_EXPORT_INTERVAL:
+                return
+            self.exporting = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._export_due()
+        else:
+            loop.run_in_executor(None, self._export_due)
+
+    def _export_due(self):
+        try:
+            self.export()
+        except OSError:
+            # Tried again at the next interval or at exit
+            with self.lock:
+                self.dirty = True
+        finally:
+            with self.lock:
+                self.exporting = False
+
+    def _export_at_exit(self):
+        if self.dirty:
+            self.export()
+
+    # Human readable summary, one line per provider
+    def describe(self):
+        with self.lock:
+            providers = sorted(self.providers.items())
+            if not providers:
+                return ["No requests yet."]
+            lines = []
+            for provider, metrics in providers:
+                lookups = metrics.cache_hits + metrics.cache_misses
+                errors = sum(metrics.errors.values())
+                parts = [f"{metrics.requests} requests"]
+                if errors:
+                    kinds = ", ".join(f"{name} {count}" for name, count in sorted(metrics.errors.items()))
+                    parts.append(f"{errors} errors ({kinds})")
+                if metrics.cancelled:
+                    parts.append(f"{metrics.cancelled} cancelled")
+                if lookups:
+                    parts.append(f"cache {metrics.cache_hits}/{lookups} hits ({metrics.cache_hits / lookups:.0%})")
+                if metrics.latency.count:
+                    parts.append(f"latency p50 {metrics.latency.quantile(0.5):.1f}s p95 {metrics.latency.quantile(0.95):.1f}s")
+                if metrics.ttft.count:
+                    parts.append(f"TTFT p50 {metrics.ttft.quantile(0.5):.1f}s")
+                if metrics.queue_wait.sum:
+                    parts.append(f"queue wait p95 {metrics.queue_wait.quantile(0.95):.1f}s")
+                parts.append(f"{metrics.request_bytes / 1024:.1f} KB sent, {metrics.response_bytes / 1024:.1f} KB received")
+                lines.append(f"{provider}: " + ", ".join(parts))
+            return lines
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+# The process-wide metrics
+def get_metrics():
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+            atexit.register(_metrics._export_at_exit)
+        return _metrics
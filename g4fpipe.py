@@ -0,0 +1,202 @@
+import argparse
+import asyncio
+import codecs
+import json
+import os
+import sys
+import time
+from g4fbatch import parse_prompt
+from g4fschedule import concurrency_warning
+
+# Default number of prompts in flight
+PIPE_CONCURRENCY = 4
+
+# Answers that may wait behind a slow earlier one, per prompt in flight
+PIPE_WINDOW_FACTOR = 4
+
+# Bytes read from stdin per wakeup
+PIPE_READ_SIZE = 64 * 1024
+
+# Lines from a file descriptor without blocking the event loop.
+#
+# Pipes and terminals are read without blocking and, when empty, watched
+# with the loop's selector until select() reports data, so prompts keep
+# being taken in while replies come back.  Descriptors a selector cannot
+# watch (regular files, or any descriptor on loops without add_reader) are
+# read in a worker thread instead.
+class LineReader:
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = b""
+        self.eof = False
+        self.selectable = True
+        self.was_blocking = None
+
+    async def _wait_readable(self):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(self.fd, readable.set_result, None)
+        try:
+            await readable
+        finally:
+            loop.remove_reader(self.fd)
+
+    async def _fill(self):
+        if self.selectable:
+            try:
+                if self.was_blocking is None:
+                    self.was_blocking = os.get_blocking(self.fd)
+                    os.set_blocking(self.fd, False)
+                while True:
+                    try:
+                        return os.read(self.fd, PIPE_READ_SIZE)
+                    except BlockingIOError:
+                        await self._wait_readable()
+            except (NotImplementedError, OSError, ValueError):
+                self.close()
+                self.selectable = False
+        return await asyncio.get_running_loop().run_in_executor(None, os.read, self.fd, PIPE_READ_SIZE)
+
+    # Next line without its newline, or None at end of input
+    async def readline(self):
+        while b"\n" not in self.buffer and not self.eof:
+            data = await self._fill()
+            if data:
+                self.buffer += data
+            else:
+                self.eof = True
+        if not self.buffer:
+            return None
+        line, _, self.buffer = self.buffer.partition(b"\n")
+        return line.decode("utf-8", errors="replace").rstrip("\r")
+
+    def close(self):
+        if self.was_blocking is not None:
+            os.set_blocking(self.fd, self.was_blocking)
+            self.was_blocking = None
+
+# Answer prompts from stdin as they arrive, up to `concurrency` at a time,
+# and write the answers to stdout in input order.  Each answer is written
+# and flushed as soon as every earlier one is out.  At most `window`
+# prompts are taken in ahead of the oldest unwritten answer, which bounds
+# memory when one prompt is slow.  In text format an answer is followed by
+# `separator`; in json format every line is an object with the prompt's
+# index.  Errors go to stderr in text format and into the object in json.
+async def run_pipe(engine, provider_name, concurrency=PIPE_CONCURRENCY, window=None, output_format="text",
+                   separator="\n", json_input=False, field="prompt", failover_providers=1, stdin=None, stdout=None):
+    stdin = sys.stdin.fileno() if stdin is None else stdin
+    stdout = stdout or sys.stdout
+    reader = LineReader(stdin)
+    calls = asyncio.Semaphore(concurrency)
+    slots = asyncio.Semaphore(window or concurrency * PIPE_WINDOW_FACTOR)
+    # index -> finished result waiting for the ones before it
+    results = {}
+    answered = asyncio.Event()
+    stats = {"done": 0, "cached": 0, "errors": 0}
+    tasks = set()
+    total = None
+
+    def emit(result):
+        if output_format == "json":
+            stdout.write(json.dumps(result) + "\n")
+        else:
+            if result["error"]:
+                print(f"[{result['index']}] {result['error']}", file=sys.stderr, flush=True)
+            stdout.write((result["response"] or "") + separator)
+        stdout.flush()
+        key = "errors" if result["error"] else "cached" if result["cached"] else "done"
+        stats[key] += 1
+
+    async def answer(index, line):
+        result = {"index": index}
+        start = time.perf_counter()
+        try:
+            messages = parse_prompt(json.loads(line) if json_input else line, field)
+            async with calls:
+                winner, response, cached = await engine.complete(
+                    provider_name, messages, stream=False, failover=failover_providers
+                )
+            result.update(provider=winner, response=response, cached=cached, error=None)
+        except Exception as e:
+            result.update(provider=provider_name, response=None, cached=False, error=f"{type(e).__name__}: {e}")
+        result["latency"] = round(time.perf_counter() - start, 3)
+        results[index] = result
+        answered.set()
+
+    async def read():
+        nonlocal total
+        index = 0
+        while True:
+            await slots.acquire()
+            line = await reader.readline()
+            if line is None:
+                break
+            if not line.strip():
+                slots.release()
+                continue
+            task = asyncio.ensure_future(answer(index, line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            index += 1
+        total = index
+        answered.set()
+
+    async def write():
+        index = 0
+        while total is None or index < total:
+            if index not in results:
+                answered.clear()
+                await answered.wait()
+                continue
+            emit(results.pop(index))
+            index += 1
+            slots.release()
+
+    try:
+        await asyncio.gather(read(), write())
+    finally:
+        reader.close()
+        for task in tasks:
+            task.cancel()
+    return stats
+
+# Entry point for 'g4fchatplus.py --pipe ...', e.g.
+# cat prompts.txt | g4fchatplus.py --pipe --provider X --concurrency 8
+def pipe_main(argv, engine):
+    parser = argparse.ArgumentParser(prog="g4fchatplus.py --pipe",
+                                     description="Answer prompts from stdin, one per line, in input order.")
+    parser.add_argument("--provider", required=True, help="provider to ask")
+    parser.add_argument("--concurrency", type=int, default=PIPE_CONCURRENCY,
+                        help="prompts in flight, at most the provider's limits in rate_limits.json allow")
+    parser.add_argument("--window", type=int, help="prompts read ahead of the oldest unwritten answer "
+                                                   f"(default: {PIPE_WINDOW_FACTOR} x concurrency)")
+    parser.add_argument("--format", choices=["text", "json"], default="text", help="output format")
+    parser.add_argument("--separator", default="\\n", help="written after each answer in text format "
+                                                           "(backslash escapes allowed, e.g. '\\n---\\n' or '\\0')")
+    parser.add_argument("--json-input", action="store_true", help="read JSONL lines as 'batch' does")
+    parser.add_argument("--field", default="prompt", help="field holding the prompt in object lines")
+    parser.add_argument("--failover", type=int, default=1, metavar="N", help="providers to try per prompt")
+    args = parser.parse_args(argv)
+
+    if args.provider not in engine.registry:
+        parser.error(f"unknown provider '{args.provider}'")
+    concurrency = max(1, args.concurrency)
+    warning = concurrency_warning(args.provider, concurrency)
+    if warning:
+        print(warning, file=sys.stderr)
+    window = max(concurrency, args.window) if args.window else None
+    separator = codecs.decode(args.separator, "unicode_escape")
+
+    start = time.perf_counter()
+    try:
+        stats = asyncio.run(run_pipe(engine, args.provider, concurrency, window, args.format, separator,
+                                     args.json_input, args.field, args.failover))
+    except BrokenPipeError:
+        # The reader went away, e.g. '| head'; keep the exit flush quiet
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    elapsed = time.perf_counter() - start
+    answered = stats["done"] + stats["cached"] + stats["errors"]
+    print(f"{answered} prompts in {elapsed:.1f}s ({answered / elapsed if elapsed else 0:.1f}/s), "
+          f"{stats['cached']} cached, {stats['errors']} errors", file=sys.stderr)
+    return 1 if stats["errors"] else 0
@@ -0,0 +1,224 @@
+import atexit
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+# Directory profiles are written to
+PROFILE_DIR = "profiles"
+
+# Seconds between stack samples
+PROFILE_INTERVAL = 0.005
+
+# Allocation sites listed per capture
+PROFILE_TOP_ALLOCATIONS = 25
+
+# Frames kept per tracemalloc traceback
+PROFILE_TRACE_FRAMES = 16
+
+_enabled = False
+_null = contextlib.nullcontext()
+_lock = threading.Lock()
+
+# phase -> [count, total seconds, longest]
+_phases = {}
+
+# Per-phase wall time, collected only while profiling
+class PhaseTimer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            stats = _phases.setdefault(self.name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+        return False
+
+# Time a phase of a turn ("cache lookup", "provider call", "cache write",
+# "render").  Costs one global lookup when profiling is off.
+def phase(name):
+    if not _enabled:
+        return _null
+    return PhaseTimer(name)
+
+# Samples the stacks of every thread while at least one capture is open.
+#
+# Each sample walks sys._current_frames() and counts the stack in collapsed
+# form ("thread;module:function;..."), which flamegraph.pl, speedscope and
+# inferno read directly.  Stacks are added to every open capture.
+class StackSampler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.captures = []
+        self.thread = None
+        self.condition = threading.Condition()
+
+    def add(self, capture):
+        with self.condition:
+            self.captures.append(capture)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="g4f-profiler", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def remove(self, capture):
+        with self.condition:
+            self.captures.remove(capture)
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self.condition:
+                while not self.captures:
+                    self.condition.wait()
+                captures = list(self.captures)
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                for capture in captures:
+                    capture.stacks[key] = capture.stacks.get(key, 0) + 1
+            time.sleep(self.interval)
+
+_sampler = StackSampler()
+
+# Allocations outside the profiler itself and the import machinery
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, cProfile.__file__),
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    ])
+_sequence = 0
+_cprofile_active = False
+
+# One profiled stretch of work: stack samples of every thread, a cProfile of
+# the thread that opened it, allocations made in between, and the phase
+# times spent in it.  Written to PROFILE_DIR when it closes.
+class Capture:
+    def __init__(self, label):
+        global _sequence
+        with _lock:
+            _sequence += 1
+            self.name = f"{os.getpid()}-{_sequence:04d}-{label}"
+        self.label = label
+        self.stacks = {}
+        self.profile = None
+
+    def __enter__(self):
+        global _cprofile_active
+        with _lock:
+            self.phases = {name: list(stats) for name, stats in _phases.items()}
+            # cProfile allows one active profiler; overlapping captures only sample
+            if not _cprofile_active:
+                _cprofile_active = True
+                self.profile = cProfile.Profile()
+        self.snapshot = _snapshot() if tracemalloc.is_tracing() else None
+        self.start = time.perf_counter()
+        _sampler.add(self)
+        if self.profile:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        global _cprofile_active
+        if self.profile:
+            self.profile.disable()
+            with _lock:
+                _cprofile_active = False
+        _sampler.remove(self)
+        elapsed = time.perf_counter() - self.start
+        self._write(elapsed)
+        return False
+
+    def _write(self, elapsed):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, self.name)
+        with open(base + ".collapsed", 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        if self.profile:
+            self.profile.dump_stats(base + ".prof")
+        with _lock:
+            phases = {
+                name: {"count": stats[0] - self.phases.get(name, [0, 0.0])[0],
+                       "seconds": stats[1] - self.phases.get(name, [0, 0.0])[1]}
+                for name, stats in _phases.items()
+            }
+        summary = {"label": self.label, "seconds": elapsed, "samples": sum(self.stacks.values()),
+                   "phases": {name: value for name, value in phases.items() if value["count"]}}
+        if self.snapshot is not None:
+            top = _snapshot().compare_to(self.snapshot, "lineno")[:PROFILE_TOP_ALLOCATIONS]
+            summary["allocations"] = [
+                {"site": str(stat.traceback[0]), "size_diff": stat.size_diff, "count_diff": stat.count_diff}
+                for stat in top
+            ]
+        with open(base + ".json", 'w') as f:
+            json.dump(summary, f, indent=2)
+
+# Profile a stretch of work ("startup", "discovery", "turn").  Does nothing
+# when profiling is off.
+def capture(label):
+    if not _enabled:
+        return _null
+    return Capture(label)
+
+def enabled():
+    return _enabled
+
+# Turn profiling on, with allocation tracing unless allocations=False
+def enable(allocations=True):
+    global _enabled
+    if _enabled:
+        return
+    _enabled = True
+    if allocations and not tracemalloc.is_tracing():
+        tracemalloc.start(PROFILE_TRACE_FRAMES)
+    atexit.register(write_summary)
+
+# Enable profiling if --profile is on the command line, and take it off
+# so the script's own argument handling never sees it
+def enable_from_argv(argv=None):
+    argv = sys.argv if argv is None else argv
+    if "--profile" in argv:
+        argv.remove("--profile")
+        enable()
+    return _enabled
+
+# Per-phase totals for the whole run, as lines
+def phase_summary():
+    with _lock:
+        phases = sorted(_phases.items(), key=lambda item: -item[1][1])
+    return [
+        f"{name}: {count} x, {total:.3f}s total, {total / count * 1000:.1f}ms mean, {longest * 1000:.1f}ms max"
+        for name, (count, total, longest) in phases
+    ]
+
+# Write the run's phase summary next to the captures and print it
+def write_summary():
+    lines = phase_summary()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{os.getpid()}-phases.txt")
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    print(f"\nProfiles written to {PROFILE_DIR}/ (phase summary in {path}):", file=sys.stderr)
+    for line in lines:
+        print(f"  {line}", file=sys.stderr)
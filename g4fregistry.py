@@ -0,0 +1,173 @@
+import importlib
+import importlib.metadata
+import importlib.util
+import inspect
+import json
+import os
+import subprocess
+import sys
+import time
+from collections.abc import Mapping
+from g4fcache import CACHE_DIR
+from g4fstate import write_atomic
+
+# File caching provider names and capabilities for the installed g4f
+MANIFEST_FILE = os.path.join(CACHE_DIR, "providers.json")
+
+# Capabilities recorded for every provider
+CAPABILITIES = ("working", "supports_stream", "needs_auth")
+
+# Identify the installed g4f without importing it
+def g4f_version():
+    try:
+        return importlib.metadata.version("g4f")
+    except importlib.metadata.PackageNotFoundError:
+        pass
+    spec = importlib.util.find_spec("g4f")
+    if spec is None or not spec.origin:
+        return None
+    return f"mtime:{os.path.getmtime(spec.origin)}"
+
+# Make a provider's params JSON friendly
+def _describe_params(params):
+    if isinstance(params, dict):
+        return {str(k): v if isinstance(v, (str, int, float, bool, type(None))) else str(v) for k, v in params.items()}
+    return str(params)
+
+# Scan g4f.Provider for provider classes and their capabilities (the slow path)
+def scan_providers():
+    import g4f
+    providers = {}
+    for name, obj in inspect.getmembers(g4f.Provider):
+        if inspect.isclass(obj) and issubclass(obj, g4f.Provider.BaseProvider) and obj != g4f.Provider.BaseProvider:
+            info = {}
+            for capability in CAPABILITIES:
+                try:
+                    info[capability] = bool(getattr(obj, capability))
+                except Exception:
+                    info[capability] = False
+            if hasattr(obj, 'params'):
+                try:
+                    info["params"] = _describe_params(obj.params)
+                except Exception:
+                    pass
+            providers[name] = info
+    return providers
+
+# Load the manifest if it matches the installed g4f, otherwise rebuild and save it
+def load_manifest(refresh=False):
+    version = g4f_version()
+    if not refresh and version and os.path.exists(MANIFEST_FILE):
+        try:
+            with open(MANIFEST_FILE, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get("g4f_version") == version:
+                return manifest
+        except ValueError:
+            pass
+    manifest = {"g4f_version": version, "providers": scan_providers()}
+    if version:
+        os.makedirs(os.path.dirname(MANIFEST_FILE), exist_ok=True)
+        write_atomic(MANIFEST_FILE, json.dumps(manifest, indent=2))
+    return manifest
+
+# Working providers by name, backed by the manifest.
+#
+# Behaves like the old available_providers dict, but provider classes are
+# only imported from g4f when a provider is actually looked up.
+class ProviderRegistry(Mapping):
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.providers = {
+            name: info for name, info in manifest["providers"].items() if info.get("working")
+        }
+        self.classes = {}
+        # (capability, value) -> names, for filtering without touching classes
+        self.capability_index = {}
+        for name, info in self.providers.items():
+            for capability in CAPABILITIES:
+                self.capability_index.setdefault((capability, info.get(capability, False)), set()).add(name)
+
+    # Add a provider that does not come from g4f, e.g. the benchmark's fake
+    def register(self, name, provider):
+        info = {capability: bool(getattr(provider, capability, False)) for capability in CAPABILITIES}
+        self.providers[name] = info
+        self.classes[name] = provider
+        for capability in CAPABILITIES:
+            for value in (True, False):
+                self.capability_index.get((capability, value), set()).discard(name)
+            self.capability_index.setdefault((capability, info[capability]), set()).add(name)
+
+    def __getitem__(self, name):
+        if name not in self.providers:
+            raise KeyError(name)
+        provider = self.classes.get(name)
+        if provider is None:
+            g4f = importlib.import_module("g4f")
+            provider = self.classes[name] = getattr(g4f.Provider, name)
+        return provider
+
+    def __iter__(self):
+        return iter(self.providers)
+
+    def __len__(self):
+        return len(self.providers)
+
+    # Capabilities recorded in the manifest for a provider
+    def info(self, name):
+        return self.providers[name]
+
+    # Provider names having all the given capability values, e.g. supports_stream=True
+    def filter(self, **capabilities):
+        names = set(self.providers)
+        for capability, value in capabilities.items():
+            names &= self.capability_index.get((capability, value), set())
+        return [name for name in self.providers if name in names]
+
+# Build the registry of working providers
+def load_providers(refresh=False):
+    return ProviderRegistry(load_manifest(refresh))
+
+# Parse filter words like "stream noauth" into capability values
+def parse_filter(words):
+    capabilities = {}
+    for word in words:
+        word = word.lower()
+        if word in ("stream", "streaming"):
+            capabilities["supports_stream"] = True
+        elif word in ("nostream",):
+            capabilities["supports_stream"] = False
+        elif word in ("noauth", "free"):
+            capabilities["needs_auth"] = False
+        elif word in ("auth",):
+            capabilities["needs_auth"] = True
+    return capabilities
+
+# Time fresh interpreters discovering providers by scanning vs. from the manifest
+def benchmark_startup(runs=5):
+    here = os.path.dirname(os.path.abspath(__file__))
+    scripts = {
+        "scan": "import g4fregistry; g4fregistry.scan_providers()",
+        "manifest": "import g4fregistry; r = g4fregistry.load_providers(); list(r)",
+    }
+    load_manifest()
+    results = {}
+    for label, script in scripts.items():
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", script], cwd=os.getcwd(), check=True,
+                           env=dict(os.environ, PYTHONPATH=here + os.pathsep + os.environ.get("PYTHONPATH", "")))
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        results[label] = {"runs": runs, "min": timings[0], "median": timings[len(timings) // 2]}
+    results["speedup"] = results["scan"]["median"] / results["manifest"]["median"]
+    return results
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["bench"]:
+        print(json.dumps(benchmark_startup(int(sys.argv[2]) if len(sys.argv) > 2 else 5), indent=2))
+    else:
+        registry = load_providers(refresh="refresh" in sys.argv[1:])
+        for name in registry:
+            print(name, registry.info(name))
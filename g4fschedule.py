@@ -0,0 +1,191 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import time
+
+# File with per-provider limits, next to api_keys.json, e.g.
+# {"default": {"per_minute": 30, "burst": 5, "concurrent": 4}, "Bing": {"per_minute": 10}}
+RATE_LIMITS_FILE = "rate_limits.json"
+
+# Limits for providers without an entry; 0 disables a limit
+DEFAULT_RATE_LIMIT = {"per_minute": 30, "burst": 5, "concurrent": 4}
+
+# Request priorities, most urgent first
+INTERACTIVE = 0
+BACKGROUND = 1
+BATCH = 2
+
+# Seconds a request may wait before the wait is reported
+WAIT_NOTICE_SECONDS = 1.0
+
+# Priority of provider calls made in the current task
+request_priority = contextvars.ContextVar("request_priority", default=INTERACTIVE)
+
+# Called with a message when a provider call in the current task has to wait
+wait_notice = contextvars.ContextVar("wait_notice", default=None)
+
+_limits = None
+
+# Load per-provider limits from file (once)
+def load_rate_limits():
+    global _limits
+    if _limits is None:
+        _limits = {}
+        if os.path.exists(RATE_LIMITS_FILE):
+            with open(RATE_LIMITS_FILE, 'r') as f:
+                _limits = json.load(f)
+    return _limits
+
+# Limits for a provider: its entry over the default entry over DEFAULT_RATE_LIMIT
+def rate_limit(provider_name):
+    limits = load_rate_limits()
+    return dict(DEFAULT_RATE_LIMIT, **limits.get("default", {}), **limits.get(provider_name, {}))
+
+# Why a run asking for `concurrency` calls in flight will get fewer from
+# the provider's limits, or None when they allow it
+def concurrency_warning(provider_name, concurrency):
+    limiter = get_scheduler().limiter(provider_name)
+    caps = []
+    if limiter.concurrent and concurrency > limiter.concurrent:
+        caps.append(f"{limiter.concurrent} requests in flight")
+    if limiter.rate and concurrency > limiter.capacity:
+        caps.append(f"{limiter.rate * 60:g} per minute after a burst of {limiter.capacity}")
+    if not caps:
+        return None
+    return (f"Note: {provider_name} is limited to {' and '.join(caps)}; raise its entry in "
+            f"{RATE_LIMITS_FILE} to use --concurrency {concurrency} fully.")
+
+# Token bucket and in-flight cap for one provider, with a priority queue.
+#
+# A request takes a token (refilled at per_minute / 60 per second, up to
+# burst) and an in-flight slot.  When either is short it queues; waiters are
+# granted strictly by (priority, arrival), so a batch job never overtakes a
+# chat and equal priorities are served in order.  A timer wakes the queue
+# when the next token is due, so requests are held back before the provider
+# would start refusing them.
+class ProviderLimiter:
+    def __init__(self, per_minute=0, burst=1, concurrent=0):
+        self.rate = per_minute / 60
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.concurrent = concurrent
+        self.in_flight = 0
+        self.waiters = []
+        self.timer = None
+        self.sequence = itertools.count()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _can_start(self):
+        if self.concurrent and self.in_flight >= self.concurrent:
+            return False
+        return not self.rate or self.tokens >= 1
+
+    def _take(self):
+        self.in_flight += 1
+        if self.rate:
+            self.tokens -= 1
+
+    # Grant queued requests while tokens and slots last
+    def _wake(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self._refill()
+        while self.waiters:
+            future = self.waiters[0][2]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if not self._can_start():
+                if self.rate and self.tokens < 1 and not (self.concurrent and self.in_flight >= self.concurrent):
+                    delay = (1 - self.tokens) / self.rate
+                    self.timer = asyncio.get_running_loop().call_later(delay, self._wake)
+                return
+            heapq.heappop(self.waiters)
+            self._take()
+            future.set_result(None)
+
+    def queued(self):
+        return sum(1 for _, _, future in self.waiters if not future.done())
+
+    # Wait for a token and a slot; returns the seconds waited
+    async def acquire(self, priority=INTERACTIVE, on_wait=None):
+        self._refill()
+        if not self.queued() and self._can_start():
+            self._take()
+            return 0.0
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        start = time.monotonic()
+        notice = loop.call_later(WAIT_NOTICE_SECONDS, on_wait, self.queued()) if on_wait else None
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as the caller gave up; pass the slot on
+                self.release()
+            else:
+                future.cancel()
+            raise
+        finally:
+            if notice:
+                notice.cancel()
+        return time.monotonic() - start
+
+    def release(self):
+        self.in_flight -= 1
+        if self.waiters:
+            self._wake()
+
+# Limiters for every provider, created from rate_limits.json on first use
+class Scheduler:
+    def __init__(self):
+        self.limiters = {}
+
+    def limiter(self, provider_name):
+        limiter = self.limiters.get(provider_name)
+        if limiter is None:
+            limiter = self.limiters[provider_name] = ProviderLimiter(**rate_limit(provider_name))
+        return limiter
+
+    # Replace a provider's limits, e.g. to lift them for a local provider
+    def configure(self, provider_name, per_minute=0, burst=1, concurrent=0):
+        self.limiters[provider_name] = ProviderLimiter(per_minute, burst, concurrent)
+
+    # Queue for a call to the provider at the current task's priority.
+    # Returns the seconds waited; release() must follow the call.
+    async def acquire(self, provider_name):
+        notice = wait_notice.get()
+
+        def report(queued):
+            notice(f"Waiting for {provider_name}'s rate limit ({queued} queued)...")
+        return await self.limiter(provider_name).acquire(request_priority.get(), report if notice else None)
+
+    def release(self, provider_name):
+        self.limiter(provider_name).release()
+
+    # Current queue state, one line per provider that has been used
+    def describe(self):
+        lines = []
+        for name, limiter in sorted(self.limiters.items()):
+            limiter._refill()
+            tokens = f", {limiter.tokens:.1f} tokens" if limiter.rate else ""
+            lines.append(f"{name}: {limiter.in_flight} in flight, {limiter.queued()} queued{tokens}")
+        return lines
+
+_scheduler = Scheduler()
+
+# The process-wide scheduler
+def get_scheduler():
+    return _scheduler
@@ -0,0 +1,397 @@
+import array
+import heapq
+import json
+import math
+import os
+import re
+import struct
+import time
+from g4fstate import FileLock, file_signature, write_atomic
+
+# Directory for the full-text search index
+SEARCH_DIR = "search"
+
+# Documents buffered in memory before they are written out as a segment
+SEGMENT_DOCS = 2000
+
+# Segments of one size level merged into one of the next level
+MERGE_FACTOR = 8
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Results returned by a search
+SEARCH_RESULTS = 10
+
+# Characters of context shown around a hit
+SNIPPET_CHARS = 160
+
+# Document offsets and lengths in docs.idx: offset in docs.dat, token count
+_DOC_ENTRY = struct.Struct("<QI")
+
+# Words of a text, lowercased
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+# Term frequencies of a text, and its length in tokens
+def term_frequencies(text):
+    tf = {}
+    tokens = tokenize(text)
+    for token in tokens:
+        tf[token] = tf.get(token, 0) + 1
+    return tf, len(tokens)
+
+# An immutable segment: the postings of a run of consecutive documents.
+#
+# "<name>.post" holds, for each term, the ids of the documents containing it
+# (uint32) followed by the term frequencies (uint16); "<name>.terms" maps each
+# term to its offset and posting count.  Only the term dictionary is held in
+# memory, so a query reads just the postings of its own terms.
+class Segment:
+    def __init__(self, directory, name, level, docs):
+        self.name = name
+        self.level = level
+        self.docs = docs
+        self.path = os.path.join(directory, name)
+        with open(self.path + ".terms", 'r') as f:
+            self.terms = json.load(f)
+        self.postings = open(self.path + ".post", 'rb')
+
+    def postings_for(self, term):
+        entry = self.terms.get(term)
+        if entry is None:
+            return None, None
+        offset, count = entry
+        self.postings.seek(offset)
+        data = self.postings.read(count * 6)
+        ids = array.array("I")
+        ids.frombytes(data[:count * 4])
+        tfs = array.array("H")
+        tfs.frombytes(data[count * 4:])
+        return ids, tfs
+
+    # Every term with its postings, for merging
+    def items(self):
+        for term in self.terms:
+            yield term, self.postings_for(term)
+
+    def close(self):
+        self.postings.close()
+
+    def remove(self):
+        self.close()
+        for suffix in (".terms", ".post"):
+            try:
+                os.remove(self.path + suffix)
+            except OSError:
+                pass
+
+    # Write postings ({term: ([doc ids], [tfs])}) as a new segment
+    @staticmethod
+    def write(directory, name, postings):
+        path = os.path.join(directory, name)
+        terms = {}
+        with open(path + ".post", 'wb') as f:
+            for term in sorted(postings):
+                ids, tfs = postings[term]
+                terms[term] = [f.tell(), len(ids)]
+                f.write(array.array("I", ids).tobytes())
+                f.write(array.array("H", (min(tf, 0xFFFF) for tf in tfs)).tobytes())
+        tmp_path = path + ".terms.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(terms, f, separators=(",", ":"))
+        os.replace(tmp_path, path + ".terms")
+
+# Incrementally maintained BM25 index over chat turns and cached responses.
+#
+# Documents are appended to "docs.dat" (one JSON line each, full text) and
+# their offset and token count to the fixed-width "docs.idx".  New documents
+# are indexed in memory; every SEGMENT_DOCS of them are flushed into an
+# immutable segment, and MERGE_FACTOR segments of the same level are merged
+# into one, so the segment count stays logarithmic.  The list of segments is
+# "segments.json", replaced atomically.  On open, only documents newer than
+# the last segment are re-read from docs.dat; a torn write from a crash is
+# cut off.
+#
+# Several processes may share the index.  Writers take "lock" and first
+# index the documents others added and pick up their segments; searches
+# never lock and catch up the same way, so every process sees every
+# document.
+class SearchIndex:
+    def __init__(self, directory=None):
+        self.directory = directory or SEARCH_DIR
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest_file = os.path.join(self.directory, "segments.json")
+        self.docs_path = os.path.join(self.directory, "docs.dat")
+        self.index_path = os.path.join(self.directory, "docs.idx")
+        self.file_lock = FileLock(os.path.join(self.directory, "lock"))
+        self.backfilled = False
+        # Documents [0, indexed) are in segments
+        self.indexed = 0
+        self.segments = []
+        self.manifest_signature = None
+        self.offsets = array.array("Q")
+        self.lengths = array.array("I")
+        self.total_length = 0
+        # Postings of documents not in a segment yet
+        self.pending = {}
+        with self.file_lock:
+            self._load_manifest()
+            self._open_docs()
+
+    # Pick up the segment list, keeping segments that are already open.  A
+    # segment merged away by another process between reading the list and
+    # opening it means the list is stale, so it is read again.
+    def _load_manifest(self):
+        while True:
+            signature = file_signature(self.manifest_file)
+            manifest = {"segments": [], "indexed": 0, "backfilled": False}
+            if signature is not None:
+                with open(self.manifest_file, 'r') as f:
+                    manifest = json.load(f)
+            current = {segment.name: segment for segment in self.segments}
+            try:
+                segments = [current.get(entry[0]) or Segment(self.directory, *entry) for entry in manifest["segments"]]
+            except FileNotFoundError:
+                continue
+            break
+        for segment in self.segments:
+            if segment not in segments:
+                segment.close()
+        self.segments = segments
+        self.backfilled = manifest["backfilled"]
+        self.manifest_signature = signature
+        if manifest["indexed"] > self.indexed:
+            self.indexed = manifest["indexed"]
+            # Drop pending postings now covered by a segment
+            for term in list(self.pending):
+                ids, tfs = self.pending[term]
+                keep = [i for i, doc_id in enumerate(ids) if doc_id >= self.indexed]
+                if keep:
+                    self.pending[term] = ([ids[i] for i in keep], [tfs[i] for i in keep])
+                else:
+                    del self.pending[term]
+
+    # Catch up with documents and segments other processes added
+    def _sync(self):
+        if file_signature(self.manifest_file) != self.manifest_signature:
+            self._load_manifest()
+        size = os.fstat(self.index.fileno()).st_size
+        known = len(self.offsets) * _DOC_ENTRY.size
+        if size - size % _DOC_ENTRY.size > known:
+            self.index.seek(known)
+            data = self.index.read(size - size % _DOC_ENTRY.size - known)
+            for offset, length in _DOC_ENTRY.iter_unpack(data):
+                doc_id = len(self.offsets)
+                self.offsets.append(offset)
+                self.lengths.append(length)
+                self.total_length += length
+                if doc_id >= self.indexed:
+                    tf, _ = term_frequencies(self.document(doc_id)["text"])
+                    self._add_postings(doc_id, tf)
+
+    def _open_docs(self):
+        data = b""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        data = data[:len(data) - len(data) % _DOC_ENTRY.size]
+        docs_size = os.path.getsize(self.docs_path) if os.path.exists(self.docs_path) else 0
+        for offset, length in _DOC_ENTRY.iter_unpack(data):
+            # An index entry for a line that never made it to disk ends the log
+            if offset >= docs_size:
+                break
+            self.offsets.append(offset)
+            self.lengths.append(length)
+            self.total_length += length
+        self.docs = open(self.docs_path, 'a+b')
+        self.index = open(self.index_path, 'a+b')
+        # A torn last line is dropped along with its index entry
+        while self.offsets and not self._line(len(self.offsets) - 1).endswith(b"\n"):
+            self.total_length -= self.lengths.pop()
+            self.offsets.pop()
+        end = self.offsets[-1] + len(self._line(len(self.offsets) - 1)) if self.offsets else 0
+        self.docs.seek(0, os.SEEK_END)
+        if self.docs.tell() != end:
+            self.docs.truncate(end)
+        self.index.truncate(len(self.offsets) * _DOC_ENTRY.size)
+        for doc_id in range(self.indexed, len(self.offsets)):
+            tf, _ = term_frequencies(self.document(doc_id)["text"])
+            self._add_postings(doc_id, tf)
+
+    def _line(self, doc_id):
+        self.docs.seek(self.offsets[doc_id])
+        return self.docs.readline()
+
+    def _save_manifest(self):
+        manifest = {
+            "segments": [[s.name, s.level, s.docs] for s in self.segments],
+            "indexed": self.indexed,
+            "backfilled": self.backfilled,
+        }
+        write_atomic(self.manifest_file, json.dumps(manifest))
+        self.manifest_signature = file_signature(self.manifest_file)
+
+    def _add_postings(self, doc_id, tf):
+        for term, count in tf.items():
+            ids, tfs = self.pending.setdefault(term, ([], []))
+            ids.append(doc_id)
+            tfs.append(count)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Index a document.  kind is "chat" or "cache", source the chat or provider.
+    def add(self, kind, source, text, at=None):
+        tf, length = term_frequencies(text)
+        if not length:
+            return
+        line = json.dumps({"kind": kind, "source": source, "at": at or time.time(), "text": text}).encode("utf-8") + b"\n"
+        with self.file_lock:
+            self._sync()
+            doc_id = len(self.offsets)
+            self.docs.seek(0, os.SEEK_END)
+            offset = self.docs.tell()
+            # Data first: an index entry never points at bytes that are not on disk
+            self.docs.write(line)
+            self.docs.flush()
+            self.index.write(_DOC_ENTRY.pack(offset, length))
+            self.index.flush()
+            self.offsets.append(offset)
+            self.lengths.append(length)
+            self.total_length += length
+            self._add_postings(doc_id, tf)
+            if len(self.offsets) - self.indexed >= SEGMENT_DOCS:
+                self.flush()
+
+    # Write the in-memory postings out as a segment
+    def flush(self):
+        with self.file_lock:
+            self._sync()
+            if not self.pending:
+                return
+            name = f"seg-{self.indexed}-{len(self.offsets)}"
+            Segment.write(self.directory, name, self.pending)
+            self.segments.append(Segment(self.directory, name, 0, len(self.offsets) - self.indexed))
+            self.indexed = len(self.offsets)
+            self.pending = {}
+            self._merge()
+            self._save_manifest()
+
+    # Merge trailing runs of MERGE_FACTOR segments of the same level
+    def _merge(self):
+        while len(self.segments) >= MERGE_FACTOR:
+            run = self.segments[-MERGE_FACTOR:]
+            if any(s.level != run[0].level for s in run):
+                return
+            postings = {}
+            for segment in run:
+                for term, (ids, tfs) in segment.items():
+                    merged = postings.setdefault(term, (array.array("I"), array.array("H")))
+                    merged[0].extend(ids)
+                    merged[1].extend(tfs)
+            first = run[0].name.split("-")[1]
+            name = f"seg-{first}-{self.indexed}"
+            Segment.write(self.directory, name, postings)
+            merged = Segment(self.directory, name, run[0].level + 1, sum(s.docs for s in run))
+            self.segments[-MERGE_FACTOR:] = [merged]
+            self._save_manifest()
+            for segment in run:
+                segment.remove()
+
+    def document(self, doc_id):
+        return json.loads(self._line(doc_id))
+
+    # Best matching documents for a query, as (score, document) pairs with a
+    # "snippet" around the first hit added to each document
+    def search(self, query, limit=SEARCH_RESULTS):
+        self._sync()
+        terms = set(tokenize(query))
+        count = len(self.offsets)
+        if not terms or not count:
+            return []
+        average_length = self.total_length / count
+        scores = {}
+        for term in terms:
+            postings = [self.pending.get(term, (None, None))] + [s.postings_for(term) for s in self.segments]
+            postings = [(ids, tfs) for ids, tfs in postings if ids]
+            df = sum(len(ids) for ids, _ in postings)
+            if not df:
+                continue
+            idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+            for ids, tfs in postings:
+                for doc_id, tf in zip(ids, tfs):
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc_id] / average_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        results = []
+        for doc_id, score in heapq.nlargest(limit, scores.items(), key=lambda item: item[1]):
+            document = self.document(doc_id)
+            document["snippet"] = snippet(document["text"], terms)
+            results.append((score, document))
+        return results
+
+    # Unflushed documents are re-indexed from docs.dat on the next open
+    def close(self):
+        self.docs.close()
+        self.index.close()
+        for segment in self.segments:
+            segment.close()
+        self.file_lock.close()
+
+# A short piece of text around the first occurrence of any of the terms
+def snippet(text, terms):
+    match = re.search(r"\b(" + "|".join(re.escape(t) for t in terms) + r")\b", text, re.IGNORECASE)
+    start = max(0, (match.start() if match else 0) - SNIPPET_CHARS // 2)
+    piece = " ".join(text[start:start + SNIPPET_CHARS].split())
+    return ("..." if start else "") + piece + ("..." if start + SNIPPET_CHARS < len(text) else "")
+
+# Text of a chat turn as one search document
+def turn_text(user_message, reply):
+    return f"{user_message['content']}\n{reply['content']}"
+
+# Index everything written before the search index existed: saved chats and
+# cached responses.  Runs once per index.
+def backfill(index, sessions=None, cache_dir=None):
+    if index.backfilled:
+        return
+    with index.file_lock:
+        # Another process may have done it meanwhile
+        index._sync()
+        if not index.backfilled:
+            _backfill(index, sessions, cache_dir)
+
+def _backfill(index, sessions, cache_dir):
+    if sessions is not None:
+        for name in sessions.list():
+            user_message = None
+            for record in sessions.records(name):
+                if record.get("role") == "user":
+                    user_message = record
+                elif record.get("role") == "assistant" and user_message:
+                    index.add("chat", name, turn_text(user_message, record), record.get("at"))
+                    user_message = None
+    from g4fcache import stored_providers, stored_responses
+    for provider in stored_providers(cache_dir):
+        for response, created in stored_responses(provider):
+            index.add("cache", provider, response, created)
+    index.backfilled = True
+    index.flush()
+    index._save_manifest()
+
+# Open the search index, indexing existing chats and cache on first use
+def open_search_index(sessions=None):
+    index = SearchIndex()
+    backfill(index, sessions)
+    return index
+
+# Print-friendly lines for search results
+def format_results(results):
+    if not results:
+        return ["No matches."]
+    lines = []
+    for i, (score, document) in enumerate(results, start=1):
+        when = time.strftime("%Y-%m-%d", time.localtime(document["at"]))
+        where = f"chat '{document['source']}'" if document["kind"] == "chat" else f"{document['source']} cache"
+        lines.append(f"{i}. [{where}, {when}, score {score:.2f}] {document['snippet']}")
+    return lines
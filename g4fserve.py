@@ -0,0 +1,333 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+from g4fcore import TurnOutput
+from g4fcontext import estimate_tokens
+from g4fwarm import CacheWarmer
+
+# Address served by default; only local tools are meant to connect
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8000
+
+# Seconds an idle keep-alive connection is kept open
+SERVE_IDLE_TIMEOUT = 60
+
+# Largest request body accepted
+SERVE_MAX_BODY = 8 * 1024 * 1024
+
+_REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    411: "Length Required", 413: "Payload Too Large", 500: "Internal Server Error", 502: "Bad Gateway",
+}
+
+# A request the server answers with an OpenAI style error
+class HTTPError(Exception):
+    def __init__(self, status, message, kind="invalid_request_error"):
+        super().__init__(message)
+        self.status = status
+        self.kind = kind
+
+# One HTTP/1.1 request
+class Request:
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    # Whether the connection stays open after this request
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def json(self):
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError as e:
+            raise HTTPError(400, f"Invalid JSON body: {e}")
+
+# Read one request from the connection, or None when the client is gone
+async def read_request(reader):
+    try:
+        line = await asyncio.wait_for(reader.readline(), SERVE_IDLE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    if not line:
+        return None
+    try:
+        method, path, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = b""
+    if "transfer-encoding" in headers:
+        raise HTTPError(411, "Chunked request bodies are not supported; send Content-Length")
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HTTPError(400, "Content-Length must be a non-negative integer")
+    if length > SERVE_MAX_BODY:
+        raise HTTPError(413, "Request body too large")
+    if length:
+        body = await reader.readexactly(length)
+    return Request(method, path.split("?", 1)[0], version, headers, body)
+
+# Writes responses on one connection
+class Responder:
+    def __init__(self, writer, keep_alive):
+        self.writer = writer
+        self.keep_alive = keep_alive
+        # Whether a status line has been written
+        self.sent = False
+
+    def _head(self, status, headers):
+        self.sent = True
+        lines = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}"]
+        headers = dict(headers, Connection="keep-alive" if self.keep_alive else "close")
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self._head(status, {"Content-Type": "application/json", "Content-Length": len(body)})
+        self.writer.write(body)
+        await self.writer.drain()
+
+    async def error(self, status, message, kind="invalid_request_error"):
+        await self.json(status, {"error": {"message": message, "type": kind, "code": status}})
+
+    # Start a server-sent event stream.  The body is chunk encoded so the
+    # connection can be kept alive afterwards.
+    def start_events(self):
+        self._head(200, {"Content-Type": "text/event-stream", "Cache-Control": "no-cache",
+                         "Transfer-Encoding": "chunked"})
+
+    def event(self, data):
+        payload = f"data: {data}\n\n".encode("utf-8")
+        self.writer.write(f"{len(payload):x}\r\n".encode("latin-1") + payload + b"\r\n")
+
+    async def end_events(self):
+        self.event("[DONE]")
+        await self.close_events()
+
+    # End the event stream without [DONE], e.g. after an error event
+    async def close_events(self):
+        self.writer.write(b"0\r\n\r\n")
+        await self.writer.drain()
+
+# Sends a reply as OpenAI chat.completion.chunk events while it streams in
+class StreamOutput(TurnOutput):
+    def __init__(self, responder, completion_id, created, model):
+        self.responder = responder
+        self.completion_id = completion_id
+        self.created = created
+        self.model = model
+        self.started = False
+
+    def _event(self, delta, finish_reason=None):
+        self.responder.event(json.dumps({
+            "id": self.completion_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }))
+
+    def reply_start(self, label):
+        if not self.started:
+            self.started = True
+            self.responder.start_events()
+            self._event({"role": "assistant", "content": ""})
+
+    def chunk(self, text):
+        self._event({"content": text})
+
+    async def finish(self):
+        self._event({}, "stop")
+        await self.responder.end_events()
+
+# One request message as the engine takes it: a role and a string.  Content
+# given as parts has its text parts joined; other parts are dropped.
+def chat_message(message):
+    if not isinstance(message, dict) or not isinstance(message.get("role"), str):
+        raise HTTPError(400, "Each message must be an object with a string 'role'")
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        texts = [part.get("text") or "" for part in content if isinstance(part, dict) and part.get("type") == "text"]
+        if not all(isinstance(text, str) for text in texts):
+            raise HTTPError(400, "Text content parts must have a string 'text'")
+        content = "".join(texts)
+    elif not isinstance(content, str):
+        raise HTTPError(400, "Message 'content' must be a string or a list of content parts")
+    return {"role": message["role"], "content": content}
+
+# OpenAI-compatible HTTP API on top of a ChatEngine.
+#
+# GET /v1/models lists the registry's providers; POST /v1/chat/completions
+# answers through engine.complete(), so replies come from and go to the
+# shared response cache, fail over like the chat frontends do, and are
+# streamed as server-sent events when "stream" is true.  A request's
+# "model" names a provider ("Bing"), a provider and a model ("Bing/gpt-4"),
+# or just a model for the default provider.  Each connection is served by
+# its own task and kept alive between requests.
+class ChatServer:
+    def __init__(self, engine, default_provider=None, failover=1):
+        self.engine = engine
+        self.default_provider = default_provider
+        self.failover = failover
+        self.server = None
+
+    async def start(self, host=SERVE_HOST, port=SERVE_PORT):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HTTPError as e:
+                    await Responder(writer, False).error(e.status, str(e))
+                    break
+                except (asyncio.IncompleteReadError, ValueError):
+                    break
+                if request is None:
+                    break
+                responder = Responder(writer, request.keep_alive())
+                try:
+                    await self.dispatch(request, responder)
+                except HTTPError as e:
+                    await responder.error(e.status, str(e), e.kind)
+                except Exception as e:
+                    # A bug, not the client's fault: answer if nothing has
+                    # been sent yet, and drop the connection either way
+                    if not responder.sent:
+                        responder.keep_alive = False
+                        await responder.error(500, f"{type(e).__name__}: {e}", "server_error")
+                    break
+                if not responder.keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, request, responder):
+        if request.path == "/v1/models":
+            if request.method != "GET":
+                raise HTTPError(405, "Use GET")
+            await responder.json(200, self.models())
+        elif request.path == "/v1/chat/completions":
+            if request.method != "POST":
+                raise HTTPError(405, "Use POST")
+            await self.chat_completion(request.json(), responder)
+        else:
+            raise HTTPError(404, f"Unknown path {request.path}")
+
+    def models(self):
+        created = int(time.time())
+        return {"object": "list", "data": [
+            {"id": name, "object": "model", "created": created, "owned_by": "g4f"}
+            for name in self.engine.registry
+        ]}
+
+    # (provider name, model) for a request's "model"
+    def resolve_model(self, requested):
+        registry = self.engine.registry
+        if requested in registry:
+            return requested, None
+        if requested and "/" in requested:
+            provider, _, model = requested.partition("/")
+            if provider in registry:
+                return provider, model
+        if self.default_provider:
+            return self.default_provider, requested
+        raise HTTPError(404, f"Unknown model '{requested}'; use a provider name from /v1/models", "model_not_found")
+
+    async def chat_completion(self, payload, responder):
+        if not isinstance(payload, dict) or not isinstance(payload.get("messages"), list) or not payload["messages"]:
+            raise HTTPError(400, "'messages' must be a non-empty list")
+        messages = [chat_message(m) for m in payload["messages"]]
+        provider_name, model = self.resolve_model(payload.get("model"))
+        stream = bool(payload.get("stream"))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        output = StreamOutput(responder, completion_id, created, payload.get("model") or provider_name) if stream else None
+        try:
+            winner, response, cached = await self.engine.complete(
+                provider_name, messages, output, stream=stream, failover=self.failover, model=model
+            )
+        except Exception as e:
+            if output and output.started:
+                # Headers are out: report the error as the last event and
+                # end the stream without [DONE], so clients see it failed
+                responder.event(json.dumps({"error": {
+                    "message": f"{type(e).__name__}: {e}", "type": "provider_error", "code": 502,
+                }}))
+                await responder.close_events()
+                responder.keep_alive = False
+                return
+            raise HTTPError(502, f"{type(e).__name__}: {e}", "provider_error")
+        if stream:
+            output.reply_start(winner)
+            await output.finish()
+            return
+        prompt_tokens = sum(estimate_tokens(m) for m in messages)
+        completion_tokens = estimate_tokens({"content": response})
+        await responder.json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": payload.get("model") or winner,
+            "provider": winner,
+            "cached": cached,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": response}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+# Entry point for 'g4fchatplus.py serve ...'
+def serve_main(argv, engine):
+    parser = argparse.ArgumentParser(prog="g4fchatplus.py serve", description="Serve an OpenAI-compatible API.")
+    parser.add_argument("--host", default=SERVE_HOST)
+    parser.add_argument("--port", type=int, default=SERVE_PORT)
+    parser.add_argument("--provider", help="provider used when a request's model is not a provider name")
+    parser.add_argument("--failover", type=int, default=1, metavar="N", help="providers to try per request")
+    parser.add_argument("--fake", action="store_true", help="add the benchmark's fake provider, for offline testing")
+    parser.add_argument("--no-warm", action="store_true", help="do not warm the cache for the custom prompts")
+    args = parser.parse_args(argv)
+
+    if args.fake:
+        from g4fbench import register_fake_provider
+        register_fake_provider(engine.registry)
+    if args.provider and args.provider not in engine.registry:
+        parser.error(f"unknown provider '{args.provider}'")
+
+    async def serve():
+        server = await ChatServer(engine, args.provider, args.failover).start(args.host, args.port)
+        if not args.no_warm:
+            engine.warmer = CacheWarmer(engine)
+            engine.warmer.start()
+        print(f"Serving on http://{args.host}:{args.port}/v1 ({len(engine.registry)} providers)", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
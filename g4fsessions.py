@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import re
+import time
+from g4fstate import JsonFile
+
+# Directory for chat journals and their index
+SESSIONS_DIR = "sessions"
+
+# Bytes read per step when scanning a journal backwards
+TAIL_BLOCK_SIZE = 64 * 1024
+
+# Journal file name for a chat
+def journal_name(chat_name):
+    slug = re.sub(r"[^\w.-]", "_", chat_name)[:40]
+    digest = hashlib.sha1(chat_name.encode("utf-8")).hexdigest()[:8]
+    return f"{slug}-{digest}.jsonl"
+
+# Persistent chats: one append-only journal per chat plus a compact index.
+#
+# Every finished turn is appended to "<chat>.jsonl" as it happens.  The index
+# ("index.json") keeps each chat's provider, turn count, journal size and
+# the offsets of its pinned messages and latest summary, so listing chats
+# reads one small file and resuming a chat reads only those records plus
+# the tail of the journal that fits the context budget.  If the index is
+# behind its journal after a crash, the missing records are replayed; a torn
+# record, or a user message whose reply never made it to disk, is cut off.
+#
+# Several processes may share the directory.  Every change happens under
+# the index's file lock against the latest index, and the index is replaced
+# atomically, so readers never wait and see other processes' chats as soon
+# as they are saved.
+class SessionStore:
+    def __init__(self, directory=None):
+        self.directory = directory or SESSIONS_DIR
+        self.index_file = os.path.join(self.directory, "index.json")
+        os.makedirs(self.directory, exist_ok=True)
+        self.file = JsonFile(self.index_file)
+        with self.file.lock:
+            for name in list(self.index):
+                self._recover(name)
+
+    # The latest index: {chat name: entry}
+    @property
+    def index(self):
+        return self.file.load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, self.index[name]["journal"])
+
+    def _save_index(self):
+        self.file.save()
+
+    # Bring an index entry in line with its journal
+    def _recover(self, name):
+        entry = self.index[name]
+        path = self._path(name)
+        if not os.path.exists(path):
+            del self.index[name]
+            self._save_index()
+            return
+        size = os.path.getsize(path)
+        if size == entry["size"]:
+            return
+        if size < entry["size"]:
+            # Journal lost data the index knew about; rebuild from scratch
+            entry.update(size=0, turns=0, messages=0, pinned=[], summary=None)
+        good = entry["size"]
+        dangling = None
+        with open(path, 'rb') as f:
+            f.seek(good)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self._account(entry, record, good)
+                dangling = good if record.get("role") == "user" else None
+                good += len(line)
+        if dangling is not None:
+            entry["messages"] -= 1
+            if dangling in entry["pinned"]:
+                entry["pinned"].remove(dangling)
+            good = dangling
+        if good != size:
+            with open(path, 'r+b') as f:
+                f.truncate(good)
+        entry["size"] = good
+        self._save_index()
+
+    # Update an index entry for a record written at offset
+    def _account(self, entry, record, offset):
+        if record.get("type") == "summary":
+            entry["summary"] = offset
+        elif record.get("type") == "provider":
+            entry["provider"] = record["provider"]
+        else:
+            entry["messages"] += 1
+            if record.get("role") == "assistant":
+                entry["turns"] += 1
+            if record.get("pinned"):
+                entry["pinned"].append(offset)
+
+    def _append(self, name, records):
+        data = b"".join(json.dumps(record).encode("utf-8") + b"\n" for record in records)
+        with self.file.lock:
+            entry = self.index[name]
+            with open(self._path(name), 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            offset = entry["size"]
+            for record, line in zip(records, data.splitlines(keepends=True)):
+                self._account(entry, record, offset)
+                offset += len(line)
+            entry["size"] = offset
+            entry["updated"] = time.time()
+            self._save_index()
+
+    # Chats as {name: index entry}, newest first
+    def list(self):
+        return dict(sorted(self.index.items(), key=lambda item: -item[1].get("updated", 0)))
+
+    # Index entry for one chat
+    def info(self, name):
+        return self.index[name]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def create(self, name, provider):
+        with self.file.lock:
+            # Another process may have created it first
+            if name in self.index:
+                return
+            self.index[name] = {
+                "journal": journal_name(name), "provider": provider, "turns": 0, "messages": 0,
+                "size": 0, "pinned": [], "summary": None, "updated": time.time(),
+            }
+            open(self._path(name), 'wb').close()
+            self._save_index()
+
+    def set_provider(self, name, provider):
+        if self.index[name]["provider"] != provider:
+            self._append(name, [{"type": "provider", "provider": provider}])
+
+    # Append a finished turn: the user message (pinned or not) and the reply
+    def append_turn(self, name, user_message, reply, pinned=False):
+        now = time.time()
+        user_record = dict(user_message, at=now)
+        if pinned:
+            user_record["pinned"] = True
+        self._append(name, [user_record, dict(reply, at=now)])
+
+    def append_summary(self, name, summary):
+        self._append(name, [{"type": "summary", "text": summary, "at": time.time()}])
+
+    def delete(self, name):
+        with self.file.lock:
+            entry = self.index.pop(name, None)
+            if entry:
+                try:
+                    os.remove(os.path.join(self.directory, entry["journal"]))
+                except OSError:
+                    pass
+                self._save_index()
+
+    # Every record of a chat's journal, oldest first
+    def records(self, name):
+        # Records past the indexed size may still be being written
+        size = self.index[name]["size"]
+        offset = 0
+        with open(self._path(name), 'rb') as f:
+            for line in f:
+                offset += len(line)
+                if offset > size:
+                    break
+                yield json.loads(line)
+
+    def _read_record(self, f, offset):
+        f.seek(offset)
+        return json.loads(f.readline())
+
+    # What a resumed chat needs: (pinned messages before the tail, summary,
+    # tail messages), reading at most about max_bytes from the end
+    def load(self, name, max_bytes):
+        entry = self.index[name]
+        path = self._path(name)
+        with open(path, 'rb') as f:
+            size = entry["size"]
+            start = size
+            data = b""
+            # Walk back block by block until enough whole lines are in hand,
+            # and at least the whole last record however large it is
+            while start > 0 and (size - start < max_bytes or data.rfind(b"\n", 0, len(data) - 1) < 0):
+                step = min(TAIL_BLOCK_SIZE, start)
+                start -= step
+                f.seek(start)
+                data = f.read(step) + data
+            last = data.rfind(b"\n", 0, len(data) - 1) + 1
+            begin = min(max(0, len(data) - max_bytes), last)
+            if start + begin > 0 and not (begin > 0 and data[begin - 1:begin] == b"\n"):
+                # Drop the partial line the window starts in
+                begin = data.find(b"\n", begin) + 1
+            start += begin
+            data = data[begin:]
+            tail = []
+            offset = start
+            for line in data.splitlines(keepends=True):
+                record = json.loads(line)
+                if "role" in record:
+                    tail.append((offset, record))
+                offset += len(line)
+            pinned = [
+                self._read_record(f, offset) for offset in entry["pinned"] if offset < start
+            ]
+            summary = self._read_record(f, entry["summary"])["text"] if entry["summary"] is not None else None
+        return pinned, summary, tail
@@ -0,0 +1,165 @@
+import json
+import os
+import threading
+from collections.abc import MutableMapping
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Exclusive lock shared by every process on the host, held on "<path>".
+#
+# Reentrant within a process: threads queue on an RLock and only the
+# outermost acquisition takes the OS lock (flock, or msvcrt.locking on
+# Windows).  The lock file is separate from the data it guards, so the data
+# can be swapped with os.replace() while the lock is held.
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            try:
+                if self.file is None:
+                    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                    self.file = open(self.path, "a+b")
+                if fcntl is not None:
+                    fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+                else:
+                    self.file.seek(0)
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+            except BaseException:
+                self.lock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.lock.release()
+        return False
+
+    def close(self):
+        with self.lock:
+            if self.file is not None and self.depth == 0:
+                self.file.close()
+                self.file = None
+
+# Replace a file's contents in one step: readers see the old file or the
+# new one, never a mix.  The temporary name is unique to the writer, so
+# concurrent writers never share one.
+def write_atomic(path, data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# Identity of a file's current contents, or None when it does not exist.
+# Every write is an atomic rename, so a new inode means new contents.
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+# A JSON file shared between processes.
+#
+# load() returns the parsed contents, read again only when the file's
+# signature changed, so readers cost one stat() and never wait for writers.
+# update() runs a read-modify-write under the file's lock against the
+# latest contents and replaces the file atomically, so concurrent updates
+# from several processes are all kept.  Only a missing file reads as the
+# default: one that cannot be parsed is moved to "<path>.corrupt" before
+# update() writes a new one, never saved over.
+class JsonFile:
+    def __init__(self, path, default=dict, indent=None):
+        self.path = path
+        self.default = default
+        self.indent = indent
+        self.lock = FileLock(path + ".lock")
+        self.signature = None
+        self.data = default()
+
+    # With strict, errors reading the file are raised instead of the last
+    # contents read being returned
+    def load(self, strict=False):
+        signature = file_signature(self.path)
+        if signature != self.signature:
+            data = self.default()
+            if signature is not None:
+                try:
+                    with open(self.path, 'r') as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    if strict:
+                        raise
+                    # Written in place by an older version, or corrupt; try
+                    # again next time and leave it to update()
+                    return self.data
+            self.data, self.signature = data, signature
+        return self.data
+
+    # Write the loaded contents; the caller holds the lock
+    def save(self):
+        try:
+            write_atomic(self.path, json.dumps(self.data, indent=self.indent))
+        except BaseException:
+            self.signature = None
+            raise
+        self.signature = file_signature(self.path)
+
+    # Apply fn to the latest contents and save them; returns fn's result
+    def update(self, fn):
+        with self.lock:
+            try:
+                data = self.load(strict=True)
+            except ValueError:
+                os.replace(self.path, self.path + ".corrupt")
+                data = self.load(strict=True)
+            result = fn(data)
+            self.save()
+            return result
+
+# A dict kept in a JsonFile, e.g. api_keys.json: reads see other processes'
+# changes, and every assignment or deletion is saved at once without
+# overwriting theirs
+class SharedDict(MutableMapping):
+    def __init__(self, path, indent=2):
+        self.file = JsonFile(path, indent=indent)
+
+    def __getitem__(self, key):
+        return self.file.load()[key]
+
+    def __setitem__(self, key, value):
+        self.file.update(lambda data: data.__setitem__(key, value))
+
+    def __delitem__(self, key):
+        def delete(data):
+            del data[key]
+        self.file.update(delete)
+
+    def __iter__(self):
+        return iter(list(self.file.load()))
+
+    def __len__(self):
+        return len(self.file.load())
+
+    def __repr__(self):
+        return f"SharedDict({self.file.path!r})"
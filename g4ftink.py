@@ -1,17 +1,31 @@
-import g4f
-import sys
-import inspect
-import json
-import os
-import pickle
-from datetime import datetime
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
 import threading
-import queue
-
-# Dictionary to store available providers
-available_providers = {}
+import time
+from collections import deque
+from g4fcore import ChatEngine, EngineThread, TurnOutput
+from g4fregistry import load_providers, parse_filter
+from g4fview import TranscriptView
+from g4fhealth import probe_providers as probe_all, rank_providers
+from g4fsessions import SessionStore
+from g4fsearch import open_search_index
+from g4fstate import SharedDict
+from g4fmetrics import get_metrics
+from g4fprofile import capture, enable_from_argv, phase
+from g4fwarm import CacheWarmer
+from g4fworkflow import describe_prompt, parse_prompt_text
+
+# --profile writes profiles of startup, discovery and every turn to profiles/
+enable_from_argv()
+
+# Available providers, from the cached provider manifest
+with capture("discovery"):
+    available_providers = load_providers()
+
+# Streamed tokens are passed to the GUI in chunks of at least this many
+# characters, or at least this often
+STREAM_FLUSH_CHARS = 80
+STREAM_FLUSH_INTERVAL = 0.05
 
 # File to store API keys
 API_KEYS_FILE = "api_keys.json"
@@ -19,78 +33,83 @@ API_KEYS_FILE = "api_keys.json"
 # File to store custom prompts
 CUSTOM_PROMPTS_FILE = "custom_prompts.json"
 
-# Directory for caching
-CACHE_DIR = "cache"
+# Hands output from worker threads to the Tk thread.  put() is safe from any
+# thread; the first put after a drain wakes the Tk loop with a virtual event,
+# later ones just queue up, so a burst of output costs one wakeup and is
+# inserted into the widget in one go.
+class OutputPump:
+    def __init__(self):
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.widget = None
+        self.pending = False
+
+    # Start delivering <<ChatOutput>> events to the widget
+    def attach(self, widget, handler):
+        widget.bind("<<ChatOutput>>", lambda event: handler())
+        with self.lock:
+            self.widget = widget
+        self._wake()
+
+    def put(self, item):
+        with self.lock:
+            self.items.append(item)
+        self._wake()
+
+    def _wake(self):
+        with self.lock:
+            if self.pending or self.widget is None or not self.items:
+                return
+            self.pending = True
+        try:
+            self.widget.event_generate("<<ChatOutput>>", when="tail")
+        except (tk.TclError, RuntimeError):
+            # The GUI is gone or shutting down
+            with self.lock:
+                self.pending = False
+
+    # Take everything queued so far
+    def drain(self):
+        with self.lock:
+            self.pending = False
+            items = list(self.items)
+            self.items.clear()
+        return items
 
 # Global variables for GUI
 root = None
 chat_output = None
+transcript = None
 user_input = None
 send_button = None
 provider_var = None
 chat_name_var = None
+stream_only_var = None
+no_auth_var = None
+search_var = None
 current_chat = None
-input_queue = queue.Queue()
-output_queue = queue.Queue()
+output_queue = OutputPump()
 
-# Load API keys from file
-def load_api_keys():
-    if os.path.exists(API_KEYS_FILE):
-        with open(API_KEYS_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+# Shared conversation engine and the background thread running its event loop
+with capture("startup"):
+    session_store = SessionStore()
+    engine = ChatEngine(available_providers, store=session_store, search=open_search_index(session_store))
+engine_thread = None
 
-# Save API keys to file
-def save_api_keys(api_keys):
-    with open(API_KEYS_FILE, 'w') as f:
-        json.dump(api_keys, f, indent=2)
+# API keys, shared with other running instances: changes are saved as
+# they are made and other instances' changes are seen on the next read
+def load_api_keys():
+    return SharedDict(API_KEYS_FILE)
 
-# Load custom prompts from file
+# Custom prompts, shared the same way
 def load_custom_prompts():
-    if os.path.exists(CUSTOM_PROMPTS_FILE):
-        with open(CUSTOM_PROMPTS_FILE, 'r') as f:
-            return json.load(f)
-    return {}
-
-# Save custom prompts to file
-def save_custom_prompts(custom_prompts):
-    with open(CUSTOM_PROMPTS_FILE, 'w') as f:
-        json.dump(custom_prompts, f, indent=2)
-
-# Cache function
-def cache_response(provider, query, response):
-    if not os.path.exists(CACHE_DIR):
-        os.makedirs(CACHE_DIR)
-    cache_file = os.path.join(CACHE_DIR, f"{provider}_cache.pkl")
-    cache = {}
-    if os.path.exists(cache_file):
-        with open(cache_file, 'rb') as f:
-            cache = pickle.load(f)
-    cache[query] = response
-    with open(cache_file, 'wb') as f:
-        pickle.dump(cache, f)
-
-# Get cached response
-def get_cached_response(provider, query):
-    cache_file = os.path.join(CACHE_DIR, f"{provider}_cache.pkl")
-    if os.path.exists(cache_file):
-        with open(cache_file, 'rb') as f:
-            cache = pickle.load(f)
-        return cache.get(query)
-    return None
-
-# Dynamically get all provider classes from g4f.Provider
-for name, obj in inspect.getmembers(g4f.Provider):
-    if inspect.isclass(obj) and issubclass(obj, g4f.Provider.BaseProvider) and obj != g4f.Provider.BaseProvider:
-        try:
-            if obj.working:
-                available_providers[name] = obj
-        except AttributeError:
-            pass
+    return SharedDict(CUSTOM_PROMPTS_FILE)
 
 # Function to display available providers
 def display_providers():
-    provider_list = list(available_providers.keys())
+    # The checkboxes stand for the CLI's 'filter' words
+    words = [word for word, var in (("stream", stream_only_var), ("noauth", no_auth_var)) if var.get()]
+    provider_list = rank_providers(available_providers.filter(**parse_filter(words)))
     provider_var.set(provider_list[0] if provider_list else "No providers available")
     provider_menu['menu'].delete(0, 'end')
     for provider in provider_list:
@@ -98,7 +117,7 @@ def display_providers():
 
 # Function to manage API keys
 def manage_api_keys():
-    api_keys = load_api_keys()
+    api_keys = engine.api_keys
     api_key_window = tk.Toplevel(root)
     api_key_window.title("API Key Management")
 
@@ -114,7 +133,6 @@ def manage_api_keys():
         key = key_entry.get()
         if provider and key:
             api_keys[provider] = key
-            save_api_keys(api_keys)
             provider_entry.delete(0, tk.END)
             key_entry.delete(0, tk.END)
             manage_api_keys()  # Refresh the window
@@ -128,7 +146,7 @@ def manage_api_keys():
 
 # Function to manage custom prompts
 def manage_custom_prompts():
-    custom_prompts = load_custom_prompts()
+    custom_prompts = engine.custom_prompts
     prompt_window = tk.Toplevel(root)
     prompt_window.title("Custom Prompts Management")
 
@@ -137,14 +155,17 @@ def manage_custom_prompts():
 
     for i, (name, prompt) in enumerate(custom_prompts.items(), start=1):
         ttk.Label(prompt_window, text=name).grid(row=i, column=0, padx=5, pady=2)
-        ttk.Label(prompt_window, text=prompt[:50] + "...").grid(row=i, column=1, padx=5, pady=2)
+        ttk.Label(prompt_window, text=describe_prompt(prompt)[:50] + "...").grid(row=i, column=1, padx=5, pady=2)
 
     def add_custom_prompt():
         name = name_entry.get()
         prompt = prompt_entry.get()
         if name and prompt:
-            custom_prompts[name] = prompt
-            save_custom_prompts(custom_prompts)
+            try:
+                custom_prompts[name] = parse_prompt_text(name, prompt)
+            except ValueError as e:
+                messagebox.showerror("Invalid workflow", str(e), parent=prompt_window)
+                return
             name_entry.delete(0, tk.END)
             prompt_entry.delete(0, tk.END)
             manage_custom_prompts()  # Refresh the window
@@ -158,87 +179,148 @@ def manage_custom_prompts():
 
 # Function to display provider information
 def display_provider_info(provider_name):
-    provider = available_providers[provider_name]
+    provider = available_providers.info(provider_name)
     info = f"Provider Information for {provider_name}:\n"
-    info += f"Working: {provider.working}\n"
-    info += f"Supports Stream: {provider.supports_stream}\n"
-    info += f"Needs Auth: {provider.needs_auth}\n"
-    if hasattr(provider, 'params'):
+    info += f"Working: {provider['working']}\n"
+    info += f"Supports Stream: {provider['supports_stream']}\n"
+    info += f"Needs Auth: {provider['needs_auth']}\n"
+    if 'params' in provider:
         info += "Parameters:\n"
-        for param, value in provider.params.items():
-            info += f" {param}: {value}\n"
+        if isinstance(provider['params'], dict):
+            for param, value in provider['params'].items():
+                info += f" {param}: {value}\n"
+        else:
+            info += f" {provider['params']}\n"
     messagebox.showinfo("Provider Information", info)
 
+# Milliseconds between refreshes of the statistics window
+STATS_REFRESH_MS = 2000
+
+# Function to show live request statistics
+def show_statistics():
+    stats_window = tk.Toplevel(root)
+    stats_window.title("Statistics")
+    stats_text = scrolledtext.ScrolledText(stats_window, wrap=tk.WORD, width=100, height=15)
+    stats_text.pack(padx=10, pady=10)
+    ttk.Button(stats_window, text="Export", command=lambda: get_metrics().export()).pack(pady=5)
+
+    def refresh():
+        if not stats_window.winfo_exists():
+            return
+        stats_text.config(state=tk.NORMAL)
+        stats_text.delete("1.0", tk.END)
+        stats_text.insert(tk.END, "\n".join(get_metrics().describe() + engine.warmer.describe()))
+        stats_text.config(state=tk.DISABLED)
+        stats_window.after(STATS_REFRESH_MS, refresh)
+
+    refresh()
+
+# Collects streamed tokens and hands them to output_queue in coalesced chunks,
+# so the text widget is not updated once per token
+class StreamBuffer:
+    def __init__(self, prefix):
+        self.parts = [prefix]
+        self.size = len(prefix)
+        self.last_flush = time.monotonic()
+
+    def add(self, chunk):
+        self.parts.append(chunk)
+        self.size += len(chunk)
+        if self.size >= STREAM_FLUSH_CHARS or time.monotonic() - self.last_flush >= STREAM_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self, end=""):
+        text = "".join(self.parts) + end
+        if text:
+            output_queue.put(("stream", text))
+        self.parts = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+
+# Sends a turn's output to output_queue for the GUI
+class ChatOutput(TurnOutput):
+    def __init__(self, session):
+        self.session = session
+        self.buffer = None
+
+    def user(self, text):
+        output_queue.put(f"You: {text}")
+
+    def line(self, text):
+        output_queue.put(text)
+
+    def reply_start(self, label):
+        self.buffer = StreamBuffer(f"{label}: ")
+
+    def chunk(self, text):
+        self.buffer.add(text)
+
+    def reply_end(self):
+        self.buffer.flush("\n")
+
+    def error(self, error):
+        error_message = f"An error occurred: {str(error)}\n"
+        error_message += "This could be due to provider issues, rate limiting, or missing API key.\n"
+        error_message += "You can try again, switch providers, or check your API key."
+        output_queue.put(error_message)
+
+    # Runs on the engine's loop after the chat's worker handled a command;
+    # handled on the Tk thread by handle_signal()
+    def signal(self, signal):
+        output_queue.put(("signal", (self.session, signal)))
+
+# Act on a signal from a chat's worker
+def handle_signal(session, signal):
+    if signal in ('exit', 'switch'):
+        if signal == 'switch':
+            output_queue.put("Please select a new provider and start a new chat.")
+        if current_chat is session:
+            leave_chat()
+    elif signal == 'info':
+        display_provider_info(session.provider_name)
+
+# Stop the current chat's worker; the chat stays saved and can be resumed
+def leave_chat():
+    global current_chat
+    if current_chat is not None:
+        engine_thread.submit(engine.close_session(current_chat.name))
+        current_chat = None
+
 # Function to start a conversation with the selected provider
 def start_conversation():
     global current_chat
-    api_keys = load_api_keys()
-    custom_prompts = load_custom_prompts()
     provider_name = provider_var.get()
     chat_name = chat_name_var.get()
     
     if not chat_name:
         messagebox.showerror("Error", "Please enter a chat name.")
         return
-
-    current_chat = chat_name
-    provider = available_providers[provider_name]
+    if current_chat is not None and current_chat.name != chat_name:
+        leave_chat()
+
+    # Opening may read the chat's journal; do it on the engine's loop
+    current_chat = engine_thread.run(engine.open_session, chat_name, provider_name)
+    turns = engine.store.info(chat_name)["turns"]
+    if turns:
+        output_queue.put(f"\nResuming chat '{chat_name}' ({turns} turns, {len(current_chat.history)} messages loaded).")
     output_queue.put(f"\nConversing with {provider_name} in chat '{chat_name}'...")
-    history = []
 
-    while True:
-        try:
-            user_input = input_queue.get(timeout=0.1)
-        except queue.Empty:
-            continue
+# Function to probe all providers in the background, then re-rank the provider menu
+def probe_providers():
+    def show(result):
+        status = "ok" if result["ok"] else f"failed ({result['error']})"
+        output_queue.put(f"Probe {result['provider']}: {status} in {result['latency']:.1f}s")
 
-        if user_input.lower() == 'exit':
-            break
-        if user_input.lower() == 'switch':
-            output_queue.put("Please select a new provider and start a new chat.")
-            break
-        if user_input.lower() == 'info':
-            display_provider_info(provider_name)
-            continue
-        if user_input.lower().startswith('use prompt '):
-            prompt_name = user_input[11:].strip()
-            if prompt_name in custom_prompts:
-                user_input = custom_prompts[prompt_name]
-                output_queue.put(f"Using custom prompt: {user_input}")
-            else:
-                output_queue.put(f"Custom prompt '{prompt_name}' not found.")
-            continue
-
-        # Log user input in chat output
-        output_queue.put(f"You: {user_input}")
-
-        history.append({"role": "user", "content": user_input})
-        cached_response = get_cached_response(provider_name, user_input)
-        if cached_response:
-            output_queue.put(f"{provider_name} (cached): {cached_response}")
-            history.append({"role": "assistant", "content": cached_response})
-            continue
+    async def probe():
+        await probe_all(available_providers, api_keys=engine.api_keys, on_result=show)
+        output_queue.put(("providers", None))
 
-        try:
-            api_key = api_keys.get(provider_name)
-            response = g4f.ChatCompletion.create(
-                model=None,
-                provider=provider,
-                messages=history,
-                api_key=api_key
-            )
-            output_queue.put(f"{provider_name}: {response}")
-            history.append({"role": "assistant", "content": response})
-            cache_response(provider_name, user_input, response)
-        except Exception as e:
-            error_message = f"An error occurred: {str(e)}\n"
-            error_message += "This could be due to provider issues, rate limiting, or missing API key.\n"
-            error_message += "You can try again, switch providers, or check your API key."
-            output_queue.put(error_message)
+    output_queue.put(f"\nProbing {len(available_providers)} providers...")
+    engine_thread.submit(probe())
 
 # GUI setup
 def setup_gui():
-    global root, chat_output, user_input, send_button, provider_var, chat_name_var, provider_menu
+    global root, chat_output, transcript, user_input, send_button, provider_var, chat_name_var, provider_menu, stream_only_var, no_auth_var, search_var
 
     root = tk.Tk()
     root.title("G4F Advanced Chat")
@@ -250,6 +332,10 @@ def setup_gui():
     provider_var = tk.StringVar(root)
     provider_menu = ttk.OptionMenu(provider_frame, provider_var, "")
     provider_menu.pack(side=tk.LEFT)
+    stream_only_var = tk.BooleanVar(root)
+    ttk.Checkbutton(provider_frame, text="Streaming", variable=stream_only_var, command=display_providers).pack(side=tk.LEFT, padx=5)
+    no_auth_var = tk.BooleanVar(root)
+    ttk.Checkbutton(provider_frame, text="No auth", variable=no_auth_var, command=display_providers).pack(side=tk.LEFT)
 
     # Chat name entry
     chat_name_frame = ttk.Frame(root)
@@ -259,13 +345,14 @@ def setup_gui():
     ttk.Entry(chat_name_frame, textvariable=chat_name_var).pack(side=tk.LEFT)
 
     # Start chat button
-    start_button = ttk.Button(root, text="Start Chat", command=start_chat_thread)
+    start_button = ttk.Button(root, text="Start Chat", command=start_conversation)
     start_button.pack(pady=5)
 
     # Chat output
     chat_output = scrolledtext.ScrolledText(root, wrap=tk.WORD, width=80, height=20)
     chat_output.pack(padx=10, pady=10)
     chat_output.config(state=tk.DISABLED)
+    transcript = TranscriptView(chat_output)
 
     # User input
     input_frame = ttk.Frame(root)
@@ -274,6 +361,17 @@ def setup_gui():
     user_input.pack(side=tk.LEFT, padx=5)
     send_button = ttk.Button(input_frame, text="Send", command=send_message)
     send_button.pack(side=tk.LEFT)
+    ttk.Button(input_frame, text="Stop", command=stop_reply).pack(side=tk.LEFT, padx=5)
+
+    # Search over past chats and cached replies
+    search_frame = ttk.Frame(root)
+    search_frame.pack(pady=5)
+    ttk.Label(search_frame, text="Search history:").pack(side=tk.LEFT)
+    search_var = tk.StringVar(root)
+    search_entry = ttk.Entry(search_frame, textvariable=search_var, width=50)
+    search_entry.pack(side=tk.LEFT, padx=5)
+    search_entry.bind('<Return>', lambda event: search_history())
+    ttk.Button(search_frame, text="Search", command=search_history).pack(side=tk.LEFT)
 
     # Menu bar
     menubar = tk.Menu(root)
@@ -284,6 +382,8 @@ def setup_gui():
     menubar.add_cascade(label="File", menu=file_menu)
     file_menu.add_command(label="Manage API Keys", command=manage_api_keys)
     file_menu.add_command(label="Manage Custom Prompts", command=manage_custom_prompts)
+    file_menu.add_command(label="Probe Providers", command=probe_providers)
+    file_menu.add_command(label="Statistics", command=show_statistics)
     file_menu.add_separator()
     file_menu.add_command(label="Exit", command=root.quit)
 
@@ -294,36 +394,75 @@ def setup_gui():
     root.bind('<Control-d>', lambda event: return_to_main_menu())
 
 def return_to_main_menu():
-    global current_chat
-    current_chat = None
+    leave_chat()
     output_queue.put("\nReturned to main menu. Please start a new chat.")
 
 def send_message():
     message = user_input.get()
     if message:
         user_input.delete(0, tk.END)
-        input_queue.put(message)
+        if current_chat is None:
+            output_queue.put("Please start a chat first.")
+            return
+        engine_thread.call(engine.post, current_chat.name, message, ChatOutput(current_chat))
+
+# Show past turns and cached replies matching the search box
+def search_history():
+    query = search_var.get().strip()
+    if not query:
+        return
+
+    def search():
+        output_queue.put(f"\nSearch results for '{query}':")
+        for line in engine.search_lines(query):
+            output_queue.put(line)
 
-def start_chat_thread():
-    conversation_thread = threading.Thread(target=start_conversation, daemon=True)
-    conversation_thread.start()
+    engine_thread.call(search)
 
+# Cancel the reply in progress in the current chat
+def stop_reply():
+    if current_chat is not None:
+        engine_thread.call(current_chat.cancel)
+
+# Append everything the pump has collected to the transcript in one piece
 def update_chat_output():
-    while True:
-        try:
-            message = output_queue.get_nowait()
-            chat_output.config(state=tk.NORMAL)
-            chat_output.insert(tk.END, message + "\n")
-            chat_output.see(tk.END)
-            chat_output.config(state=tk.DISABLED)
-        except queue.Empty:
-            break
-    root.after(100, update_chat_output)
+    texts = []
+    for message in output_queue.drain():
+        # Streamed chunks are inserted as-is, everything else is a line
+        if isinstance(message, tuple):
+            kind, message = message
+            if kind == "providers":
+                display_providers()
+                continue
+            if kind == "signal":
+                handle_signal(*message)
+                continue
+        else:
+            message += "\n"
+        texts.append(message)
+    with phase("render"):
+        transcript.append("".join(texts))
 
 def main():
-    setup_gui()
-    update_chat_output()
+    global engine_thread
+    with capture("gui"):
+        engine_thread = EngineThread()
+        setup_gui()
+    # Keys and prompts are read through as other instances change them
+    engine.api_keys = load_api_keys()
+    engine.custom_prompts = load_custom_prompts()
+    # Warm the cache for the custom prompts now and every WARM_INTERVAL
+    engine.warmer = CacheWarmer(engine)
+    engine_thread.call(engine.warmer.start)
+    output_queue.attach(root, update_chat_output)
+    root.protocol("WM_DELETE_WINDOW", root.quit)
     root.mainloop()
+    # Let every chat worker finish cancelling before the loop stops
+    try:
+        engine_thread.submit(engine.shutdown()).result(timeout=2)
+    except Exception:
+        pass
+    engine_thread.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,142 @@
+import tempfile
+import tkinter as tk
+
+# Most characters kept in the text widget at once
+VIEW_MAX_CHARS = 200000
+
+# Characters paged back in when scrolling past either end of the window
+VIEW_PAGE_CHARS = 50000
+
+# A bounded, virtualized transcript on top of a Text widget.
+#
+# Every appended piece of text is written to an anonymous segment file and
+# indexed by offset, so the full transcript is always on disk.  The widget
+# only holds a contiguous window of pieces [first, last) of at most
+# VIEW_MAX_CHARS characters: appends at the tail push the oldest pieces out
+# of the widget, and scrolling against the top or bottom edge pages the
+# neighbouring pieces back in from the segment file.  An append costs one
+# file write plus one insert (and sometimes one delete at the top), however
+# long the conversation has run.
+class TranscriptView:
+    def __init__(self, widget, max_chars=None, page_chars=None):
+        self.widget = widget
+        self.max_chars = max_chars or VIEW_MAX_CHARS
+        self.page_chars = page_chars or VIEW_PAGE_CHARS
+        self.segment = tempfile.TemporaryFile()
+        # (byte offset, byte length, char length) of every piece
+        self.pieces = []
+        self.first = 0
+        self.last = 0
+        self.chars = 0
+        self.paging = False
+        self.scrollbar = getattr(widget, "vbar", None)
+        widget.config(yscrollcommand=self._on_scroll)
+
+    def append(self, text):
+        if not text:
+            return
+        data = text.encode("utf-8")
+        self.segment.seek(0, 2)
+        self.pieces.append((self.segment.tell(), len(data), len(text)))
+        self.segment.write(data)
+        # While the user is paged back into history new text only goes to disk
+        if self.last != len(self.pieces) - 1:
+            return
+        at_bottom = self.widget.yview()[1] >= 0.999
+        self._edit(lambda: self.widget.insert(tk.END, text))
+        self.last += 1
+        self.chars += len(text)
+        self._trim_top()
+        if at_bottom:
+            self.widget.see(tk.END)
+
+    def _read(self, index):
+        offset, length, _ = self.pieces[index]
+        self.segment.seek(offset)
+        return self.segment.read(length).decode("utf-8")
+
+    def _edit(self, change):
+        self.widget.config(state=tk.NORMAL)
+        change()
+        self.widget.config(state=tk.DISABLED)
+
+    # Drop pieces from the top of the widget until it fits again
+    def _trim_top(self):
+        drop = 0
+        while self.chars > self.max_chars and self.last - self.first > 1:
+            drop += self.pieces[self.first][2]
+            self.chars -= self.pieces[self.first][2]
+            self.first += 1
+        if drop:
+            self._keep_view(lambda: self.widget.delete("1.0", f"1.0 + {drop} chars"))
+
+    # Drop pieces from the bottom of the widget until it fits again
+    def _trim_bottom(self):
+        drop = 0
+        while self.chars > self.max_chars and self.last - self.first > 1:
+            self.last -= 1
+            drop += self.pieces[self.last][2]
+            self.chars -= self.pieces[self.last][2]
+        if drop:
+            self._edit(lambda: self.widget.delete(f"end - {drop + 1} chars", "end - 1 chars"))
+
+    # Make a change above the visible text without moving what the user sees
+    def _keep_view(self, change):
+        self.widget.mark_set("view_top", "@0,0")
+        self.widget.mark_gravity("view_top", tk.LEFT)
+        self._edit(change)
+        self.widget.yview("view_top")
+
+    # Page older pieces in above the window
+    def page_up(self):
+        texts = []
+        size = 0
+        while self.first > 0 and size < self.page_chars:
+            self.first -= 1
+            texts.append(self._read(self.first))
+            size += self.pieces[self.first][2]
+        if not texts:
+            return
+        text = "".join(reversed(texts))
+        self.chars += size
+        self._keep_view(lambda: self.widget.insert("1.0", text))
+        self._trim_bottom()
+
+    # Page newer pieces in below the window
+    def page_down(self):
+        texts = []
+        size = 0
+        while self.last < len(self.pieces) and size < self.page_chars:
+            texts.append(self._read(self.last))
+            size += self.pieces[self.last][2]
+            self.last += 1
+        if not texts:
+            return
+        self.chars += size
+        self._edit(lambda: self.widget.insert(tk.END, "".join(texts)))
+        self._trim_top()
+
+    def _on_scroll(self, top, bottom):
+        if self.scrollbar is not None:
+            self.scrollbar.set(top, bottom)
+        if self.paging:
+            return
+        if float(top) <= 0.0 and self.first > 0:
+            self._schedule(self.page_up)
+        elif float(bottom) >= 1.0 and self.last < len(self.pieces):
+            self._schedule(self.page_down)
+
+    # Page after the current scroll event has been handled
+    def _schedule(self, page):
+        self.paging = True
+
+        def run():
+            try:
+                page()
+            finally:
+                self.paging = False
+
+        self.widget.after_idle(run)
+
+    def close(self):
+        self.segment.close()
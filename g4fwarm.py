@@ -0,0 +1,204 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from g4fcache import CACHE_DIR, cache_key, get_cached_response
+from g4fhealth import rank_providers
+from g4fschedule import BACKGROUND, get_scheduler, request_priority
+from g4fstate import JsonFile
+from g4fworkflow import is_workflow
+
+# File recording warmed entries and how often they were used
+WARM_FILE = os.path.join(CACHE_DIR, "warm.json")
+
+# Providers each custom prompt is warmed for
+WARM_PROVIDERS = 2
+
+# Warming calls in flight at once
+WARM_CONCURRENCY = 2
+
+# Provider calls one warming run may make
+WARM_BUDGET = 10
+
+# Seconds between scheduled warming runs
+WARM_INTERVAL = 6 * 3600
+
+# Seconds a warming call waits between checks while chats are busy
+WARM_IDLE_POLL = 1.0
+
+# Providers to warm for: those of the most recently used chats, then the
+# best ranked ones, skipping providers that need a key the user has not set
+def preferred_providers(engine, count=WARM_PROVIDERS):
+    names = []
+    if engine.store:
+        for info in engine.store.list().values():
+            if info["provider"] in engine.registry and info["provider"] not in names:
+                names.append(info["provider"])
+    for name in rank_providers(list(engine.registry)):
+        if name not in names and (not engine.registry.info(name).get("needs_auth") or name in engine.api_keys):
+            names.append(name)
+    return names[:count]
+
+# The messages a custom prompt is sent as when it opens a chat
+def prompt_messages(text):
+    return [{"role": "user", "content": text}]
+
+_warm_file = None
+
+def get_warm_file():
+    global _warm_file
+    if _warm_file is None:
+        os.makedirs(os.path.dirname(WARM_FILE) or ".", exist_ok=True)
+        _warm_file = JsonFile(WARM_FILE)
+    return _warm_file
+
+# Count a cache hit on a warmed entry in `file` (WARM_FILE by default).
+# The engine calls this on every cache hit, so hits are counted in
+# processes that do not warm themselves too, e.g. the CLI chat.
+def record_hit(provider, messages, model, file=None):
+    if model is not None or len(messages) != 1:
+        return
+    file = file or get_warm_file()
+    key = cache_key(provider, None, messages)
+    if key in file.load():
+        def count(entries):
+            if key in entries:
+                entries[key]["hits"] += 1
+        file.update(count)
+
+# Fills the response cache with replies to the custom prompts.
+#
+# A warming run looks up every custom prompt for each preferred provider
+# and fetches the ones the cache has no entry for: never warmed, expired,
+# evicted, or edited since.  Calls go through engine.complete() at
+# BACKGROUND priority, at most `concurrency` at a time and `budget` per
+# run, and each waits until no chat is sending and nothing is queued for
+# the provider, so warming only uses capacity the user is not using.
+# Warmed entries are the ones a chat opened with 'use prompt' finds; the
+# engine reports such hits through record_hit(), and the counts are kept
+# in WARM_FILE across runs and shared by every running instance.
+class CacheWarmer:
+    def __init__(self, engine, path=WARM_FILE):
+        self.engine = engine
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = JsonFile(path)
+        self.last_run = None
+        self.task = None
+
+    # cache key -> {"provider", "prompt", "warmed", "hits"}
+    @property
+    def entries(self):
+        return self.file.load()
+
+    # (provider, prompt name, text) for every plain custom prompt not in the
+    # cache; workflows need their variables and are left out
+    def stale(self, providers):
+        for name, text in self.engine.custom_prompts.items():
+            if is_workflow(text):
+                continue
+            for provider in providers:
+                if get_cached_response(provider, prompt_messages(text)) is None:
+                    yield provider, name, text
+
+    # Called by the engine on every cache hit
+    def hit(self, provider, messages, model):
+        record_hit(provider, messages, model, self.file)
+
+    # Whether a chat is sending or anything waits for the provider
+    def busy(self, provider):
+        if any(session.task for session in self.engine.sessions.values()):
+            return True
+        return get_scheduler().limiter(provider).queued() > 0
+
+    # Warm stale custom prompts once; returns the run's counts
+    async def run(self, providers=None, budget=WARM_BUDGET, concurrency=WARM_CONCURRENCY, on_result=None):
+        request_priority.set(BACKGROUND)
+        providers = providers or preferred_providers(self.engine)
+        stale = list(self.stale(providers))
+        stats = {"providers": providers, "stale": len(stale), "warmed": 0, "failed": 0,
+                 "over_budget": max(0, len(stale) - budget), "at": time.time()}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def warm(provider, name, text):
+            async with semaphore:
+                while self.busy(provider):
+                    await asyncio.sleep(WARM_IDLE_POLL)
+                messages = prompt_messages(text)
+                try:
+                    winner, _, _ = await self.engine.complete(provider, messages)
+                except Exception as e:
+                    stats["failed"] += 1
+                    result = {"provider": provider, "prompt": name, "ok": False, "error": str(e)}
+                else:
+                    key = cache_key(winner, None, messages)
+                    entry = {"provider": winner, "prompt": name, "warmed": time.time(), "hits": 0}
+
+                    def record(entries):
+                        entry["hits"] = entries.get(key, {}).get("hits", 0)
+                        entries[key] = entry
+                    self.file.update(record)
+                    stats["warmed"] += 1
+                    result = {"provider": winner, "prompt": name, "ok": True, "error": None}
+            if on_result:
+                on_result(result)
+
+        await asyncio.gather(*(warm(*item) for item in stale[:budget]))
+        self.last_run = stats
+        return stats
+
+    # Warm now and then every `interval` seconds until cancelled
+    async def schedule(self, interval=WARM_INTERVAL):
+        while True:
+            try:
+                await self.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+            await asyncio.sleep(interval)
+
+    # Start scheduled warming on the running loop
+    def start(self, interval=WARM_INTERVAL):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.schedule(interval))
+        return self.task
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    # Warmed entries and their use, as display lines
+    def describe(self):
+        used = [entry for entry in self.entries.values() if entry["hits"]]
+        lines = [f"Warmed entries: {len(self.entries)}, {len(used)} used, "
+                 f"{sum(entry['hits'] for entry in used)} hits"]
+        if self.last_run:
+            run = self.last_run
+            lines.append(f"Last warming: {run['warmed']} warmed, {run['failed']} failed, "
+                         f"{run['over_budget']} left for the next run ({', '.join(run['providers']) or 'no providers'})")
+        return lines
+
+# Entry point for 'g4fchatplus.py warm ...', e.g. from cron
+def warm_main(argv, engine):
+    parser = argparse.ArgumentParser(prog="g4fchatplus.py warm", description="Fill the response cache with replies to the custom prompts.")
+    parser.add_argument("--provider", action="append", help="provider to warm for (repeatable; default: preferred providers)")
+    parser.add_argument("--budget", type=int, default=WARM_BUDGET, help="provider calls to make at most")
+    parser.add_argument("--concurrency", type=int, default=WARM_CONCURRENCY, help="calls in flight")
+    parser.add_argument("--report", action="store_true", help="only show how warmed entries were used")
+    args = parser.parse_args(argv)
+    for name in args.provider or []:
+        if name not in engine.registry:
+            parser.error(f"unknown provider '{name}'")
+
+    warmer = engine.warmer = CacheWarmer(engine)
+    if not args.report:
+        def on_result(result):
+            status = "ok" if result["ok"] else f"failed: {result['error']}"
+            print(f"{result['prompt']} ({result['provider']}): {status}", file=sys.stderr)
+
+        asyncio.run(warmer.run(args.provider, args.budget, args.concurrency, on_result))
+    for line in warmer.describe():
+        print(line)
+    return 0
@@ -0,0 +1,280 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import shlex
+import sys
+from g4fcache import CACHE_DIR, cache_key, get_cached_response
+from g4fstate import JsonFile
+
+# Provider each step's answer came from, by the step's resolved prompt
+WORKFLOW_CACHE_FILE = os.path.join(CACHE_DIR, "workflows.json")
+
+# Step answers remembered in WORKFLOW_CACHE_FILE
+WORKFLOW_CACHE_SIZE = 2000
+
+# Joins the answers of an 'each' step, and list variables used as text
+ITEM_SEPARATOR = "\n\n"
+
+# {name} in a prompt: a variable, or the answer of the step called name
+PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+def is_workflow(prompt):
+    return isinstance(prompt, dict)
+
+# Short description of a custom prompt for listings; a workflow edited
+# into custom_prompts.json by hand may not be valid
+def describe_prompt(prompt):
+    if is_workflow(prompt):
+        try:
+            return f"workflow: {', '.join(Workflow('', prompt).steps)}"
+        except (ValueError, TypeError, AttributeError):
+            return "invalid workflow"
+    return prompt
+
+# Fill {variable} placeholders; names without a value are left as written,
+# so braces in ordinary prompts are not touched
+def fill(text, values):
+    def value(match):
+        value = values.get(match.group(1))
+        if value is None:
+            return match.group(0)
+        return ITEM_SEPARATOR.join(value) if isinstance(value, list) else value
+    return PLACEHOLDER.sub(value, text)
+
+# Split 'use prompt' arguments into the prompt name and its variables.
+# The whole text is taken as the name when it is one, so names with spaces
+# keep working; otherwise it is 'name var=value ...', shell-quoted.  A
+# value '@path' is read from the file, and a variable given more than once
+# becomes a list.
+def parse_prompt_command(text, prompts):
+    text = text.strip()
+    if text in prompts:
+        return text, {}
+    tokens = shlex.split(text)
+    if not tokens:
+        raise ValueError("No custom prompt named.")
+    variables = {}
+    for token in tokens[1:]:
+        name, sep, value = token.partition("=")
+        if not sep or not name.isidentifier():
+            raise ValueError(f"Expected name=value, got '{token}'.")
+        if value.startswith("@"):
+            with open(os.path.expanduser(value[1:]), 'r', encoding="utf-8") as f:
+                value = f.read()
+        if name in variables:
+            previous = variables[name]
+            variables[name] = (previous if isinstance(previous, list) else [previous]) + [value]
+        else:
+            variables[name] = value
+    return tokens[0], variables
+
+# A named multi-step prompt.
+#
+# Stored in custom_prompts.json as an object instead of a string:
+#
+#   {"steps": {"a": "Summarize: {doc_a}",
+#              "b": {"prompt": "Summarize: {doc_b}", "provider": "Bing"},
+#              "docs": {"prompt": "Summarize: {doc}", "each": "doc"},
+#              "compare": "Compare:\n{a}\n\n{b}"},
+#    "output": "compare", "variables": {...defaults}, "providers": [...]}
+#
+# A placeholder naming another step makes the step depend on it; any other
+# placeholder is a variable supplied with 'use prompt'.  A step with "each"
+# runs once per value of a list variable and its answer is the answers
+# joined.  Steps without a provider take the next one from "providers" in
+# step order, or the chat's provider.  "output" defaults to the last step.
+class Workflow:
+    def __init__(self, name, spec):
+        self.name = name
+        if not isinstance(spec.get("steps"), dict) or not spec["steps"]:
+            raise ValueError(f"Workflow '{name}' has no steps.")
+        self.steps = {}
+        for step, value in spec["steps"].items():
+            value = {"prompt": value} if isinstance(value, str) else dict(value)
+            if not isinstance(value.get("prompt"), str):
+                raise ValueError(f"Step '{step}' of workflow '{name}' has no prompt.")
+            self.steps[step] = value
+        self.output = spec.get("output") or list(self.steps)[-1]
+        if self.output not in self.steps:
+            raise ValueError(f"Workflow '{name}' outputs unknown step '{self.output}'.")
+        self.defaults = spec.get("variables", {})
+        self.providers = spec.get("providers", [])
+        self.dependencies = {
+            step: sorted({n for n in PLACEHOLDER.findall(value["prompt"]) if n in self.steps})
+            for step, value in self.steps.items()
+        }
+        self.variables = sorted(
+            {n for value in self.steps.values() for n in PLACEHOLDER.findall(value["prompt"]) if n not in self.steps}
+            | {value["each"] for value in self.steps.values() if value.get("each")}
+        )
+        self.order = self._sort()
+
+    # Steps with every step before its dependents
+    def _sort(self):
+        order, state = [], {}
+
+        def visit(step, path):
+            if state.get(step) == "done":
+                return
+            if state.get(step) == "visiting":
+                cycle = path[path.index(step):] + [step]
+                raise ValueError(f"Workflow '{self.name}' has a cycle: {' -> '.join(cycle)}.")
+            state[step] = "visiting"
+            for dependency in self.dependencies[step]:
+                visit(dependency, path + [step])
+            state[step] = "done"
+            order.append(step)
+
+        for step in self.steps:
+            visit(step, [])
+        return order
+
+    # Provider for every step
+    def assign_providers(self, default):
+        assigned, pool = {}, list(self.providers)
+        for i, step in enumerate(self.steps):
+            assigned[step] = self.steps[step].get("provider") or (pool[i % len(pool)] if pool else default)
+        return assigned
+
+    # Supplied variables over the defaults; raises if any is missing
+    def bind(self, variables):
+        values = dict(self.defaults, **variables)
+        missing = [name for name in self.variables if name not in values]
+        if missing:
+            raise ValueError(f"Workflow '{self.name}' needs {', '.join(missing)} "
+                             f"(use prompt {self.name} {' '.join(n + '=...' for n in missing)}).")
+        return values
+
+# Check text typed as a custom prompt: a JSON object with "steps" is a
+# workflow and is returned parsed, anything else, braces and all, is a
+# plain prompt.  Raises ValueError for an invalid workflow.
+def parse_prompt_text(name, text):
+    if not text.lstrip().startswith("{"):
+        return text
+    try:
+        spec = json.loads(text)
+    except ValueError:
+        return text
+    if not isinstance(spec, dict) or "steps" not in spec:
+        return text
+    Workflow(name, spec)
+    return spec
+
+# Which provider answered each resolved step prompt, so a step answered
+# through failover is found in the response cache again
+class StepCache:
+    def __init__(self, path=WORKFLOW_CACHE_FILE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = JsonFile(path)
+
+    def get(self, provider, messages):
+        winner = self.file.load().get(cache_key(provider, None, messages), provider)
+        response = get_cached_response(winner, messages, near_duplicate=False)
+        return (winner, response) if response is not None else None
+
+    def put(self, provider, messages, winner):
+        key = cache_key(provider, None, messages)
+
+        def record(entries):
+            entries.pop(key, None)
+            entries[key] = winner
+            for old in list(entries)[:max(0, len(entries) - WORKFLOW_CACHE_SIZE)]:
+                del entries[old]
+        self.file.update(record)
+
+_step_cache = None
+
+def get_step_cache():
+    global _step_cache
+    if _step_cache is None:
+        _step_cache = StepCache()
+    return _step_cache
+
+# Run a workflow's steps on the engine, each as soon as the steps it uses
+# have answered, so independent steps run concurrently (each provider's
+# rate limit still applies).  A step whose resolved prompt was answered
+# before is taken from the cache, so after one input changes only the
+# steps that see the change are asked again.  on_step(step, provider,
+# cached) is called as each step finishes.  Returns {step: {"prompt",
+# "response", "provider", "cached"}}; the first failing step cancels the
+# rest and its error is raised.
+async def run_workflow(engine, workflow, variables, provider_name, failover=1, on_step=None):
+    values = workflow.bind(variables)
+    providers = workflow.assign_providers(provider_name)
+    unknown = sorted({p for p in providers.values() if p not in engine.registry})
+    if unknown:
+        raise ValueError(f"Workflow '{workflow.name}' uses unknown provider {', '.join(unknown)}.")
+    cache = get_step_cache()
+    results = {}
+    tasks = {}
+
+    async def ask(provider, prompt):
+        messages = [{"role": "user", "content": prompt}]
+        hit = cache.get(provider, messages)
+        if hit:
+            return hit[0], hit[1], True
+        winner, response, cached = await engine.complete(provider, messages, near_duplicate=False,
+                                                         stream=False, failover=failover)
+        cache.put(provider, messages, winner)
+        return winner, response, cached
+
+    async def run_step(step):
+        await asyncio.gather(*(tasks[dependency] for dependency in workflow.dependencies[step]))
+        spec = workflow.steps[step]
+        inputs = dict(values, **{name: results[name]["response"] for name in workflow.dependencies[step]})
+        each = spec.get("each")
+        if each:
+            items = inputs[each] if isinstance(inputs[each], list) else [inputs[each]]
+            prompts = [fill(spec["prompt"], dict(inputs, **{each: item})) for item in items]
+        else:
+            prompts = [fill(spec["prompt"], inputs)]
+        answers = await asyncio.gather(*(ask(providers[step], prompt) for prompt in prompts))
+        results[step] = {
+            "prompt": ITEM_SEPARATOR.join(prompts),
+            "response": ITEM_SEPARATOR.join(answer[1] for answer in answers),
+            "provider": ", ".join(dict.fromkeys(answer[0] for answer in answers)),
+            "cached": all(answer[2] for answer in answers),
+        }
+        if on_step:
+            on_step(step, results[step]["provider"], results[step]["cached"])
+
+    for step in workflow.order:
+        tasks[step] = asyncio.ensure_future(run_step(step))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for task in tasks.values():
+            task.cancel()
+    return results
+
+# Entry point for 'g4fchatplus.py workflow NAME [var=value ...]': prints the
+# output step's answer, and each step's progress on stderr
+def workflow_main(argv, engine):
+    parser = argparse.ArgumentParser(prog="g4fchatplus.py workflow", description="Run a custom prompt workflow.")
+    parser.add_argument("name", help="custom prompt to run")
+    parser.add_argument("variables", nargs="*", metavar="var=value", help="workflow variables ('@path' reads a file)")
+    parser.add_argument("--provider", required=True, help="provider for steps that do not name one")
+    parser.add_argument("--failover", type=int, default=1, metavar="N", help="providers to try per step")
+    args = parser.parse_intermixed_args(argv)
+
+    if args.provider not in engine.registry:
+        parser.error(f"unknown provider '{args.provider}'")
+    prompt = engine.custom_prompts.get(args.name)
+    if prompt is None:
+        parser.error(f"unknown custom prompt '{args.name}'")
+    try:
+        _, variables = parse_prompt_command(shlex.join(["-"] + args.variables), {})
+        spec = prompt if is_workflow(prompt) else {"steps": {args.name: prompt}}
+        workflow = Workflow(args.name, spec)
+
+        def on_step(step, provider, cached):
+            print(f"{step} ({provider}): {'cached' if cached else 'done'}", file=sys.stderr)
+
+        results = asyncio.run(run_workflow(engine, workflow, variables, args.provider, args.failover, on_step))
+    except Exception as e:
+        print(f"{type(e).__name__}: {e}", file=sys.stderr)
+        return 1
+    print(results[workflow.output]["response"])
+    return 0
@@ -0,0 +1,46 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from g4fbench import register_fake_provider
+from g4fcore import ChatEngine, TurnOutput
+from g4fmetrics import get_metrics
+from g4fsearch import SearchIndex
+
+# Turns and replies reach a search index that starts out empty
+class FreshIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.index = SearchIndex()
+        self.engine = ChatEngine(register_fake_provider(latency=0, ttft=0), search=self.index)
+
+    def tearDown(self):
+        self.index.close()
+        # Export here rather than at exit, into the current directory
+        get_metrics()._export_at_exit()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_chat_turn_is_searchable(self):
+        async def chat():
+            session = self.engine.open_session("notes", "Fake")
+            await session.send("where did the zeppelin land", TurnOutput())
+            await self.engine.shutdown()
+
+        self.assertEqual(len(self.index), 0)
+        asyncio.run(chat())
+        results = self.index.search("zeppelin")
+        self.assertEqual([d["kind"] for _, d in results], ["chat"])
+        self.assertEqual(results[0][1]["source"], "notes")
+
+    def test_fresh_reply_is_searchable(self):
+        messages = [{"role": "user", "content": "describe the zeppelin"}]
+        asyncio.run(self.engine.complete("Fake", messages, stream=False))
+        results = self.index.search("zeppelin")
+        self.assertEqual([d["kind"] for _, d in results], ["cache"])
+
+if __name__ == "__main__":
+    unittest.main()